@@ -9,43 +9,48 @@ import socket
 import time
 import threading
 import logging
-import subprocess
+import signal
 import re
+import errno
+import heapq
+import itertools
+import subprocess
+import ctypes
+import contextlib
+import hashlib
+import random
+import atexit
+import tempfile
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor
 import platform  # 用于获取主机名
+import sys
+try:
+    import resource  # 仅POSIX提供，Windows下脚本不设置资源限制
+except ImportError:
+    resource = None
 
 # 获取脚本所在目录和主机名
 AGENT_DIR = os.path.dirname(os.path.abspath(__file__))
 HOSTNAME = platform.node()  # 使用platform.node()获取更准确的主机名
 
+# 引入服务端和节点代理共用的模块
+sys.path.insert(0, os.path.dirname(AGENT_DIR))
+from common.framing import FrameReader, MESSAGE_ERRORS, encode_frame, decode_frame
+from common.logpipe import setup_logging
+
 # 配置日志
 LOG_FILE = os.path.join(AGENT_DIR, 'agent.log')
+LOG_LEVEL = logging.INFO  # 排查问题时可改为logging.DEBUG
 
-# 创建日志记录器
-logger = logging.getLogger('superagent-agent')
-logger.setLevel(logging.DEBUG)  # 临时设置为DEBUG以获取详细调试信息
-
-# 清除已有的处理器
-if logger.handlers:
-    logger.handlers.clear()
-
-# 创建格式器
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-# 创建文件处理器
-file_handler = logging.FileHandler(LOG_FILE)
-file_handler.setFormatter(formatter)
-file_handler.setLevel(logging.DEBUG)  # 设置为DEBUG以记录所有调试信息
-
-# 创建控制台处理器
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(formatter)
-console_handler.setLevel(logging.DEBUG)  # 设置为DEBUG以显示所有调试信息
+# 高频日志的采样率，按日志类别（extra中的category）配置
+LOG_SAMPLE_RATES = {
+    'heartbeat': 0.1  # 心跳日志每10条保留1条
+}
 
-# 添加处理器到记录器
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+# 创建日志记录器：事件循环只负责入队，格式化和写文件/控制台由后台线程完成，输出JSON行并按大小轮转
+logger = logging.getLogger('superagent-agent')
+setup_logging(logger, LOG_FILE, level=LOG_LEVEL, console=True, sample_rates=LOG_SAMPLE_RATES)
 
 # 记录启动信息
 logger.info(f"SuperAgent Agent 启动中... 主机名: {HOSTNAME}, 日志文件: {LOG_FILE}")
@@ -54,48 +59,350 @@ logger.info(f"SuperAgent Agent 启动中... 主机名: {HOSTNAME}, 日志文件:
 SERVER_HOST = '192.168.123.101'  # 服务端地址（根据实际连接地址修改）
 SERVER_PORT = 4568  # 节点连接端口（必须与服务端配置的NODE_PORT一致）
 SCRIPT_DIR = os.path.join(AGENT_DIR, 'scripts')  # 脚本存储目录
-TASKS_FILE = os.path.join(SCRIPT_DIR, '.tasks.json')  # 任务持久化文件
+TASKS_FILE = os.path.join(SCRIPT_DIR, '.tasks.json')  # 旧版本的任务持久化文件，启动时迁移到 TASK_STORE_DIR
+TASK_STORE_DIR = os.path.join(SCRIPT_DIR, '.tasks')  # 任务持久化目录，每个任务一个文件
+TASK_STORE_FLUSH_DELAY = 0.2  # 任务变更合并写入的延迟（秒），同步期间的大量变更只写一次
+
+# 离线缓存配置：与服务端断开期间任务继续执行，结果写入磁盘缓存，重连后补发
+SPOOL_DIR = os.path.join(AGENT_DIR, 'spool')  # 离线缓存目录
+SPOOL_MAX_BYTES = 64 * 1024 * 1024  # 离线缓存总大小上限，超过后丢弃最旧的分段
+SPOOL_SEGMENT_BYTES = 1024 * 1024  # 单个缓存分段文件的大小
+SPOOL_REPLAY_BATCH = 100  # 补发时每条消息包含的结果数
+SPOOL_REPLAY_INTERVAL = 0.5  # 补发消息之间的间隔（秒），避免重连后集中冲击服务端
 NODE_SECRET_KEY = 'superagent_secret_key_2024'  # 用于节点验证的密钥，必须与服务端一致
 
+# 重连退避配置：等待时间在 [0, min(上限, 基数*2^失败次数)] 内随机，避免所有节点同时重连
+RECONNECT_BASE_DELAY = 1  # 退避基数（秒）
+RECONNECT_MAX_DELAY = 300  # 退避上限（秒）
+RECONNECT_STABLE_TIME = 60  # 连接保持超过该时长（秒）后断开，退避从头开始
+
+# 节点标签，认证时上报给服务端，用于按标签定向下发任务
+# 可通过环境变量 SUPERAGENT_LABELS 追加或覆盖，格式: role=db,dc=bj
+NODE_LABELS = {
+    'os': platform.system().lower()
+}
+
+def load_node_labels():
+    """合并配置中的标签和环境变量中的标签"""
+    labels = dict(NODE_LABELS)
+    for item in os.environ.get('SUPERAGENT_LABELS', '').split(','):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            if key.strip():
+                labels[key.strip()] = value.strip()
+    return labels
+
 # 节点信息
 NODE_ID = None  # 服务端分配的节点ID
-node_info = {  # 节点信息，包含ID和主机名
+node_info = {  # 节点信息，包含ID、主机名和标签
     'id': None,
-    'hostname': HOSTNAME
+    'hostname': HOSTNAME,
+    'labels': load_node_labels()
 }
 
 # 存储任务信息
 class Task:
-    def __init__(self, task_name, script_content, interval):
+    def __init__(self, task_name, script_sha, interval, phase=0, collector=None, limits=None, priority=None):
         self.task_name = task_name
-        self.script_content = script_content
+        self.script_sha = script_sha  # 脚本内容的sha256，脚本本身保存在 script_path，内置采集器为None
         self.interval = interval
-        self.timer = None
+        self.phase = phase  # 服务端分配的相位偏移（秒），执行时刻为 interval 的整数倍加上 phase
+        self.collector = collector  # 内置采集器名称，为空时执行脚本
+        self.collector_state = None  # 采集器在两次执行之间保留的数据（如CPU计数）
+        self.limits = limits or {}  # 服务端为该任务指定的资源限制，未指定的项使用默认值
+        self.priority = resolve_priority(priority, interval)  # 执行优先级: critical、normal 或 bulk
         self.script_path = os.path.join(SCRIPT_DIR, f"{task_name}.sh")
         self.should_stop = False  # 用于控制任务是否继续运行
+        self.throttled_until = 0  # 服务端限流该任务时，在此时刻（monotonic）之前跳过执行
+    
+    def definition(self):
+        """任务定义，用于判断服务端重新下发的任务是否有变化"""
+        return (self.script_sha, self.interval, self.phase, self.collector, self.limits, self.priority)
+    
+    def to_entry(self):
+        """持久化格式，脚本只保存引用和摘要"""
+        return {
+            'task_name': self.task_name,
+            'script': None if self.collector else os.path.basename(self.script_path),
+            'sha256': self.script_sha,
+            'interval': self.interval,
+            'phase': self.phase,
+            'collector': self.collector,
+            'limits': self.limits,
+            'priority': self.priority
+        }
+
+def script_digest(script_content):
+    """计算脚本内容的sha256"""
+    return hashlib.sha256(script_content.encode('utf-8')).hexdigest()
+
+def write_file_atomic(path, data, mode=0o644):
+    """写入临时文件后原子替换，进程在写入过程中退出或断电不会留下半个文件
+    
+    临时文件名唯一，同一文件的并发写入互不覆盖；替换前fsync，保证替换后的文件内容已落盘
+    """
+    directory, filename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{filename}.", suffix='.tmp', dir=directory or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def resolve_priority(priority, interval):
+    """服务端未指定优先级时，按执行间隔推断: 间隔短的检查对延迟敏感，间隔长的脚本作为批量任务"""
+    if priority in EXECUTION_PRIORITIES:
+        return priority
+    if interval <= CRITICAL_INTERVAL:
+        return 'critical'
+    if interval >= BULK_INTERVAL:
+        return 'bulk'
+    return 'normal'
 
 # 所有任务
 all_tasks = {}
 
-# 创建线程池用于执行脚本
-thread_pool = ThreadPoolExecutor(max_workers=10)
+# 服务端对整个节点限流时，在此时刻（monotonic）之前暂停发送
+throttle_state = {
+    'until': 0
+}
+
+# 最近一次向服务端发送消息的时刻（monotonic），任何消息都能证明节点在线，空闲时才需要发送心跳
+link_state = {
+    'last_sent': 0
+}
+
+# 脚本执行配置
+SCRIPT_TIMEOUT = 300  # 脚本执行超时时间（秒）
+SCRIPT_KILL_GRACE = 5  # 超时后发送SIGTERM到SIGKILL之间的等待时间（秒）
+MAX_CONCURRENT_SCRIPTS = 32  # 同时运行的脚本数上限
+
+# 执行优先级，服务端未指定时按执行间隔推断
+EXECUTION_PRIORITIES = ('critical', 'normal', 'bulk')
+CRITICAL_INTERVAL = 60  # 执行间隔不超过该值（秒）的任务默认为critical
+BULK_INTERVAL = 3600  # 执行间隔不小于该值（秒）的任务默认为bulk
+# 各优先级最多占用的执行槽位比例
+EXECUTION_PRIORITY_SHARE = {'critical': 1.0, 'normal': 0.75, 'bulk': 0.25}
+FAIR_SHARE_HALF_LIFE = 600  # 公平份额中任务累计执行时间的衰减半衰期（秒）
+
+# 脚本资源限制，服务端可以为单个任务指定（client --limits），未指定的项使用默认值
+# 默认值为None的项不设置，脚本继承代理自身的限制，只有服务端指定时才生效
+DEFAULT_SCRIPT_LIMITS = {
+    'cpu_seconds': 60,  # CPU时间（RLIMIT_CPU），超过后脚本收到SIGXCPU
+    'memory_mb': 256,  # 数据段大小（RLIMIT_DATA），不限制地址空间，JVM、Go等预留大量虚拟内存的程序不受影响
+    'open_files': None,  # 打开文件数（RLIMIT_NOFILE）
+    'output_kb': 1024,  # 标准输出和错误输出合计大小，超过后终止脚本
+    'nice': 10,  # 调度优先级，越大越低
+    'io_class': 'best-effort',  # IO调度类别: best-effort 或 idle
+    'io_level': 7,  # best-effort类别下的IO优先级，0最高，7最低
+    'timeout': SCRIPT_TIMEOUT,  # 执行超时（秒），超过后终止脚本
+}
+# 服务端指定的值不能超过以下上限，保证单个脚本的开销有上限
+SCRIPT_LIMIT_CAPS = {
+    'cpu_seconds': 300,
+    'memory_mb': 2048,
+    'open_files': 1024,
+    'output_kb': 8192,
+    'timeout': 3600,
+}
+SCRIPT_MIN_NICE = 0  # 脚本的调度优先级不能高于代理本身
+# 同时运行的脚本内存限制之和的上限（MB），与 MAX_CONCURRENT_SCRIPTS 一起限定代理在主机上的总开销
+SCRIPT_MEMORY_BUDGET_MB = 4096
+SCRIPT_SHELL = '/bin/sh'  # 脚本没有shebang时用于解释执行的shell
+# 进程组、wait4和资源限制只在POSIX下可用，Windows下脚本直接终止和回收，不统计CPU时间
+SCRIPT_KILL_SIGNAL = getattr(signal, 'SIGKILL', signal.SIGTERM)
+SCRIPT_CPU_SIGNAL = getattr(signal, 'SIGXCPU', None)
+
+IOPRIO_CLASSES = {'best-effort': 2, 'idle': 3}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+# ioprio_set没有libc封装，按架构使用系统调用号
+SYS_IOPRIO_SET = {'x86_64': 251, 'aarch64': 30, 'i386': 289, 'i686': 289, 'armv7l': 314}.get(platform.machine())
+try:
+    libc_syscall = ctypes.CDLL(None, use_errno=True).syscall if sys.platform.startswith('linux') else None
+except (OSError, AttributeError):
+    libc_syscall = None
+
+def resolve_script_limits(limits):
+    """合并服务端指定的资源限制和默认值，并限制在上限之内"""
+    resolved = dict(DEFAULT_SCRIPT_LIMITS)
+    for key, value in (limits or {}).items():
+        if key not in resolved:
+            logger.warning(f"忽略未知的资源限制: {key}")
+            continue
+        if key == 'io_class':
+            if value in IOPRIO_CLASSES:
+                resolved[key] = value
+            continue
+        try:
+            resolved[key] = int(value)
+        except (TypeError, ValueError):
+            logger.warning(f"资源限制 {key} 的值无效: {value}")
+    for key, cap in SCRIPT_LIMIT_CAPS.items():
+        if resolved[key] is not None:
+            resolved[key] = max(1, min(resolved[key], cap))
+    resolved['nice'] = max(SCRIPT_MIN_NICE, min(resolved['nice'], 19))
+    resolved['io_level'] = max(0, min(resolved['io_level'], 7))
+    return resolved
+
+class ScriptBudget:
+    """按内存限制为运行中的脚本预留额度，额度不足时等待其他脚本结束
+    
+    条件变量在第一次使用时于运行中的事件循环里创建，模块导入时还没有事件循环
+    """
+    
+    def __init__(self, total_mb):
+        self.total_mb = total_mb
+        self.used_mb = 0
+        self._condition = None
+    
+    def _get_condition(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+    
+    async def acquire(self, memory_mb):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.used_mb + memory_mb <= self.total_mb)
+            self.used_mb += memory_mb
+    
+    async def release(self, memory_mb):
+        condition = self._get_condition()
+        async with condition:
+            self.used_mb -= memory_mb
+            condition.notify_all()
+
+class ExecutionQueue:
+    """脚本执行槽位，按优先级和公平份额分配
+    
+    - 优先级：critical 先于 normal 先于 bulk；低优先级最多占用 EXECUTION_PRIORITY_SHARE 比例的槽位，
+      保证短间隔的检查在大量慢脚本或立即执行请求下仍有空闲槽位
+    - 公平份额：同一优先级内，近期累计执行时间（按 FAIR_SHARE_HALF_LIFE 衰减）最少的任务先执行
+    """
+    
+    def __init__(self, slots):
+        self.slots = slots
+        self.running = 0
+        self._class_running = dict.fromkeys(EXECUTION_PRIORITIES, 0)
+        self._class_limit = {priority: max(1, int(slots * EXECUTION_PRIORITY_SHARE[priority]))
+                             for priority in EXECUTION_PRIORITIES}
+        self._waiters = []  # [(优先级序号, 序号, 任务名, 优先级, future)]
+        self._usage = {}  # {任务名: (衰减后的累计执行时间, 更新时间)}
+        self._counter = itertools.count()
+    
+    @property
+    def queued(self):
+        """等待执行槽位的脚本数"""
+        return len(self._waiters)
+    
+    def _decayed_usage(self, task_name, now):
+        value, updated = self._usage.get(task_name, (0.0, now))
+        return value * 0.5 ** ((now - updated) / FAIR_SHARE_HALF_LIFE)
+    
+    def _can_run(self, priority):
+        return self.running < self.slots and self._class_running[priority] < self._class_limit[priority]
+    
+    def _start(self, priority):
+        self.running += 1
+        self._class_running[priority] += 1
+    
+    def _wake(self):
+        """把空闲槽位分配给等待中的执行，跳过已被取消、尚未清理的等待者"""
+        now = time.monotonic()
+        self._waiters = [waiter for waiter in self._waiters if not waiter[4].done()]
+        while self._waiters and self.running < self.slots:
+            candidates = [waiter for waiter in self._waiters if self._can_run(waiter[3])]
+            if not candidates:
+                return
+            waiter = min(candidates, key=lambda w: (w[0], self._decayed_usage(w[2], now), w[1]))
+            self._waiters.remove(waiter)
+            self._start(waiter[3])
+            waiter[4].set_result(None)
+    
+    @contextlib.asynccontextmanager
+    async def slot(self, task_name, priority):
+        """占用一个执行槽位，结束后按执行时间计入任务的公平份额"""
+        # 先加入等待队列再分配，有空闲槽位且没有更优先的等待者时立即获得槽位
+        future = asyncio.get_running_loop().create_future()
+        waiter = (EXECUTION_PRIORITIES.index(priority), next(self._counter), task_name, priority, future)
+        self._waiters.append(waiter)
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分配槽位后、恢复运行前被取消，归还槽位并交给下一个等待者
+                self._release(task_name, priority, 0)
+            elif waiter in self._waiters:
+                # 等待中被取消，_wake可能已经把它移出队列
+                self._waiters.remove(waiter)
+            raise
+        
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(task_name, priority, time.monotonic() - started)
+    
+    def _release(self, task_name, priority, elapsed):
+        now = time.monotonic()
+        self._usage[task_name] = (self._decayed_usage(task_name, now) + elapsed, now)
+        self.running -= 1
+        self._class_running[priority] -= 1
+        self._wake()
+    
+    def forget(self, task_name):
+        """任务删除后清除其公平份额记录"""
+        self._usage.pop(task_name, None)
+
+# 按优先级和公平份额分配脚本执行槽位
+execution_queue = ExecutionQueue(MAX_CONCURRENT_SCRIPTS)
+# 限制同时运行的脚本内存总量
+script_budget = ScriptBudget(SCRIPT_MEMORY_BUDGET_MB)
+
+class ScriptOutputTooLarge(Exception):
+    """脚本输出超过限制"""
+
+# 创建线程池用于文件读写等阻塞操作
+thread_pool = ThreadPoolExecutor(max_workers=4)
+# 单线程执行需要保持顺序的文件写入（离线缓存、任务存储），提交顺序即写入顺序
+file_writer = ThreadPoolExecutor(max_workers=1)
 
 # 创建脚本目录
 os.makedirs(SCRIPT_DIR, exist_ok=True)
 
+# 脚本输出行格式: 级别|值 或 级别:子键|值
+OUTPUT_LINE_PATTERN = re.compile(r'^([IWE])(?::([^|]+))?\|\s*(.*)$')
+LEVEL_SEVERITY = {'O': 0, 'I': 1, 'W': 2, 'E': 3}
+
+def summarize_metrics(metrics):
+    """为多项结果中没有子键的行编号，返回 (最严重的级别, 对应的值, 多项结果)"""
+    unkeyed = [metric for metric in metrics if not metric[1]]
+    if len(unkeyed) > 1:
+        for index, metric in enumerate(unkeyed, 1):
+            metric[1] = str(index)
+    worst = max(metrics, key=lambda metric: LEVEL_SEVERITY.get(metric[0], 0))
+    value = f"{worst[1]} {worst[2]}" if worst[1] else worst[2]
+    return worst[0], value, metrics
+
 class ScriptExecutor:
     """脚本执行器"""
     
     @staticmethod
     def save_script(task_name, script_content):
-        """保存脚本到本地"""
+        """保存脚本到本地（原子替换，并添加执行权限）"""
         try:
             script_path = os.path.join(SCRIPT_DIR, f"{task_name}.sh")
-            with open(script_path, 'w', encoding='utf-8') as f:
-                f.write(script_content)
-            
-            # 添加执行权限
-            os.chmod(script_path, 0o755)
+            write_file_atomic(script_path, script_content.encode('utf-8'), 0o755)
             logger.info(f"脚本 {task_name} 已保存到 {script_path}")
             return True, script_path
         except Exception as e:
@@ -104,119 +411,544 @@ class ScriptExecutor:
             return False, error_msg
     
     @staticmethod
-    def execute_script(script_path):
-        """执行脚本并解析输出"""
+    def _rlimit(kind, value):
+        """不超过当前硬限制的 (软限制, 硬限制)，避免setrlimit因提高硬限制而失败"""
+        _, hard = resource.getrlimit(kind)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        return value, value
+    
+    @staticmethod
+    def _apply_limits(pid, limits):
+        """对刚启动的脚本进程设置资源限制、调度优先级和IO优先级，脚本之后启动的子进程会继承
+        
+        prlimit仅Linux提供，其他平台不设置资源限制，setpriority在Windows下不可用
+        """
+        if sys.platform.startswith('linux'):
+            ScriptExecutor._apply_rlimits(pid, limits)
+        if hasattr(os, 'setpriority'):
+            os.setpriority(os.PRIO_PROCESS, pid, limits['nice'])
+        if libc_syscall is not None and SYS_IOPRIO_SET is not None:
+            ioprio = (IOPRIO_CLASSES[limits['io_class']] << IOPRIO_CLASS_SHIFT) | limits['io_level']
+            libc_syscall(SYS_IOPRIO_SET, IOPRIO_WHO_PROCESS, pid, ioprio)
+    
+    @staticmethod
+    def _apply_rlimits(pid, limits):
+        """通过prlimit设置CPU时间、数据段大小和打开文件数，未指定打开文件数时继承代理自身的限制"""
+        cpu_soft, cpu_hard = ScriptExecutor._rlimit(resource.RLIMIT_CPU, limits['cpu_seconds'])
+        # 超过软限制时收到SIGXCPU，留出宽限时间后由硬限制强制杀死
+        rlimits = [
+            (resource.RLIMIT_CPU, (cpu_soft, cpu_hard if cpu_hard != cpu_soft else cpu_soft + SCRIPT_KILL_GRACE)),
+            (resource.RLIMIT_DATA, ScriptExecutor._rlimit(resource.RLIMIT_DATA, limits['memory_mb'] * 1024 * 1024)),
+        ]
+        if limits['open_files'] is not None:
+            rlimits.append((resource.RLIMIT_NOFILE, ScriptExecutor._rlimit(resource.RLIMIT_NOFILE, limits['open_files'])))
+        for kind, value in rlimits:
+            resource.prlimit(pid, kind, value)
+    
+    @staticmethod
+    def _spawn(script_path, limits):
+        """直接exec脚本（不经过shell），脚本放在新的会话中以便超时时按进程组终止，启动后立即设置资源限制
+        
+        在线程池中调用，fork和exec不阻塞事件循环。限制在exec之后通过prlimit设置，
+        子进程中不需要在fork后执行Python代码（preexec_fn在多线程下不安全），代价是脚本开始运行的瞬间尚未受限。
+        不使用asyncio的子进程接口：它由子进程监视器回收进程，拿不到子进程的rusage，
+        这里由execute_script自行用wait4回收
+        """
+        command = [script_path]
+        while True:
+            try:
+                proc = subprocess.Popen(
+                    command,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    start_new_session=True
+                )
+                break
+            except OSError as e:
+                # 没有shebang的脚本无法直接exec，交给shell解释执行
+                if e.errno != errno.ENOEXEC or command[0] == SCRIPT_SHELL:
+                    raise
+                command = [SCRIPT_SHELL, script_path]
         try:
-            logger.info(f"执行脚本: {script_path}")
-            
-            # 执行脚本，使用shell=True以支持环境变量解析
-            result = subprocess.run(
-                script_path,
-                shell=True,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                timeout=300  # 5分钟超时
+            ScriptExecutor._apply_limits(proc.pid, limits)
+        except OSError:
+            # 限制没有生效时不继续运行脚本
+            ScriptExecutor._kill_process_group(proc, SCRIPT_KILL_SIGNAL)
+            proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+            raise
+        return proc
+    
+    @staticmethod
+    def _discard(spawning):
+        """执行在启动脚本期间被取消时，终止并回收已经启动的脚本"""
+        if spawning.cancelled() or spawning.exception() is not None:
+            return
+        proc = spawning.result()
+        ScriptExecutor._kill_process_group(proc, SCRIPT_KILL_SIGNAL)
+        thread_pool.submit(proc.communicate)
+    
+    @staticmethod
+    async def _read_pipe(pipe, budget):
+        """在事件循环中读取子进程管道直到EOF
+        
+        budget为标准输出和错误输出共享的剩余字节数 [剩余]，用完时抛出ScriptOutputTooLarge
+        """
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        chunks = []
+        try:
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    return b''.join(chunks)
+                budget[0] -= len(chunk)
+                if budget[0] < 0:
+                    raise ScriptOutputTooLarge()
+                chunks.append(chunk)
+        finally:
+            transport.close()
+    
+    @staticmethod
+    async def _wait4(proc):
+        """等待子进程退出并回收，返回 (退出码, rusage)
+        
+        支持pidfd时由事件循环监听进程退出，否则在线程中阻塞等待；没有wait4的平台（Windows）rusage为None
+        """
+        loop = asyncio.get_running_loop()
+        if not hasattr(os, 'wait4'):
+            return await loop.run_in_executor(None, proc.wait), None
+        pid = proc.pid
+        try:
+            pidfd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            pidfd = None
+        if pidfd is None:
+            _, status, rusage = await loop.run_in_executor(None, os.wait4, pid, 0)
+            return ScriptExecutor._exit_code(status), rusage
+        
+        exited = loop.create_future()
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+        _, status, rusage = os.wait4(pid, 0)
+        return ScriptExecutor._exit_code(status), rusage
+    
+    @staticmethod
+    def _kill_process_group(proc, sig):
+        """向脚本所在的进程组发送信号，包括脚本启动的子进程；没有进程组的平台（Windows）只终止脚本本身"""
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(proc.pid, sig)
+            else:
+                proc.kill()
+        except ProcessLookupError:
+            pass
+    
+    @staticmethod
+    def _exit_code(status):
+        """将wait状态转换为与Popen.returncode一致的退出码，被信号终止时为负的信号值
+        
+        与os.waitstatus_to_exitcode相同，但该函数需要Python 3.9，这里兼容更早的版本
+        """
+        if os.WIFEXITED(status):
+            return os.WEXITSTATUS(status)
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return status
+    
+    @staticmethod
+    def _usage(started, returncode, rusage):
+        """整理一次执行的资源消耗: 耗时、用户态/内核态CPU（秒）、退出码，没有rusage时CPU时间记为0
+
+        不上报最大RSS: 子进程由代理fork后exec，内核记录的峰值包含代理自身的内存，没有参考价值"""
+        return {
+            'wall': round(time.monotonic() - started, 3),
+            'utime': round(rusage.ru_utime, 3) if rusage is not None else 0.0,
+            'stime': round(rusage.ru_stime, 3) if rusage is not None else 0.0,
+            'exit': returncode
+        }
+    
+    @staticmethod
+    async def execute_script(script_path, timeout=None, limits=None):
+        """异步执行脚本，返回 (输出, 资源消耗)，失败时输出为错误信息，无法启动时资源消耗为None
+        
+        limits为服务端指定的资源限制，与默认值合并后在子进程中生效；未指定timeout时使用limits中的超时时间
+        """
+        limits = resolve_script_limits(limits)
+        timeout = timeout or limits['timeout']
+        await script_budget.acquire(limits['memory_mb'])
+        try:
+            return await ScriptExecutor._execute(script_path, timeout, limits)
+        finally:
+            await script_budget.release(limits['memory_mb'])
+    
+    @staticmethod
+    async def _execute(script_path, timeout, limits):
+        """启动脚本并等待结束，超时、输出过多或CPU时间超限时终止整个进程组"""
+        loop = asyncio.get_running_loop()
+        logger.info(f"执行脚本: {script_path}")
+        started = time.monotonic()
+        spawning = loop.run_in_executor(thread_pool, ScriptExecutor._spawn, script_path, limits)
+        try:
+            proc = await asyncio.shield(spawning)
+        except asyncio.CancelledError:
+            spawning.add_done_callback(ScriptExecutor._discard)
+            raise
+        except Exception as e:
+            error_msg = f"执行脚本时发生异常: {e}"
+            logger.error(error_msg)
+            return error_msg, None
+        
+        # 回收进程的任务单独运行，即使本次执行被取消也会完成回收，避免僵尸进程
+        waiter = asyncio.ensure_future(ScriptExecutor._wait4(proc))
+        output_budget = [limits['output_kb'] * 1024]
+        
+        async def communicate():
+            stdout, stderr = await asyncio.gather(
+                ScriptExecutor._read_pipe(proc.stdout, output_budget),
+                ScriptExecutor._read_pipe(proc.stderr, output_budget)
             )
-            
-            output = result.stdout.strip()
-            return output
-            
-        except subprocess.TimeoutExpired:
-            error_msg = f"脚本执行超时（超过5分钟）"
+            returncode, rusage = await asyncio.shield(waiter)
+            return stdout, stderr, returncode, rusage
+        
+        try:
+            stdout, stderr, returncode, rusage = await asyncio.wait_for(communicate(), timeout)
+        except asyncio.TimeoutError:
+            # 先尝试正常终止整个进程组，超过宽限时间后强制杀死
+            ScriptExecutor._kill_process_group(proc, signal.SIGTERM)
+            try:
+                returncode, rusage = await asyncio.wait_for(asyncio.shield(waiter), SCRIPT_KILL_GRACE)
+            except asyncio.TimeoutError:
+                ScriptExecutor._kill_process_group(proc, SCRIPT_KILL_SIGNAL)
+                returncode, rusage = await waiter
+            proc.returncode = returncode
+            error_msg = f"脚本执行超时（超过{timeout}秒）"
             logger.error(error_msg)
-            return error_msg
-        except subprocess.CalledProcessError as e:
-            error_msg = f"脚本执行失败，退出码: {e.returncode}\n错误输出: {e.stderr}"
+            return error_msg, ScriptExecutor._usage(started, returncode, rusage)
+        except ScriptOutputTooLarge:
+            ScriptExecutor._kill_process_group(proc, SCRIPT_KILL_SIGNAL)
+            returncode, rusage = await waiter
+            proc.returncode = returncode
+            error_msg = f"脚本输出超过限制（{limits['output_kb']}KB），已终止"
             logger.error(error_msg)
-            return error_msg
-        except Exception as e:
-            error_msg = f"执行脚本时发生异常: {e}"
+            return error_msg, ScriptExecutor._usage(started, returncode, rusage)
+        except asyncio.CancelledError:
+            ScriptExecutor._kill_process_group(proc, SCRIPT_KILL_SIGNAL)
+            # 保持Popen对象存活到回收完成，避免它在回收前被析构并由subprocess模块抢先回收
+            waiter.add_done_callback(lambda future: setattr(proc, 'returncode', -SCRIPT_KILL_SIGNAL))
+            raise
+        
+        # 已由wait4回收，告知Popen对象以免它再次回收同一个pid
+        proc.returncode = returncode
+        usage = ScriptExecutor._usage(started, returncode, rusage)
+        logger.debug(f"脚本 {script_path} 资源消耗: {usage}")
+        
+        if SCRIPT_CPU_SIGNAL is not None and (
+                proc.returncode == -SCRIPT_CPU_SIGNAL or (proc.returncode == -SCRIPT_KILL_SIGNAL
+                                                          and usage['utime'] + usage['stime'] >= limits['cpu_seconds'])):
+            error_msg = f"脚本CPU时间超过限制（{limits['cpu_seconds']}秒），已终止"
+            logger.error(error_msg)
+            return error_msg, usage
+        
+        if proc.returncode != 0:
+            error_msg = f"脚本执行失败，退出码: {proc.returncode}\n错误输出: {stderr.decode('utf-8', errors='replace')}"
             logger.error(error_msg)
-            return error_msg
+            return error_msg, usage
+        
+        return stdout.decode('utf-8', errors='replace').strip(), usage
     
     @staticmethod
     def parse_script_output(output):
-        """解析脚本输出，提取级别和值"""
-        # 尝试匹配格式: 级别|值
-        match = re.search(r'^([IWE])\|\s*(.*)$', output.strip())
-        if match:
-            level = match.group(1)
-            value = match.group(2).strip()
-            return level, value
+        """解析脚本输出，返回 (级别, 值, 多项结果)
+        
+        每行格式为 级别|值 或 级别:子键|值（如 W:/data|91%），不符合格式的行忽略。
+        只有一行且没有子键时多项结果为None；否则多项结果为 [级别, 子键, 值] 列表，
+        级别和值取最严重的一行
+        """
+        metrics = []
+        for line in output.strip().splitlines():
+            match = OUTPUT_LINE_PATTERN.match(line.strip())
+            if match:
+                metrics.append([match.group(1), match.group(2), match.group(3).strip()])
         
         # 如果没有匹配，默认为O级别
-        return 'O', output.strip()
+        if not metrics:
+            return 'O', output.strip(), None
+        if len(metrics) == 1 and metrics[0][1] is None:
+            return metrics[0][0], metrics[0][2], None
+        return summarize_metrics(metrics)
 
-# 保留原有的setup_task函数以兼容load_tasks
-# 在load_tasks中会使用这个函数，但在实际运行时会被setup_task_async替代
-# 当没有writer参数时，不会实际发送结果，只保存任务
+# 内置采集器告警阈值（百分比），达到W阈值输出W，达到E阈值输出E
+CPU_WARN_PERCENT = 70
+CPU_ERROR_PERCENT = 90
+MEM_WARN_PERCENT = 70
+MEM_ERROR_PERCENT = 90
+DISK_WARN_PERCENT = {'/': 85}  # 按挂载点设置磁盘告警阈值，未列出的挂载点使用 DISK_DEFAULT_WARN_PERCENT
+DISK_DEFAULT_WARN_PERCENT = 95
+DISK_ERROR_PERCENT = 98
+# 只统计这些真实文件系统，忽略proc、tmpfs、overlay等
+DISK_FS_TYPES = {'ext2', 'ext3', 'ext4', 'xfs', 'btrfs', 'zfs', 'f2fs', 'jfs', 'reiserfs', 'vfat'}
 
-def setup_task(task_name, script_content, interval):
-    """设置任务（兼容旧代码）"""
-    # 取消已存在的任务
-    if task_name in all_tasks:
-        cancel_task(task_name)
+class NativeCollectors:
+    """内置采集器，直接读取/proc和statvfs，不需要启动shell和外部命令"""
     
-    # 保存脚本
-    success, result = ScriptExecutor.save_script(task_name, script_content)
-    if not success:
-        logger.error(f"设置任务 {task_name} 失败: {result}")
-        return False
+    @staticmethod
+    def _read_cpu_times():
+        """读取/proc/stat中的CPU总计数，返回 (空闲, 总计)"""
+        with open('/proc/stat', 'r') as f:
+            fields = f.readline().split()
+        values = [int(v) for v in fields[1:]]
+        # idle + iowait 视为空闲；guest已包含在user中，不重复统计
+        idle = values[3] + (values[4] if len(values) > 4 else 0)
+        total = sum(values[:8])
+        return idle, total
     
-    # 创建任务对象
-    task = Task(task_name, script_content, interval)
-    all_tasks[task_name] = task
+    @staticmethod
+    def _level(percent, warn, error):
+        if percent >= error:
+            return 'E'
+        if percent >= warn:
+            return 'W'
+        return 'I'
     
-    # 注意：这里不再启动实际的任务执行
-    # 任务执行将在连接到服务器后通过asyncio启动
+    @staticmethod
+    def prime(task):
+        """任务设置时记录初始数据，使第一次执行就能计算出区间值"""
+        if task.collector == 'cpu':
+            try:
+                task.collector_state = NativeCollectors._read_cpu_times()
+            except OSError:
+                task.collector_state = None
     
-    # 更新持久化存储
-    save_tasks()
+    @staticmethod
+    def collect_cpu(task):
+        """计算两次执行之间的CPU使用率"""
+        idle, total = NativeCollectors._read_cpu_times()
+        previous = task.collector_state
+        task.collector_state = (idle, total)
+        if previous is None or total <= previous[1]:
+            return 'O', "首次采集，下次执行时输出CPU使用率", None
+        used = 100.0 * (1 - (idle - previous[0]) / (total - previous[1]))
+        return NativeCollectors._level(used, CPU_WARN_PERCENT, CPU_ERROR_PERCENT), f"{used:.1f}%", None
     
-    logger.info(f"任务 {task_name} 已设置，执行间隔: {interval}秒")
-    return True
+    @staticmethod
+    def collect_mem(task):
+        """根据/proc/meminfo计算内存使用率"""
+        meminfo = {}
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, _, rest = line.partition(':')
+                meminfo[key] = int(rest.split()[0])
+        total = meminfo['MemTotal']
+        # 旧内核没有MemAvailable，使用free+buffers+cached近似
+        available = meminfo.get('MemAvailable',
+                                meminfo.get('MemFree', 0) + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0))
+        used = 100.0 * (total - available) / total
+        return NativeCollectors._level(used, MEM_WARN_PERCENT, MEM_ERROR_PERCENT), f"{used:.1f}%", None
+    
+    @staticmethod
+    def collect_disk(task):
+        """检查各挂载点的磁盘使用率，每个挂载点作为一项结果，级别和值取最严重的挂载点"""
+        metrics = []
+        seen = set()
+        with open('/proc/mounts', 'r') as f:
+            mounts = [line.split()[:3] for line in f]
+        for device, mount_point, fs_type in mounts:
+            if fs_type not in DISK_FS_TYPES or device in seen:
+                continue
+            seen.add(device)
+            try:
+                st = os.statvfs(mount_point)
+            except OSError:
+                continue
+            used_blocks = st.f_blocks - st.f_bfree
+            if used_blocks + st.f_bavail <= 0:
+                continue
+            # 与df一致：已用 / (已用 + 普通用户可用)
+            percent = 100.0 * used_blocks / (used_blocks + st.f_bavail)
+            warn = DISK_WARN_PERCENT.get(mount_point, DISK_DEFAULT_WARN_PERCENT)
+            level = NativeCollectors._level(percent, warn, DISK_ERROR_PERCENT)
+            metrics.append([level, mount_point, f"{percent:.1f}%"])
+        if not metrics:
+            return 'O', "未找到可检查的挂载点", None
+        return summarize_metrics(metrics)
+    
+    @staticmethod
+    def collect(task):
+        """执行内置采集器，返回 (级别, 值, 多项结果)"""
+        if not sys.platform.startswith('linux'):
+            return 'O', f"内置采集器 {task.collector} 仅支持Linux", None
+        collector = getattr(NativeCollectors, f"collect_{task.collector}", None)
+        if collector is None:
+            return 'O', f"未知的内置采集器: {task.collector}", None
+        try:
+            return collector(task)
+        except (OSError, ValueError, KeyError, IndexError, ZeroDivisionError) as e:
+            return 'E', f"采集失败: {e}", None
 
-def save_tasks():
-    """保存任务信息到本地文件"""
-    try:
-        tasks_data = {}
-        for task_name, task in all_tasks.items():
-            tasks_data[task_name] = {
-                'script_content': task.script_content,
-                'interval': task.interval
-            }
-        
-        with open(TASKS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(tasks_data, f, ensure_ascii=False, indent=2)
-        logger.info(f"任务信息已保存到 {TASKS_FILE}")
-    except Exception as e:
-        logger.error(f"保存任务信息失败: {e}")
+async def run_task_once(task):
+    """执行一次任务（内置采集器或脚本），返回 (级别, 值, 多项结果, 资源消耗)
+    
+    内置采集器在进程内运行，不占用执行槽位，资源消耗为None
+    """
+    if task.collector:
+        return NativeCollectors.collect(task) + (None,)
+    # 按任务优先级等待执行槽位，然后异步执行脚本，不占用线程
+    async with execution_queue.slot(task.task_name, task.priority):
+        output, usage = await ScriptExecutor.execute_script(task.script_path, limits=task.limits)
+    return ScriptExecutor.parse_script_output(output) + (usage,)
 
-def load_tasks():
-    """从本地文件加载任务信息"""
-    if not os.path.exists(TASKS_FILE):
-        logger.info("任务文件不存在，无需加载")
-        return
+class TaskStore:
+    """任务持久化存储
+    
+    每个任务一个JSON文件（TASK_STORE_DIR/任务名.json），只保存任务定义和脚本的引用，
+    脚本内容保存在scripts目录中。文件通过临时文件+os.replace原子替换，
+    变更先记入待写集合，TASK_STORE_FLUSH_DELAY后合并写入，同步时大量任务变更只写一次。
+    写入统一提交到单线程的file_writer，先取出的变更先写，较旧的定义不会覆盖较新的定义
+    """
+    
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self._dirty = set()  # 待写入的任务名，写入时任务已不存在则删除其文件
+        self._flush_handle = None
+        os.makedirs(store_dir, exist_ok=True)
+    
+    def _entry_path(self, task_name):
+        return os.path.join(self.store_dir, f"{task_name}.json")
+    
+    def mark(self, task_name):
+        """记录任务的新增、更新或删除，稍后合并写入"""
+        self._dirty.add(task_name)
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        self._flush_handle = loop.call_later(TASK_STORE_FLUSH_DELAY, self._flush_async)
+    
+    def _snapshot(self):
+        """在事件循环线程中取出待写入的任务定义，None表示删除"""
+        dirty, self._dirty = self._dirty, set()
+        return {task_name: all_tasks[task_name].to_entry() if task_name in all_tasks else None
+                for task_name in dirty}
     
+    def write(self, entries):
+        """写入任务定义 {任务名: 定义或None}，None表示删除"""
+        for task_name, entry in entries.items():
+            path = self._entry_path(task_name)
+            try:
+                if entry is None:
+                    if os.path.exists(path):
+                        os.remove(path)
+                else:
+                    write_file_atomic(path, json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+            except Exception as e:
+                logger.error(f"保存任务 {task_name} 失败: {e}")
+        logger.debug(f"已保存 {len(entries)} 个任务的变更")
+    
+    def _flush_async(self):
+        self._flush_handle = None
+        entries = self._snapshot()
+        if entries:
+            file_writer.submit(self.write, entries)
+    
+    def flush(self):
+        """立即写入所有待写入的变更，排在已提交的写入之后，返回时已写完"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        entries = self._snapshot()
+        if not entries:
+            return
+        try:
+            file_writer.submit(self.write, entries).result()
+        except RuntimeError:
+            # 解释器退出时执行器已关闭，此前提交的写入已经完成，直接写入
+            self.write(entries)
+    
+    def load(self):
+        """读取所有任务定义，损坏或脚本缺失的任务跳过"""
+        entries = []
+        for filename in os.listdir(self.store_dir):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.store_dir, filename), 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+                if entry.get('script') and not os.path.exists(os.path.join(SCRIPT_DIR, entry['script'])):
+                    logger.warning(f"任务 {entry['task_name']} 的脚本文件不存在，跳过")
+                    continue
+                entries.append(entry)
+            except Exception as e:
+                logger.error(f"读取任务文件 {filename} 失败: {e}")
+        return entries
+
+def register_task(task):
+    """将任务加入任务表和调度器，替换同名任务"""
+    old_task = all_tasks.get(task.task_name)
+    if old_task is not None:
+        old_task.should_stop = True
+    all_tasks[task.task_name] = task
+    NativeCollectors.prime(task)
+    scheduler.schedule(task)
+    task_store.mark(task.task_name)
+
+def migrate_legacy_tasks():
+    """将旧版本的 .tasks.json（内联脚本内容）迁移到任务存储目录"""
     try:
         with open(TASKS_FILE, 'r', encoding='utf-8') as f:
             tasks_data = json.load(f)
-        
+        entries = {}
         for task_name, task_info in tasks_data.items():
-            setup_task(task_name, task_info['script_content'], task_info['interval'])
-        logger.info(f"已从 {TASKS_FILE} 加载 {len(tasks_data)} 个任务")
+            collector = task_info.get('collector')
+            script_sha = None
+            if not collector:
+                script_content = task_info.get('script_content') or ''
+                success, result = ScriptExecutor.save_script(task_name, script_content)
+                if not success:
+                    continue
+                script_sha = script_digest(script_content)
+            task = Task(task_name, script_sha, task_info['interval'], task_info.get('phase', 0), collector,
+                        task_info.get('limits'), task_info.get('priority'))
+            entries[task_name] = task.to_entry()
+        task_store.write(entries)
+        os.remove(TASKS_FILE)
+        logger.info(f"已将 {len(tasks_data)} 个任务从 {TASKS_FILE} 迁移到 {TASK_STORE_DIR}")
     except Exception as e:
-        logger.error(f"加载任务信息失败: {e}")
+        logger.error(f"迁移旧任务文件失败: {e}")
+
+def load_tasks():
+    """从本地任务存储加载任务，加载时不重写任何文件，启动时加载的任务立即开始调度，
+    连接服务端之前的结果写入离线缓存
+    """
+    if os.path.exists(TASKS_FILE):
+        migrate_legacy_tasks()
+    
+    entries = task_store.load()
+    for entry in entries:
+        task = Task(entry['task_name'], entry.get('sha256'), entry['interval'], entry.get('phase', 0),
+                    entry.get('collector'), entry.get('limits'), entry.get('priority'))
+        all_tasks[task.task_name] = task
+        NativeCollectors.prime(task)
+        scheduler.schedule(task)
+    logger.info(f"已从 {TASK_STORE_DIR} 加载 {len(entries)} 个任务")
 
 def cancel_task(task_name):
     """取消任务"""
     if task_name in all_tasks:
         task = all_tasks[task_name]
         task.should_stop = True  # 设置停止标志
-        if task.timer:
-            task.timer.cancel()
+        scheduler.cancel(task_name)
         # 删除脚本文件
         try:
             if os.path.exists(task.script_path):
@@ -224,73 +956,445 @@ def cancel_task(task_name):
         except Exception as e:
             logger.error(f"删除脚本文件失败: {e}")
         del all_tasks[task_name]
+        execution_queue.forget(task_name)
         # 更新持久化存储
-        save_tasks()
+        task_store.mark(task_name)
         logger.info(f"任务 {task_name} 已取消")
 
-async def start_task_timer(task, writer):
-    """异步启动任务定时器"""
-    async def run_task():
-        while not task.should_stop and task.task_name in all_tasks:
-            try:
-                # 在工作线程中执行脚本，避免阻塞事件循环
-                loop = asyncio.get_event_loop()
-                output = await loop.run_in_executor(thread_pool, ScriptExecutor.execute_script, task.script_path)
-                
-                # 解析输出
-                level, value = ScriptExecutor.parse_script_output(output)
+def throttle_remaining(task_name=None):
+    """返回当前仍需等待的限流时间（秒），指定任务名时同时考虑任务级限流"""
+    now = time.monotonic()
+    remaining = throttle_state['until'] - now
+    task = all_tasks.get(task_name) if task_name else None
+    if task is not None:
+        remaining = max(remaining, task.throttled_until - now)
+    return max(0, remaining)
+
+def seconds_until_next_run(task, now=None):
+    """计算距离任务下一个执行时刻的秒数
+    
+    执行时刻按墙上时钟对齐到 k * interval + phase，各节点相位不同，从而错开上报
+    """
+    if now is None:
+        now = time.time()
+    if not task.interval or task.interval <= 0:
+        return 0
+    return (task.phase - now) % task.interval
+
+class TaskScheduler:
+    """任务调度器
+    
+    所有定时任务共用一个最小堆，按单调时钟的截止时间排序，以固定频率执行：
+    下一次执行时间 = 本次计划时间 + interval，不受脚本执行耗时影响。
+    - 重叠策略：到期时上一次执行仍未结束，则跳过本次执行
+    - 错过策略：事件循环阻塞等原因错过多个执行时刻时，只补执行一次，然后对齐到之后的执行时刻
+    取消和重新调度通过代数标记实现懒删除，均为O(log n)
+    """
+    
+    def __init__(self):
+        self._heap = []  # [(截止时间, 序号, 任务名, 代数)]
+        self._generations = {}  # {任务名: 当前代数}，不在其中或代数不一致的堆条目视为已取消
+        self._running = {}  # {任务名: 正在执行的asyncio.Task}
+        self._counter = itertools.count()
+        self._wakeup = None
+        self.writer = None  # 当前与服务端的连接，用于发送结果
+    
+    def schedule(self, task):
+        """按任务的间隔和相位调度任务，已调度的任务会被重新调度"""
+        generation = next(self._counter)
+        self._generations[task.task_name] = generation
+        deadline = time.monotonic() + seconds_until_next_run(task)
+        self._push(deadline, task.task_name, generation)
+    
+    def reschedule(self, task_name):
+        """任务的间隔或相位变化后重新调度"""
+        task = all_tasks.get(task_name)
+        if task is not None:
+            self.schedule(task)
+    
+    def cancel(self, task_name):
+        """取消任务调度，正在执行的本次运行不受影响"""
+        self._generations.pop(task_name, None)
+        # 懒删除的条目过多时压缩堆
+        if len(self._heap) > 2 * len(self._generations) + 64:
+            self._heap = [entry for entry in self._heap if self._generations.get(entry[2]) == entry[3]]
+            heapq.heapify(self._heap)
+    
+    def is_running(self, task_name):
+        """任务是否有正在执行的运行"""
+        running = self._running.get(task_name)
+        return running is not None and not running.done()
+    
+    def _push(self, deadline, task_name, generation):
+        heapq.heappush(self._heap, (deadline, next(self._counter), task_name, generation))
+        if self._wakeup is not None:
+            self._wakeup.set()
+    
+    async def run(self):
+        """调度主循环"""
+        self._wakeup = asyncio.Event()
+        while True:
+            # 丢弃已取消的堆顶条目
+            while self._heap and self._generations.get(self._heap[0][2]) != self._heap[0][3]:
+                heapq.heappop(self._heap)
+            
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            
+            deadline = self._heap[0][0]
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                # 等待到期，或有更早的任务加入
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            _, _, task_name, generation = heapq.heappop(self._heap)
+            task = all_tasks.get(task_name)
+            if task is None or task.should_stop:
+                self._generations.pop(task_name, None)
+                continue
+            
+            # 固定频率计算下一次执行时间，错过多个执行时刻时直接对齐到未来
+            now = time.monotonic()
+            next_deadline = deadline + task.interval
+            if next_deadline <= now:
+                missed = int((now - next_deadline) // task.interval) + 1
+                next_deadline += missed * task.interval
+                logger.warning(f"任务 {task_name} 错过 {missed} 次执行时刻，已跳过")
+            self._push(next_deadline, task_name, generation)
+            
+            self._dispatch(task)
+    
+    def run_now(self, task):
+        """立即执行一次任务，不影响周期调度，返回是否已启动"""
+        return self._dispatch(task)
+    
+    def _dispatch(self, task):
+        """启动一次任务执行，上一次执行（包括等待执行槽位）尚未结束时跳过"""
+        if self.is_running(task.task_name):
+            logger.warning(f"任务 {task.task_name} 上一次执行尚未结束，跳过本次执行")
+            return False
+        if throttle_remaining(task.task_name) > 0:
+            logger.debug(f"任务 {task.task_name} 处于限流中，跳过本次执行")
+            return False
+        self._running[task.task_name] = asyncio.create_task(self._run_once(task))
+        return True
+    
+    async def _run_once(self, task):
+        try:
+            level, value, metrics, usage = await run_task_once(task)
+            
+            # 异步发送结果，带上执行的脚本版本
+            await send_task_result(task.task_name, level, value, self.writer, metrics, usage, task.script_sha)
+        except Exception as e:
+            logger.error(f"执行任务 {task.task_name} 时出错: {e}")
+        finally:
+            if self._running.get(task.task_name) is asyncio.current_task():
+                del self._running[task.task_name]
+
+# 全局任务调度器
+scheduler = TaskScheduler()
+
+# 任务持久化存储，退出前写入尚未保存的变更
+task_store = TaskStore(TASK_STORE_DIR)
+atexit.register(task_store.flush)
+
+class ResultSpool:
+    """磁盘上的离线结果缓存
+    
+    结果按行追加到分段文件中，总大小超过上限时删除最旧的分段（环形缓存）。
+    重连后按分段从旧到新分批补发，补发完的分段即删除。
+    分段的记账在事件循环线程中进行，文件的打开、写入、关闭、读取和删除都提交到file_writer，
+    按提交顺序执行，事件循环不做同步磁盘IO，补发读取时也能看到之前提交的全部写入
+    """
+    
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+        os.makedirs(spool_dir, exist_ok=True)
+        self._sizes = {}  # {分段序号: 字节数}
+        for filename in os.listdir(spool_dir):
+            match = re.match(r'^spool-(\d+)\.jsonl$', filename)
+            if match:
+                self._sizes[int(match.group(1))] = os.path.getsize(os.path.join(spool_dir, filename))
+        self._next_seq = max(self._sizes, default=0) + 1
+        self._file_seq = None  # 当前追加的分段序号
+        self._file = None  # 当前追加的分段文件，只在file_writer线程中访问
+        self._replay_position = (None, 0)  # (分段序号, 已补发的行数)，连接中断后从此处继续
+        self.dropped_segments = 0
+    
+    def _segment_path(self, seq):
+        return os.path.join(self.spool_dir, f"spool-{seq:012d}.jsonl")
+    
+    def backlog_bytes(self):
+        """缓存中待补发的字节数"""
+        return sum(self._sizes.values())
+    
+    def append(self, message):
+        """追加一条结果，写入在file_writer中完成"""
+        if self._file_seq is None or self._sizes.get(self._file_seq, 0) >= SPOOL_SEGMENT_BYTES:
+            self._open_segment()
+        data = encode_frame(message)
+        file_writer.submit(self._write, self._file_seq, data)
+        self._sizes[self._file_seq] += len(data)
+        self._enforce_limit()
+    
+    def _write(self, seq, data):
+        """在file_writer线程中追加写入"""
+        try:
+            if self._file is None:
+                self._file = open(self._segment_path(seq), 'ab')
+            self._file.write(data)
+            self._file.flush()
+        except OSError as e:
+            logger.error(f"写入离线缓存分段 {seq} 失败: {e}")
+    
+    def _close(self):
+        """在file_writer线程中关闭当前分段文件"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    def _open_segment(self):
+        self.seal()
+        self._file_seq = self._next_seq
+        self._next_seq += 1
+        self._sizes[self._file_seq] = 0
+    
+    def seal(self):
+        """关闭当前分段，之后的结果写入新分段"""
+        if self._file_seq is not None:
+            file_writer.submit(self._close)
+            self._file_seq = None
+    
+    def _enforce_limit(self):
+        """超过总大小上限时删除最旧的分段"""
+        while self.backlog_bytes() > SPOOL_MAX_BYTES and len(self._sizes) > 1:
+            oldest = min(self._sizes)
+            if oldest == self._file_seq:
+                break
+            self._remove_segment(oldest)
+            self.dropped_segments += 1
+            logger.warning(f"离线缓存超过 {SPOOL_MAX_BYTES} 字节，丢弃最旧的分段 {oldest}")
+    
+    def _remove_segment(self, seq):
+        self._sizes.pop(seq, None)
+        file_writer.submit(self._unlink, seq)
+    
+    def _unlink(self, seq):
+        try:
+            os.remove(self._segment_path(seq))
+        except FileNotFoundError:
+            pass
+    
+    def _read_segment(self, seq):
+        try:
+            with open(self._segment_path(seq), 'rb') as f:
+                return [line for line in f.read().split(b'\n') if line.strip()]
+        except FileNotFoundError:
+            return []
+    
+    async def replay(self, writer):
+        """分批补发缓存的结果，发送失败时抛出异常，下次从中断处继续
+        
+        补发期间新写入的分段也会继续补发，直到缓存中没有分段为止
+        """
+        loop = asyncio.get_running_loop()
+        while self._sizes:
+            seq = min(self._sizes)
+            if seq == self._file_seq:
+                self.seal()
+            lines = await loop.run_in_executor(file_writer, self._read_segment, seq)
+            position_seq, sent = self._replay_position
+            start = sent if position_seq == seq else 0
+            
+            for offset in range(start, len(lines), SPOOL_REPLAY_BATCH):
+                batch = [decode_frame(line) for line in lines[offset:offset + SPOOL_REPLAY_BATCH]]
                 
-                # 异步发送结果
-                await send_task_result(task.task_name, level, value, writer)
+                # 被服务端限流时等待
+                remaining = throttle_remaining()
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
                 
-                # 等待下一次执行
-                await asyncio.sleep(task.interval)
-            except Exception as e:
-                logger.error(f"执行任务 {task.task_name} 时出错: {e}")
-                # 出错后仍然等待，避免频繁重试
-                if not task.should_stop and task.task_name in all_tasks:
-                    await asyncio.sleep(task.interval)
-    
-    # 立即创建并启动任务协程
-    asyncio.create_task(run_task())
+                writer.write(encode_frame({'type': 'task_result_batch', 'results': batch}))
+                await writer.drain()
+                link_state['last_sent'] = time.monotonic()
+                self._replay_position = (seq, offset + len(batch))
+                await asyncio.sleep(SPOOL_REPLAY_INTERVAL)
+            
+            self._remove_segment(seq)
+            self._replay_position = (None, 0)
+            logger.info(f"离线缓存分段 {seq} 已补发 {len(lines)} 条结果")
+
+# 离线结果缓存
+result_spool = ResultSpool(SPOOL_DIR)
 
-async def send_task_result(task_name, level, value, writer):
-    """异步发送任务执行结果到服务端，包含节点ID和主机名"""
+async def replay_spool(writer):
+    """重连后补发离线缓存"""
+    if not result_spool.backlog_bytes():
+        return
+    logger.info(f"开始补发离线缓存，共 {result_spool.backlog_bytes()} 字节")
     try:
-        message = {
-            'type': 'task_result',
-            'task_name': task_name,
-            'timestamp': datetime.now().isoformat(),
-            'level': level,
-            'value': value,
-            'node_id': node_info['id'],  # 添加节点ID
-            'hostname': node_info['hostname']  # 添加主机名
-        }
+        await result_spool.replay(writer)
+        logger.info("离线缓存补发完成")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"补发离线缓存失败，将在下次连接时继续: {e}")
+
+async def send_task_result(task_name, level, value, writer, metrics=None, usage=None, script_sha=None):
+    """异步发送任务执行结果到服务端，包含节点ID和主机名
+    
+    多行输出的每一项放在同一条消息的metrics中，由服务端按子键分别保存；
+    脚本执行的资源消耗放在usage中，由服务端按任务汇总；
+    script_sha为执行的脚本的sha256，服务端在分批下发时据此区分新旧版本的结果。
+    未连接或发送失败时写入离线缓存，重连后补发
+    """
+    message = {
+        'type': 'task_result',
+        'task_name': task_name,
+        'timestamp': datetime.now().isoformat(),
+        'level': level,
+        'value': value,
+        'node_id': node_info['id'],  # 添加节点ID
+        'hostname': node_info['hostname']  # 添加主机名
+    }
+    if metrics:
+        message['metrics'] = metrics
+    if usage:
+        message['usage'] = usage
+    if script_sha:
+        message['sha256'] = script_sha
+    
+    if writer is None or writer.is_closing():
+        spool_task_result(message)
+        return
+    
+    try:
+        # 节点整体被限流时，等待限流结束后再发送
+        remaining = throttle_remaining()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        
+        # 代理运行状况到期时随结果一起上报，结果持续发送时不再需要单独的心跳
+        if agent_telemetry.due():
+            message['telemetry'] = agent_telemetry.collect()
         
         # 异步发送数据
-        writer.write((json.dumps(message) + '\n').encode('utf-8'))
+        writer.write(encode_frame(message))
         await writer.drain()
-        logger.info(f"已发送任务 {task_name} 结果: {level} {value}, 节点: {node_info['id']}({node_info['hostname']})")
+        link_state['last_sent'] = time.monotonic()
+        logger.info("已发送任务 %s 结果: %s %s, 节点: %s(%s)", task_name, level, value,
+                    node_info['id'], node_info['hostname'],
+                    extra={'category': 'result', 'task': task_name, 'result_level': level})
     except Exception as e:
         logger.error(f"发送任务结果失败: {e}")
+        message.pop('telemetry', None)
+        spool_task_result(message)
+
+def spool_task_result(message):
+    """将结果写入离线缓存"""
+    try:
+        result_spool.append(message)
+        logger.debug(f"未连接到服务端，任务 {message['task_name']} 结果已写入离线缓存")
+    except Exception as e:
+        logger.error(f"写入离线缓存失败: {e}")
+
+class AgentTelemetry:
+    """代理自身的运行状况，随心跳或任务结果上报，用于在漏报结果之前发现过载或卡住的节点"""
+    
+    def __init__(self):
+        self.max_lag = 0.0  # 上次上报以来事件循环的最大延迟（秒）
+        self._last_cpu = None  # (monotonic时间, 进程CPU时间)
+        self.reported_at = 0.0  # 上次上报的时刻（monotonic）
+    
+    async def monitor_loop_lag(self):
+        """定期睡眠并测量实际唤醒时间，超出部分即为事件循环延迟"""
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = time.monotonic() - started - LOOP_LAG_INTERVAL
+            self.max_lag = max(self.max_lag, lag)
+    
+    @staticmethod
+    def _rss_kb():
+        """当前常驻内存（KB），没有/proc时使用历史最大值，都不可用时为0"""
+        try:
+            with open('/proc/self/statm', 'r') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+        except (OSError, ValueError, IndexError):
+            if resource is None:
+                return 0
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    def _cpu_percent(self):
+        """上次上报以来代理进程（不含脚本子进程）的CPU使用率"""
+        times = os.times()
+        sample = (time.monotonic(), times.user + times.system)
+        previous, self._last_cpu = self._last_cpu, sample
+        if previous is None or sample[0] <= previous[0]:
+            return 0.0
+        return round(100.0 * (sample[1] - previous[1]) / (sample[0] - previous[0]), 1)
+    
+    def due(self):
+        """距上次上报超过一个心跳间隔"""
+        return time.monotonic() - self.reported_at >= HEARTBEAT_INTERVAL
+    
+    def collect(self):
+        """生成紧凑的状态数据并重置区间统计"""
+        telemetry = {
+            'lag_ms': round(self.max_lag * 1000),  # 事件循环最大延迟
+            'queued': execution_queue.queued,  # 等待执行槽位的脚本数
+            'running': execution_queue.running,  # 正在运行的脚本数
+            'spool': result_spool.backlog_bytes(),  # 离线缓存积压（字节）
+            'rss_kb': self._rss_kb(),
+            'cpu': self._cpu_percent(),
+            'tasks': len(all_tasks)
+        }
+        self.max_lag = 0.0
+        self.reported_at = time.monotonic()
+        return telemetry
+
+LOOP_LAG_INTERVAL = 1  # 测量事件循环延迟的间隔（秒）
+HEARTBEAT_INTERVAL = 30  # 空闲多久后发送心跳（秒），须小于服务端的节点超时时间的一半
+
+# 代理运行状况统计
+agent_telemetry = AgentTelemetry()
 
 async def send_heartbeat(writer):
-    """异步定期发送心跳，包含主机名信息"""
+    """连接空闲超过心跳间隔时发送心跳，包含主机名信息和代理运行状况
+    
+    结果持续发送时不发送心跳；心跳不要求服务端响应
+    """
     while True:
+        idle = time.monotonic() - link_state['last_sent']
+        if idle < HEARTBEAT_INTERVAL:
+            await asyncio.sleep(HEARTBEAT_INTERVAL - idle)
+            continue
+        
+        # 被限流时跳过本次心跳
+        if throttle_remaining() > 0:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            continue
         try:
             message = {
                 'type': 'heartbeat', 
                 'timestamp': time.time(),
-                'hostname': node_info['hostname']  # 心跳中也携带主机名信息
+                'hostname': node_info['hostname'],  # 心跳中也携带主机名信息
+                'telemetry': agent_telemetry.collect(),
+                'ack': False  # 不需要heartbeat_response
             }
-            writer.write((json.dumps(message) + '\n').encode('utf-8'))
+            writer.write(encode_frame(message))
             await writer.drain()
-            logger.debug(f"已发送心跳，主机名: {node_info['hostname']}")
+            link_state['last_sent'] = time.monotonic()
+            logger.debug("已发送心跳，主机名: %s", node_info['hostname'], extra={'category': 'heartbeat'})
         except Exception as e:
             logger.error(f"发送心跳失败: {e}")
             break
-        
-        await asyncio.sleep(30)  # 每30秒发送一次心跳
 
 async def handle_server_message(message, writer):
     """处理来自服务端的消息（异步版本）"""
@@ -300,11 +1404,26 @@ async def handle_server_message(message, writer):
     
     if msg_type == 'handshake':
         NODE_ID = message.get('node_id')
-        logger.info(f"收到节点ID: {NODE_ID}")
+        # 更新节点信息字典，如果服务端没有返回主机名则使用本地获取的
+        node_info['id'] = NODE_ID
+        node_info['hostname'] = message.get('hostname', HOSTNAME)
+        logger.info(f"收到握手消息，节点ID: {NODE_ID}, 主机名: {node_info['hostname']}")
     
     elif msg_type == 'heartbeat_response':
         logger.debug("收到心跳响应")
     
+    elif msg_type == 'throttle':
+        # 服务端限流通知，按要求退避
+        retry_after = float(message.get('retry_after', 1))
+        task_name = message.get('task_name')
+        until = time.monotonic() + retry_after
+        if task_name and task_name in all_tasks:
+            all_tasks[task_name].throttled_until = until
+            logger.warning(f"任务 {task_name} 被服务端限流，{retry_after} 秒内暂停执行")
+        else:
+            throttle_state['until'] = until
+            logger.warning(f"节点被服务端限流，{retry_after} 秒内暂停发送")
+    
     elif msg_type == 'auth_response':
         # 处理认证响应消息
         if message.get('success'):
@@ -314,13 +1433,25 @@ async def handle_server_message(message, writer):
             logger.error(f"认证失败: {error_msg}")
     
     elif msg_type == 'task':
-        task_name = message.get('task_name')
-        script_content = message.get('script_content')
-        interval = message.get('interval')
-        
-        # 传递writer给setup_task
-        if await setup_task_async(task_name, script_content, interval, writer):
-            logger.info(f"成功接收任务: {task_name}")
+        if await apply_task_message(message, writer):
+            logger.info(f"成功接收任务: {message.get('task_name')}")
+    
+    elif msg_type == 'task_bundle':
+        # 服务端同步脚本目录时一次发送的多个任务变更
+        deletes = message.get('delete') or []
+        for task_name in deletes:
+            cancel_task(task_name)
+        tasks = message.get('tasks') or []
+        applied = 0
+        for task_message in tasks:
+            if await apply_task_message(task_message, writer):
+                applied += 1
+        logger.info(f"收到任务包，设置 {applied}/{len(tasks)} 个任务，删除 {len(deletes)} 个任务")
+    
+    elif msg_type == 'task_update':
+        # 只修改执行间隔、资源限制等参数，脚本不变
+        update_task(message.get('task_name'), message.get('interval'), message.get('phase', 0),
+                    message.get('limits'), message.get('priority'))
     
     elif msg_type == 'delete_task':
         task_name = message.get('task_name')
@@ -343,63 +1474,99 @@ async def handle_server_message(message, writer):
         if task_name in all_tasks:
             logger.info(f"收到立即执行任务的请求: {task_name}")
             
-            # 异步执行任务
-            asyncio.create_task(execute_task_immediately(task_name, writer))
+            # 与周期执行共用调度器，同一任务不会同时运行多次
+            scheduler.run_now(all_tasks[task_name])
         else:
             logger.warning(f"请求执行不存在的任务: {task_name}")
     
     else:
         logger.warning(f"未知消息类型: {msg_type}")
 
-async def execute_task_immediately(task_name, writer):
-    """异步立即执行任务"""
-    try:
-        task = all_tasks.get(task_name)
-        if task:
-            # 在工作线程中执行脚本
-            loop = asyncio.get_event_loop()
-            output = await loop.run_in_executor(thread_pool, ScriptExecutor.execute_script, task.script_path)
-            
-            # 解析输出
-            level, value = ScriptExecutor.parse_script_output(output)
-            
-            # 异步发送结果
-            await send_task_result(task_name, level, value, writer)
-    except Exception as e:
-        logger.error(f"立即执行任务 {task_name} 时出错: {e}")
+async def apply_task_message(message, writer):
+    """按服务端的task消息设置任务"""
+    return await setup_task_async(message.get('task_name'), message.get('script_content'), message.get('interval'),
+                                  writer, message.get('phase', 0), message.get('collector'), message.get('limits'),
+                                  message.get('priority'))
 
-async def setup_task_async(task_name, script_content, interval, writer):
-    """异步设置任务"""
-    # 取消已存在的任务
-    if task_name in all_tasks:
-        cancel_task(task_name)
+async def setup_task_async(task_name, script_content, interval, writer, phase=0, collector=None, limits=None,
+                           priority=None):
+    """异步设置任务
     
-    # 保存脚本（使用线程池避免阻塞事件循环）
-    loop = asyncio.get_event_loop()
-    success, result = await loop.run_in_executor(
-        thread_pool, 
-        lambda: ScriptExecutor.save_script(task_name, script_content)
-    )
+    重连后服务端会重新下发所有任务，定义没有变化的任务保持原有调度，不重写任何文件
+    """
+    script_sha = None if collector else script_digest(script_content or '')
+    task = Task(task_name, script_sha, interval, phase, collector, limits, priority)
+    existing = all_tasks.get(task_name)
+    if existing is not None and existing.definition() == task.definition():
+        logger.debug(f"任务 {task_name} 没有变化")
+        return True
     
-    if not success:
-        logger.error(f"设置任务 {task_name} 失败: {result}")
-        return False
+    # 保存脚本（使用线程池避免阻塞事件循环），内置采集器不需要脚本文件，脚本没有变化时不重写
+    if not collector and (existing is None or existing.script_sha != script_sha):
+        loop = asyncio.get_event_loop()
+        success, result = await loop.run_in_executor(
+            thread_pool, 
+            lambda: ScriptExecutor.save_script(task_name, script_content)
+        )
+        
+        if not success:
+            logger.error(f"设置任务 {task_name} 失败: {result}")
+            return False
     
-    # 创建任务对象
-    task = Task(task_name, script_content, interval)
-    all_tasks[task_name] = task
+    # 替换同名任务，加入调度器并记录变更
+    register_task(task)
     
-    # 异步启动定时任务
-    await start_task_timer(task, writer)
+    logger.info(f"任务 {task_name} 已设置，执行间隔: {interval}秒，相位: {phase}秒，优先级: {task.priority}")
+    return True
+
+def update_task(task_name, interval, phase=0, limits=None, priority=None):
+    """原地修改任务参数，执行间隔或相位变化时重新调度，不重写脚本"""
+    task = all_tasks.get(task_name)
+    if task is None:
+        # 本地没有该任务时忽略，下次同步时服务端会下发完整任务
+        logger.warning(f"请求更新不存在的任务: {task_name}")
+        return False
+    if not interval or interval <= 0:
+        logger.warning(f"任务 {task_name} 的执行间隔无效: {interval}")
+        return False
     
-    # 更新持久化存储（使用线程池）
-    await loop.run_in_executor(thread_pool, save_tasks)
+    reschedule = (task.interval, task.phase) != (interval, phase)
+    task.interval = interval
+    task.phase = phase
+    task.limits = limits or {}
+    task.priority = resolve_priority(priority, interval)
+    if reschedule:
+        scheduler.schedule(task)
+    task_store.mark(task_name)
     
-    logger.info(f"任务 {task_name} 已设置，执行间隔: {interval}秒")
+    logger.info(f"任务 {task_name} 已更新，执行间隔: {interval}秒，相位: {phase}秒，优先级: {task.priority}")
     return True
 
+class ReconnectBackoff:
+    """带上限的指数退避，使用完全随机抖动（full jitter），并遵循服务端建议的等待时间"""
+    
+    def __init__(self):
+        self.failures = 0
+        self.retry_after = None  # 服务端繁忙时建议的等待时间（秒）
+    
+    def next_delay(self):
+        """返回下一次重连前的等待时间（秒）"""
+        ceiling = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** self.failures)
+        self.failures += 1
+        delay = random.uniform(0, ceiling)
+        if self.retry_after:
+            # 在建议时间之后再随机推迟，避免被拒绝的节点在同一时刻再次到达
+            delay = max(delay, self.retry_after * random.uniform(1, 2))
+            self.retry_after = None
+        return delay
+    
+    def reset(self):
+        self.failures = 0
+        self.retry_after = None
+
 async def connect_to_server():
-    """异步连接到服务端并保持通信，包含密钥认证"""
+    """异步连接到服务端并保持通信，包含密钥认证，断开后按指数退避重连"""
+    backoff = ReconnectBackoff()
     while True:
         try:
             logger.info(f"尝试连接到服务端: {SERVER_HOST}:{SERVER_PORT}")
@@ -410,91 +1577,49 @@ async def connect_to_server():
             )
             logger.info("成功连接到服务端，开始密钥认证")
             
-            # 发送认证信息，包含主机名
+            # 发送认证信息，包含主机名和节点标签
             auth_message = {
                 'type': 'auth',
                 'secret_key': NODE_SECRET_KEY,
                 'hostname': HOSTNAME,  # 添加主机名信息
+                'labels': node_info['labels'],  # 节点标签，用于定向下发任务
+                'features': ['task_bundle'],  # 支持的消息类型，服务端据此选择下发方式
                 'timestamp': time.time()
             }
-            writer.write((json.dumps(auth_message) + '\n').encode('utf-8'))
+            writer.write(encode_frame(auth_message))
             await writer.drain()
-            logger.debug(f"已发送认证消息，包含主机名: {HOSTNAME}")
+            link_state['last_sent'] = time.monotonic()
+            logger.debug(f"已发送认证消息，包含主机名: {HOSTNAME}，标签: {node_info['labels']}")
             
-            # 等待认证响应并处理多个消息
+            # 等待认证响应，之后的握手、任务等消息保留在帧读取器中由消息循环处理
+            frame_reader = FrameReader(reader)
             auth_success = False
-            buffer = ''
             try:
-                # 读取初始数据
-                data = await reader.read(4096)
-                if not data:
+                frame = await frame_reader.read_frame()
+                if frame is None:
                     logger.error("服务端未响应认证请求，连接已关闭")
                     writer.close()
                     await writer.wait_closed()
-                    await asyncio.sleep(10)
+                    await asyncio.sleep(backoff.next_delay())
                     continue
                 
-                raw_response = data.decode('utf-8')
-                logger.debug(f"收到认证响应原始数据: {raw_response}")
-                buffer += raw_response
+                message = decode_frame(frame)
+                logger.debug(f"收到认证响应: {message}")
                 
-                # 处理缓冲区内的所有消息
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    line = line.strip()
-                    if not line:
-                        continue
-                    
-                    try:
-                        message = json.loads(line)
-                        msg_type = message.get('type')
-                        logger.debug(f"处理消息类型: {msg_type}")
-                        
-                        # 处理认证响应
-                        if msg_type == 'auth_response':
-                            if message.get('success'):
-                                logger.info("密钥认证成功")
-                                auth_success = True
-                            else:
-                                error_msg = message.get('message', '未知错误')
-                                logger.error(f"密钥认证失败: {error_msg}")
-                                writer.close()
-                                await writer.wait_closed()
-                                await asyncio.sleep(10)
-                                auth_success = False
-                                break
-                        
-                        # 提前处理握手消息
-                        elif msg_type == 'handshake':
-                            try:
-                                server_node_id = message.get('node_id')
-                                server_hostname = message.get('hostname', HOSTNAME)  # 如果服务端没有返回，则使用本地获取的
-                                
-                                # 使用全局变量更新NODE_ID
-                                global NODE_ID
-                                NODE_ID = server_node_id
-                                
-                                # 更新节点信息字典
-                                node_info['id'] = server_node_id
-                                node_info['hostname'] = server_hostname
-
-                                logger.info(f"收到握手消息，节点ID: {server_node_id}, 主机名: {server_hostname}")
-                                logger.debug(f"节点完整信息: {node_info}")
-                            except Exception as handshake_error:
-                                logger.error(f"处理握手消息时出错: {handshake_error}")
-                        
-                        # 提前处理任务同步消息
-                        elif msg_type == 'tasks_sync':
-                            try:
-                                server_tasks = message.get('tasks', [])
-                                server_task_names = set(server_tasks)
-                                logger.debug(f"收到任务同步信息，服务端任务数: {len(server_task_names)}")
-                            except Exception as sync_error:
-                                logger.error(f"处理任务同步消息时出错: {sync_error}")
-                    except json.JSONDecodeError as e:
-                        logger.error(f"解析单个消息失败: {e}，消息内容: {line}")
-                    except Exception as msg_error:
-                        logger.error(f"处理消息时发生未知错误: {msg_error}")
+                if message.get('type') == 'auth_response' and message.get('success'):
+                    logger.info("密钥认证成功")
+                    auth_success = True
+                else:
+                    error_msg = message.get('message', '未知错误')
+                    logger.error(f"密钥认证失败: {error_msg}")
+                    writer.close()
+                    await writer.wait_closed()
+                    # 服务端繁忙时会给出建议的等待时间
+                    if message.get('retry_after'):
+                        backoff.retry_after = float(message['retry_after'])
+                    delay = backoff.next_delay()
+                    logger.info(f"{delay:.1f}秒后重新连接")
+                    await asyncio.sleep(delay)
                 
                 if not auth_success:
                     logger.warning("认证未成功，重新尝试连接")
@@ -507,54 +1632,57 @@ async def connect_to_server():
                     await writer.wait_closed()
                 except:
                     pass
-                await asyncio.sleep(10)
+                await asyncio.sleep(backoff.next_delay())
                 continue
             
-            # 认证成功，启动心跳协程
+            # 认证成功，任务结果通过新连接发送，启动心跳协程和离线缓存补发
+            scheduler.writer = writer
+            connected_at = time.monotonic()
             heartbeat_task = asyncio.create_task(send_heartbeat(writer))
+            replay_task = asyncio.create_task(replay_spool(writer))
             
-            # 处理来自服务端的消息
-            buffer = ''
+            # 处理来自服务端的消息，每次读取可能包含多条完整消息
             try:
                 while True:
-                    # 异步读取数据
-                    data = await reader.read(4096)
-                    if not data:
+                    frames = await frame_reader.read_batch()
+                    if not frames:
                         logger.warning("服务端连接已关闭")
                         break
                     
-                    # 处理可能的多条消息
-                    buffer += data.decode('utf-8')
-                    while '\n' in buffer:
-                        line, buffer = buffer.split('\n', 1)
-                        if line.strip():
-                            try:
-                                message = json.loads(line)
-                                # 异步处理消息
-                                await handle_server_message(message, writer)
-                            except json.JSONDecodeError as e:
-                                logger.error(f"解析消息失败: {e}")
+                    for frame in frames:
+                        try:
+                            message = decode_frame(frame)
+                            # 异步处理消息
+                            await handle_server_message(message, writer)
+                        except MESSAGE_ERRORS as e:
+                            logger.error(f"解析消息失败: {e!r}")
             except Exception as e:
                 logger.error(f"处理消息时出错: {e}")
             finally:
-                # 取消心跳任务
+                # 取消心跳和补发任务
                 heartbeat_task.cancel()
+                replay_task.cancel()
+                scheduler.writer = None
                 # 关闭连接
                 writer.close()
                 await writer.wait_closed()
                 
-                # 连接断开时停止所有任务
-                for task_name, task in all_tasks.items():
-                    task.should_stop = True
-                logger.info("连接断开，已停止所有任务")
+                # 连接断开时任务继续执行，结果写入离线缓存
+                logger.info(f"连接断开，{len(all_tasks)} 个任务继续执行，结果写入离线缓存")
+                
+                # 连接稳定保持过一段时间才重置退避，服务端反复崩溃时退避继续增长
+                if time.monotonic() - connected_at >= RECONNECT_STABLE_TIME:
+                    backoff.reset()
                 
         except ConnectionRefusedError:
             logger.warning(f"无法连接到服务端，稍后重试")
         except Exception as e:
             logger.error(f"连接出错: {e}")
         
-        # 等待重试
-        await asyncio.sleep(10)
+        # 按退避时间等待重试
+        delay = backoff.next_delay()
+        logger.info(f"{delay:.1f}秒后重新连接")
+        await asyncio.sleep(delay)
 
 async def main_async():
     """异步主函数"""
@@ -575,6 +1703,10 @@ async def main_async():
         except Exception as e:
             logger.error(f"加载任务失败: {e}")
         
+        # 启动任务调度器和事件循环延迟监测
+        asyncio.create_task(scheduler.run())
+        asyncio.create_task(agent_telemetry.monitor_loop_lag())
+        
         # 异步连接到服务端
         logger.info(f"准备连接到服务端: {SERVER_HOST}:{SERVER_PORT}")
         await connect_to_server()
@@ -12,6 +12,13 @@ import argparse
 import getpass
 import logging
 import os
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+# 引入与服务端共用的模块
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.framing import ChunkedStream, send_chunked
 
 # 配置日志
 logging.basicConfig(
@@ -23,19 +30,44 @@ logger = logging.getLogger('superagent-client')
 # 配置
 SERVER_HOST = '192.168.123.101'
 SERVER_PORT = 4567
-TIMEOUT = 30
+TIMEOUT = 30  # 每个服务端的超时时间（秒），从建立连接到收到完整响应
+# 超过该大小（字节）的脚本和 -S 的脚本清单压缩后分块上传；旧版本服务端只读取请求的前4096字节，更大的脚本原本就无法上传
+COMPRESS_MIN = 4096
+
+class ResponseReader(ChunkedStream):
+    """从连接读取服务端响应，支持一行JSON和压缩后分块传输的JSON，超时时间覆盖整个请求"""
+    
+    def read_response(self):
+        """读取一个响应，服务端压缩时第一行只说明编码"""
+        line = self.readline()
+        if not line:
+            raise ConnectionError("服务端连接已关闭")
+        message = json.loads(line)
+        if 'success' not in message and message.get('encoding') == 'zlib':
+            message = json.loads(self.read_chunked())
+        return message
 
 class Client:
     """客户端主类"""
     
-    def __init__(self, server_host=SERVER_HOST, server_port=SERVER_PORT, username=None, password=None):
+    def __init__(self, server_host=SERVER_HOST, server_port=SERVER_PORT, username=None, password=None, timeout=TIMEOUT):
         self.server_host = server_host
         self.server_port = server_port
         self.username = username
         self.password = password
+        self.timeout = timeout
     
-    def connect(self, command):
-        """连接到服务端并发送命令"""
+    def connect(self, command, selector=None, hosts=None, limits=None, priority=None, rollout=None, since_version=None,
+                prune=False):
+        """连接到服务端并发送命令
+        
+        selector和hosts用于指定命令的目标节点，格式分别为 key=value[,key=value] 和 host1,host2；
+        limits为下发脚本时的资源限制，格式为 key=value[,key=value]；priority为任务执行优先级；
+        rollout为分批下发参数，格式为 key=value[,key=value]，空字符串表示使用默认参数；
+        since_version为 -t 的条件查询版本号，结果没有变化时响应中not_modified为True，
+        否则响应中带有新的version，delta为True时data只包含变化的结果，removed为已删除的结果；
+        prune用于 -S 同步脚本目录，为True时删除服务端上目录中没有、且目标与本次同步相同的脚本任务
+        """
         try:
             # 检查是否为上传脚本命令或下发任务命令
             is_upload = command.startswith('-u ')
@@ -44,6 +76,20 @@ class Client:
             script_name = None
             script_content = None
             
+            # 以@开头的是节点内置采集器（如 -a @cpu_1m），不需要读取脚本文件
+            if (is_upload or is_add_task) and command.split(' ', 1)[1].startswith('@'):
+                is_upload = is_add_task = False
+            
+            # 同步脚本目录，先只发送每个脚本的sha256，服务端回复需要上传的脚本
+            catalog = None
+            if command.startswith('-S '):
+                try:
+                    catalog = read_script_catalog(command.split(' ', 1)[1])
+                except Exception as e:
+                    logger.error(f"读取脚本目录失败: {e}")
+                    return {'success': False, 'message': f"读取脚本目录失败: {e}"}
+                command = '-S prune' if prune else '-S'
+            
             if is_upload or is_add_task:
                 # 提取脚本路径
                 script_path = command.split(' ', 1)[1]
@@ -59,48 +105,79 @@ class Client:
                     logger.error(f"读取脚本文件失败: {e}")
                     return {'success': False, 'message': f"读取脚本文件失败: {e}"}
             
-            # 创建socket连接
+            # 创建socket连接，超时时间覆盖整个请求，而不是每次读写
+            deadline = time.monotonic() + self.timeout
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(30)  # 设置超时
+            sock.settimeout(self.timeout)
             sock.connect((self.server_host, self.server_port))
             
-            # 准备认证和命令数据
+            # 准备认证和命令数据，声明支持压缩的响应
             auth_data = {
                 'username': self.username,
                 'password': self.password,
-                'command': command
+                'command': command,
+                'accept_encoding': 'zlib'
             }
             
-            # 如果是上传脚本或下发任务，添加脚本内容和名称
+            # 添加命令目标
+            if selector:
+                auth_data['selector'] = selector
+            if hosts:
+                auth_data['hosts'] = hosts
+            if limits:
+                auth_data['limits'] = limits
+            if priority:
+                auth_data['priority'] = priority
+            if rollout is not None:
+                auth_data['rollout'] = rollout
+            if since_version is not None:
+                auth_data['since_version'] = since_version
+            manifest_body = None
+            if catalog is not None:
+                manifest = {name: hashlib.sha256(content.encode('utf-8')).hexdigest()
+                            for name, content in catalog.items()}
+                manifest_body = json.dumps(manifest).encode('utf-8')
+                if len(manifest_body) >= COMPRESS_MIN:
+                    auth_data['manifest_encoding'] = 'zlib'
+                else:
+                    auth_data['manifest'] = manifest
+                    manifest_body = None
+            
+            # 如果是上传脚本或下发任务，添加脚本内容和名称，较大的脚本压缩后跟在请求头之后分块发送
+            script_body = None
             if is_upload or is_add_task:
                 auth_data['script_name'] = script_name
-                auth_data['script_content'] = script_content
+                if len(script_content.encode('utf-8')) >= COMPRESS_MIN:
+                    script_body = script_content.encode('utf-8')
+                    auth_data['script_encoding'] = 'zlib'
+                else:
+                    auth_data['script_content'] = script_content
             
             # 确保数据可以正确JSON序列化
             try:
                 json_data = json.dumps(auth_data)
                 # 发送数据
                 sock.sendall((json_data + '\n').encode('utf-8'))
+                if script_body is not None:
+                    send_chunked(sock, script_body)
+                if manifest_body is not None:
+                    send_chunked(sock, manifest_body)
                 logger.info(f"已成功序列化并发送数据，命令: {command}")
             except Exception as e:
                 logger.error(f"JSON序列化失败: {e}")
                 return {'success': False, 'message': f"构建请求数据失败: {e}"}
             
-            # 接收响应
-            data = b''
-            while True:
-                chunk = sock.recv(4096)
-                if not chunk:
-                    break
-                data += chunk
-                # 检查是否收到完整消息（以\n结尾）
-                if b'\n' in data:
-                    break
-            
-            if data:
-                response = json.loads(data.decode('utf-8').strip())
+            # 接收响应，同步脚本目录时服务端先回复需要上传的脚本，上传后再回复同步结果
+            try:
+                reader = ResponseReader(sock, deadline)
+                response = reader.read_response()
+                if catalog is not None and 'need' in response:
+                    logger.info(f"服务端需要上传 {len(response['need'])} 个脚本")
+                    bundle = {name: catalog[name] for name in response['need'] if name in catalog}
+                    send_chunked(sock, json.dumps(bundle).encode('utf-8'))
+                    response = reader.read_response()
                 return response
-            else:
+            except ConnectionError:
                 return {'success': False, 'message': '未收到服务端响应'}
         
         except ConnectionRefusedError:
@@ -119,6 +196,53 @@ class Client:
             if 'sock' in locals():
                 sock.close()
 
+def read_script_catalog(directory):
+    """读取目录下的所有.sh脚本（不含子目录），返回 {脚本名: 内容}"""
+    catalog = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.endswith('.sh') and os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                catalog[name] = f.read()
+    if not catalog:
+        raise ValueError(f"目录 {directory} 中没有.sh脚本")
+    return catalog
+
+def query_servers(servers, username, password, command, timeout=TIMEOUT, **options):
+    """并行向多个服务端发送同一命令，返回 [((地址, 端口), 响应)]，顺序与servers一致
+    
+    每个服务端使用独立的连接和超时，总耗时取决于最慢的服务端
+    """
+    def query(server):
+        host, port = server
+        return Client(host, port, username, password, timeout).connect(command, **options)
+    
+    if len(servers) == 1:
+        return [(servers[0], query(servers[0]))]
+    with ThreadPoolExecutor(max_workers=len(servers)) as executor:
+        return list(zip(servers, executor.map(query, servers)))
+
+def merge_data(command, data_lists):
+    """合并多个服务端返回的列表数据
+    
+    -t 的结果按时间从新到旧排列，-N 按级别（E、W、I）和主机名排列，-l 的任务名去重排序，
+    其他命令按服务端顺序拼接
+    """
+    lines = [line for data in data_lists for line in data]
+    if command.startswith('-t '):
+        # 每行以 "YYYY-MM-DD HH:MM:SS" 开头
+        return sorted(lines, key=lambda line: line[:19], reverse=True)
+    if command.startswith('-N'):
+        # 每行格式: 日期 时间 级别 主机名 ...
+        def node_key(line):
+            fields = line.split(' ', 4)
+            level = fields[2] if len(fields) > 2 else 'I'
+            return ('EWI'.find(level), fields[3] if len(fields) > 3 else '')
+        return sorted(lines, key=node_key)
+    if command == '-l':
+        return sorted(set(lines))
+    return lines
+
 def parse_arguments():
     """解析命令行参数"""
     # 创建主解析器
@@ -133,7 +257,13 @@ def parse_arguments():
         'server', 
         nargs='?',
         default=f"{SERVER_HOST}:{SERVER_PORT}",
-        help=f'服务端地址和端口 (默认: {SERVER_HOST}:{SERVER_PORT})'
+        help=f'服务端地址和端口，多个服务端用逗号分隔，命令会并行发送到所有服务端并合并结果 (默认: {SERVER_HOST}:{SERVER_PORT})'
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=TIMEOUT,
+        help=f'每个服务端的超时时间（秒），超时的服务端在结果末尾列出 (默认: {TIMEOUT})'
     )
     
     # 认证参数
@@ -141,6 +271,58 @@ def parse_arguments():
     # 使用store_true=False以确保特殊字符能被正确处理
     parser.add_argument('--passwd', required=True, help='密码，建议使用双引号包裹包含特殊字符的密码')
     
+    # 目标参数，用于 -a、-u、-n 定向到部分节点
+    parser.add_argument(
+        '--selector',
+        help='按节点标签选择目标，格式: key=value[,key=value]，如 role=db,dc=bj'
+    )
+    parser.add_argument(
+        '--hosts',
+        help='按主机名选择目标，格式: host1,host2'
+    )
+    
+    # 脚本资源限制，用于 -a、-u、-e
+    parser.add_argument(
+        '--limits',
+        help='脚本资源限制，格式: key=value[,key=value]，可选 cpu_seconds、memory_mb、open_files、output_kb、nice、io_class、io_level、timeout，如 cpu_seconds=30,memory_mb=256'
+    )
+    
+    # 分批下发，用于 -a、-u
+    parser.add_argument(
+        '--rollout',
+        nargs='?',
+        const='',
+        help='分批下发，先下发到金丝雀节点，结果正常后再按批次下发，异常时自动停止并回滚，格式: --rollout [key=value[,key=value]]，'
+             '可选 canary（第一批百分比，默认5）、batch（每批百分比，默认25）、concurrency（同时发送的节点数，默认20）、'
+             'wait（每批等待结果的秒数，默认120）、tolerance（允许W/E/O比例比下发前升高的百分点，默认10）'
+    )
+    
+    # 同步脚本目录时删除目录中没有的任务，用于 -S
+    parser.add_argument(
+        '--prune',
+        action='store_true',
+        help='同步脚本目录时，删除服务端上目录中没有、且目标与本次同步相同的脚本任务（内置采集器不受影响）'
+    )
+    
+    # 条件查询，用于 -t
+    parser.add_argument(
+        '--since-version',
+        help='只返回该版本之后变化的结果，没有变化时只输出版本号；首次查询可以指定0，输出末尾会显示新的版本号，只能用于单个服务端'
+    )
+    
+    # 新的执行间隔，用于 -e
+    parser.add_argument(
+        '--interval',
+        help='修改任务时的新执行间隔，格式: 数字加单位，如 30s、5m、1h'
+    )
+    
+    # 任务执行优先级，用于 -a、-u、-e
+    parser.add_argument(
+        '--priority',
+        choices=['critical', 'normal', 'bulk'],
+        help='任务执行优先级，节点繁忙时critical先执行；不指定时按执行间隔推断（1分钟及以内为critical，1小时及以上为bulk）'
+    )
+    
     # 功能参数（互斥组）
     group = parser.add_mutually_exclusive_group(required=True)
     
@@ -167,7 +349,7 @@ def parse_arguments():
     # 下发任务
     group.add_argument(
         '-a', '--add',
-        help='下发任务，指定脚本名称'
+        help='下发任务，指定脚本名称；使用节点内置采集器时格式为 @采集器_时间单位，如 @cpu_1m（可选 cpu、mem、disk）'
     )
     
     # 清除任务记录
@@ -182,18 +364,53 @@ def parse_arguments():
         help='显示脚本内容'
     )
     
+    # 修改任务参数
+    group.add_argument(
+        '-e', '--edit',
+        help='修改任务的执行间隔、资源限制或优先级，不重新下发脚本，格式: -e task_name [--interval 30s] [--limits ...] [--priority ...]'
+    )
+    
     # 上传脚本
     group.add_argument(
         '-u', '--upload',
         help='上传脚本文件'
     )
     
+    # 同步脚本目录
+    group.add_argument(
+        '-S', '--sync',
+        help='同步脚本目录，只上传有变化的脚本，所有变更一次性生效并合并下发到节点，格式: -S 目录 [--prune]，可配合 --selector、--hosts、--limits、--priority 使用'
+    )
+    
+    # 查看或停止分批下发
+    group.add_argument(
+        '-R', '--rollout-status',
+        nargs='+',
+        help='查看任务的分批下发进度，格式: -R task_name [stop]，指定stop时停止分批下发并回滚'
+    )
+    
     # 立即执行任务
     group.add_argument(
         '-n', '--now',
         help='立即执行任务，格式: -n task_name'
     )
     
+    # 列出节点运行状况
+    group.add_argument(
+        '-N', '--nodes',
+        nargs='?',
+        const='',
+        help='列出在线节点及代理运行状况（事件循环延迟、脚本排队、离线缓存等），格式: -N [级别]，可配合 --selector、--hosts 使用'
+    )
+    
+    # 显示资源消耗最高的任务
+    group.add_argument(
+        '-r', '--top',
+        nargs='?',
+        const='10',
+        help='显示所有节点上累计CPU消耗最高的任务，格式: -r [数量]，默认10个'
+    )
+    
     return parser.parse_args()
 
 def build_command(args):
@@ -216,6 +433,16 @@ def build_command(args):
         return f'-u {args.upload}'
     elif args.now:
         return f'-n {args.now}'
+    elif args.sync:
+        return f'-S {args.sync}'
+    elif args.rollout_status:
+        return ' '.join(['-R'] + args.rollout_status)
+    elif args.edit:
+        return f'-e {args.edit} {args.interval or ""}'.strip()
+    elif args.top:
+        return f'-r {args.top}'
+    elif args.nodes is not None:
+        return f'-N {args.nodes}'.strip()
     return ''
 
 def parse_server_address(server_str):
@@ -231,14 +458,46 @@ def parse_server_address(server_str):
         # 解析失败，使用默认值
         return SERVER_HOST, SERVER_PORT
 
+def print_merged_responses(command, responses):
+    """输出多个服务端的合并结果，最后列出失败的服务端
+    
+    全部成功返回0，全部失败返回1，部分失败返回2
+    """
+    data_lists = []
+    failures = []
+    for (host, port), response in responses:
+        server = f"{host}:{port}"
+        if not response.get('success'):
+            failures.append(f"{server} {response.get('message', '未知错误')}")
+        elif isinstance(response.get('data'), list):
+            data_lists.append(response['data'])
+        elif 'data' in response:
+            print(f"[{server}]")
+            print(response['data'])
+        elif 'message' in response:
+            print(f"[{server}] {response['message']}")
+    
+    for line in merge_data(command, data_lists):
+        print(line)
+    for failure in failures:
+        print(f"错误: {failure}")
+    
+    if not failures:
+        return 0
+    return 1 if len(failures) == len(responses) else 2
+
 def main():
     """主函数"""
     try:
         # 解析命令行参数
         args = parse_arguments()
         
-        # 解析服务端地址
-        server_host, server_port = parse_server_address(args.server)
+        # 解析服务端地址，多个服务端用逗号分隔
+        servers = [parse_server_address(server.strip()) for server in args.server.split(',') if server.strip()]
+        # 版本号由各服务端独立生成，一个版本号只对一个服务端有意义
+        if args.since_version is not None and len(servers) > 1:
+            print("错误: --since-version 只能用于单个服务端")
+            return 1
         
         # 构建命令
         command = build_command(args)
@@ -248,12 +507,19 @@ def main():
         # 处理在shell中被转义的特殊字符
         password = password.replace('\\|', '|').replace('\\#', '#').replace('\\!', '!').replace('\\~', '~').replace('\\<', '<')
         
-        # 创建客户端并连接
-        client = Client(server_host, server_port, args.user, password)
-        response = client.connect(command)
+        # 向所有服务端并行发送命令
+        responses = query_servers(servers, args.user, password, command, args.timeout, selector=args.selector,
+                                  hosts=args.hosts, limits=args.limits, priority=args.priority, rollout=args.rollout,
+                                  since_version=args.since_version, prune=args.prune)
+        if len(responses) > 1:
+            return print_merged_responses(command, responses)
+        response = responses[0][1]
         
         # 处理响应
         if response['success']:
+            if response.get('not_modified'):
+                print(f"未变化，版本: {response['version']}")
+                return 0
             if 'data' in response:
                 # 显示数据
                 if isinstance(response['data'], list):
@@ -261,6 +527,11 @@ def main():
                         print(line)
                 else:
                     print(response['data'])
+                # 条件查询时输出已删除的结果和新的版本号
+                for key in response.get('removed', []):
+                    print(f"已删除: {key}")
+                if 'version' in response:
+                    print(f"{'增量' if response.get('delta') else '全量'}，版本: {response['version']}")
             elif 'message' in response:
                 print(response['message'])
             return 0
@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+"""
+服务端和节点代理共用的模块
+"""
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+通信协议分帧
+节点通信（服务端和节点代理共用）: 每帧为一行UTF-8编码的JSON，以换行符结尾；
+客户端端口（服务端和客户端共用）: 一行JSON请求头或响应，较大的数据用zlib压缩后分块传输
+"""
+
+import json
+import socket
+import time
+import zlib
+from collections import deque
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # 单帧最大字节数，超过后视为协议错误
+READ_SIZE = 64 * 1024  # 每次从连接读取的字节数
+CHUNK_SIZE = 64 * 1024  # 分块传输时每块压缩前的大小，发送的每块数据也不超过该值
+MAX_CHUNK_SIZE = CHUNK_SIZE * 2  # 接收时单块数据的上限，超过后视为协议错误
+
+# 单帧消息无效时可能抛出的异常: JSON格式错误、非UTF-8字节、缺少字段或字段类型错误（如消息不是对象）
+# 接收循环按帧捕获，一帧错误只丢弃该帧，不影响同一批中的其他帧和连接
+MESSAGE_ERRORS = (json.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError, AttributeError)
+
+class FrameTooLarge(ValueError):
+    """单帧超过最大长度"""
+
+def encode_frame(message):
+    """将消息编码为一帧"""
+    return json.dumps(message).encode('utf-8') + b'\n'
+
+def decode_frame(frame):
+    """将一帧解码为消息，json.loads可以直接处理UTF-8字节，无需先解码为字符串"""
+    return json.loads(frame)
+
+class FrameDecoder:
+    """增量分帧器
+    
+    使用bytearray缓存不完整的帧，只对完整的帧做切分；
+    一次读取到多个完整小帧且没有残留数据时走快速路径，不复制缓冲区
+    """
+    __slots__ = ('_buffer', 'max_frame_size')
+    
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self._buffer = bytearray()
+        self.max_frame_size = max_frame_size
+    
+    def feed(self, data):
+        """输入新读取的数据，返回其中所有完整帧（bytes列表，已跳过空行）"""
+        if not self._buffer:
+            # 快速路径：没有残留数据，直接在本次读取的数据上切分
+            end = data.rfind(b'\n')
+            if end == -1:
+                self._buffer += data
+                self._check_pending()
+                return []
+            if end + 1 < len(data):
+                self._buffer += memoryview(data)[end + 1:]
+                self._check_pending()
+            frames = data[:end].split(b'\n')
+        else:
+            self._buffer += data
+            end = self._buffer.rfind(b'\n')
+            if end == -1:
+                self._check_pending()
+                return []
+            complete = bytes(memoryview(self._buffer)[:end])
+            del self._buffer[:end + 1]
+            self._check_pending()
+            frames = complete.split(b'\n')
+        
+        result = []
+        for frame in frames:
+            if len(frame) > self.max_frame_size:
+                raise FrameTooLarge(f"帧长度 {len(frame)} 超过上限 {self.max_frame_size}")
+            if frame.strip():
+                result.append(frame)
+        return result
+    
+    def _check_pending(self):
+        """检查未完成的帧是否已经超过上限"""
+        if len(self._buffer) > self.max_frame_size:
+            size = len(self._buffer)
+            self._buffer.clear()
+            raise FrameTooLarge(f"未完成的帧长度 {size} 超过上限 {self.max_frame_size}")
+
+class FrameReader:
+    """基于asyncio.StreamReader的帧读取器"""
+    
+    def __init__(self, reader, max_frame_size=MAX_FRAME_SIZE, read_size=READ_SIZE):
+        self.reader = reader
+        self.read_size = read_size
+        self.decoder = FrameDecoder(max_frame_size)
+        self._pending = deque()
+    
+    async def read_batch(self):
+        """读取下一批完整帧，连接关闭时返回空列表"""
+        if self._pending:
+            frames = list(self._pending)
+            self._pending.clear()
+            return frames
+        while True:
+            data = await self.reader.read(self.read_size)
+            if not data:
+                return []
+            frames = self.decoder.feed(data)
+            if frames:
+                return frames
+    
+    async def read_frame(self):
+        """读取下一帧，连接关闭时返回None"""
+        if not self._pending:
+            frames = await self.read_batch()
+            if not frames:
+                return None
+            self._pending.extend(frames)
+        return self._pending.popleft()
+
+def send_chunked(sock, payload, chunk_size=CHUNK_SIZE):
+    """将数据用zlib压缩后分块发送
+    
+    分块格式: 每块为 "十六进制长度\n" 加上该长度的数据，以 "0\n" 结束，所有块拼接后为zlib压缩数据
+    """
+    compressor = zlib.compressobj()
+    
+    def send(piece):
+        for offset in range(0, len(piece), chunk_size):
+            block = piece[offset:offset + chunk_size]
+            sock.sendall(f"{len(block):x}\n".encode('ascii') + block)
+    
+    for offset in range(0, len(payload), chunk_size):
+        send(compressor.compress(payload[offset:offset + chunk_size]))
+    send(compressor.flush())
+    sock.sendall(b'0\n')
+
+class ChunkedStream:
+    """阻塞套接字上的缓冲读取，读取一行请求头或响应，以及send_chunked发送的分块数据
+    
+    指定deadline（time.monotonic()时间）时整个读取过程共用该截止时间，否则使用套接字本身的超时
+    """
+    
+    def __init__(self, sock, deadline=None, read_size=READ_SIZE):
+        self.sock = sock
+        self.deadline = deadline
+        self.read_size = read_size
+        self._buffer = bytearray()
+    
+    def _fill(self):
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout()
+            self.sock.settimeout(remaining)
+        data = self.sock.recv(self.read_size)
+        if not data:
+            raise ConnectionError("连接已关闭")
+        self._buffer += data
+    
+    def readline(self, limit=None):
+        """读取一行（不含换行符），超过limit字节时抛出ValueError；连接在读到任何数据之前关闭时返回空字节串"""
+        start = 0
+        while True:
+            end = self._buffer.find(b'\n', start)
+            if end != -1:
+                if limit is not None and end > limit:
+                    raise ValueError(f"单行超过 {limit} 字节")
+                line = bytes(self._buffer[:end])
+                del self._buffer[:end + 1]
+                return line
+            if limit is not None and len(self._buffer) > limit:
+                raise ValueError(f"单行超过 {limit} 字节")
+            start = len(self._buffer)
+            try:
+                self._fill()
+            except ConnectionError:
+                if not self._buffer:
+                    return b''
+                raise
+    
+    def read_exact(self, size):
+        while len(self._buffer) < size:
+            self._fill()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+    
+    def read_chunked(self, limit=None):
+        """读取分块数据并边读边解压
+        
+        单块超过MAX_CHUNK_SIZE或解压后超过limit字节时抛出ValueError，不会为异常的长度分配内存
+        """
+        decompressor = zlib.decompressobj()
+        output = bytearray()
+        while True:
+            line = self.readline(16)
+            if not line:
+                raise ConnectionError("分块数据不完整")
+            size = int(line, 16)
+            if size == 0:
+                break
+            if size < 0 or size > MAX_CHUNK_SIZE:
+                raise ValueError(f"分块长度 {size} 超过上限 {MAX_CHUNK_SIZE}")
+            if limit is None:
+                output += decompressor.decompress(self.read_exact(size))
+                continue
+            output += decompressor.decompress(self.read_exact(size), limit + 1 - len(output))
+            if len(output) > limit or decompressor.unconsumed_tail:
+                raise ValueError(f"解压后的数据超过 {limit} 字节")
+        output += decompressor.flush()
+        return bytes(output)
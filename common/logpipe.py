@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+非阻塞日志管道
+服务端和节点代理共用：事件循环线程只负责把日志记录放入队列，
+格式化和文件写入由后台线程完成，输出JSON行并按大小轮转
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+from datetime import datetime
+
+LOG_QUEUE_SIZE = 10000  # 日志队列长度，队列满时丢弃新日志而不是阻塞事件循环
+LOG_MAX_BYTES = 50 * 1024 * 1024  # 单个日志文件最大字节数
+LOG_BACKUP_COUNT = 5  # 保留的轮转日志文件数
+
+# LogRecord的标准属性，其余属性视为通过extra传入的结构化字段
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """将日志记录格式化为一行JSON"""
+    
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """按类别采样高频日志
+    
+    通过 extra={'category': '...'} 指定类别，采样率为0到1之间的小数，
+    按计数确定性地保留每N条中的1条；WARNING及以上级别始终保留。
+    挂在logger上而不是处理器上，被丢弃的记录不会进入处理器；
+    调用方应使用 %s 参数而不是f-string，被丢弃的日志不需要格式化消息
+    """
+    
+    def __init__(self, sample_rates=None):
+        super().__init__()
+        self.sample_rates = dict(sample_rates or {})
+        self.counters = {}
+    
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        category = getattr(record, 'category', None)
+        rate = self.sample_rates.get(category)
+        if rate is None or rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        count = self.counters.get(category, 0)
+        self.counters[category] = count + 1
+        return count % round(1 / rate) == 0
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """只入队不格式化的队列处理器，队列满时丢弃日志并计数"""
+    
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record):
+        # 格式化推迟到后台线程，这里原样入队
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging(logger, log_file, level=logging.INFO, formatter=None, console=False,
+                  sample_rates=None, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+    """为logger配置非阻塞日志管道，返回后台的QueueListener
+    
+    formatter默认为JsonFormatter；console为True时同时输出到控制台
+    """
+    formatter = formatter or JsonFormatter()
+    
+    handlers = []
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+    )
+    file_handler.setFormatter(formatter)
+    handlers.append(file_handler)
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(formatter)
+        handlers.append(console_handler)
+    
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    
+    logger.handlers.clear()
+    for old_filter in [f for f in logger.filters if isinstance(f, SamplingFilter)]:
+        logger.removeFilter(old_filter)
+    logger.addFilter(SamplingFilter(sample_rates))
+    logger.addHandler(queue_handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
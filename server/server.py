@@ -12,35 +12,62 @@ import time
 import asyncio
 import logging
 import hashlib
+import itertools
 import re
 import threading
+import sys
 from datetime import datetime
 from collections import defaultdict
 from typing import Dict, List, Optional, Any
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='superagent_server.log'
-)
+# 引入服务端和节点代理共用的模块
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.framing import (FrameReader, FrameTooLarge, MESSAGE_ERRORS, MAX_FRAME_SIZE, encode_frame, decode_frame,
+                            ChunkedStream, send_chunked)
+from common.logpipe import setup_logging
+
+# 高频日志的采样率，按日志类别（extra中的category）配置
+LOG_SAMPLE_RATES = {
+    'result': 0.01,  # 任务结果日志每100条保留1条
+    'heartbeat': 0  # 心跳日志不记录
+}
+
+# 配置日志：事件循环只负责入队，格式化和写文件由后台线程完成，输出JSON行并按大小轮转
 logger = logging.getLogger('superagent-server')
+setup_logging(logger, 'superagent_server.log', sample_rates=LOG_SAMPLE_RATES)
 
-# 配置客户端操作日志
+# 配置客户端操作日志，写入client.log
 client_logger = logging.getLogger('client-operations')
-client_logger.setLevel(logging.INFO)
-# 创建文件处理器，写入client.log
-client_handler = logging.FileHandler('client.log')
-client_handler.setFormatter(logging.Formatter('%(asctime)s - %(username)s - %(command)s - %(success)s - %(client_ip)s:%(client_port)s'))
-client_logger.addHandler(client_handler)
+setup_logging(
+    client_logger, 'client.log',
+    formatter=logging.Formatter('%(asctime)s - %(username)s - %(command)s - %(success)s - %(client_ip)s:%(client_port)s')
+)
 
 # 全局配置
 SERVER_HOST = '0.0.0.0'
 SERVER_PORT = 4567
 NODE_PORT = 4568  # 节点连接端口
+# 客户端连接配置：请求头为一行JSON，较大的脚本和响应用zlib压缩后分块传输
+CLIENT_TIMEOUT = 30  # 客户端连接的读写超时（秒）
+CLIENT_MAX_HEADER = 256 * 1024  # 请求头（一行JSON）的大小上限（字节），在认证之前读取，较大的脚本和清单分块传输
+CLIENT_MAX_REQUEST = 16 * 1024 * 1024  # 认证后分块上传的数据解压后的大小上限（字节）
+CLIENT_COMPRESS_MIN = 1024  # 客户端支持压缩时，超过该大小（字节）的响应压缩后发送
 SCRIPT_DIR = '/opt/script/superagent/'
 DATA_DIR = './data'
+HISTORY_DIR = os.path.join(DATA_DIR, 'history')  # 任务历史记录目录（包括节点补发的离线结果）
+HISTORY_MAX_BYTES = 64 * 1024 * 1024  # 单个任务历史记录文件的大小上限，超过后轮转
 HEARTBEAT_TIMEOUT = 60  # 心跳超时时间（秒）
+# 节点运行状况告警阈值（-N 查询时按此判断级别）
+NODE_LAG_WARN_MS = 500  # 事件循环延迟
+NODE_LAG_ERROR_MS = 5000
+NODE_QUEUED_WARN = 10  # 等待执行槽位的脚本数
+NODE_SPOOL_WARN_BYTES = 1024 * 1024  # 离线缓存积压
+NODE_CPU_WARN = 50  # 代理进程CPU使用率（%）
+NODE_HEARTBEAT_WARN = 45  # 距上次心跳的时间（秒），超过 HEARTBEAT_TIMEOUT 为E
+# 节点上报的运行状况字段及类型，保存时按类型转换，缺失或无效的字段为0，未知字段忽略
+NODE_TELEMETRY_FIELDS = {'lag_ms': int, 'queued': int, 'running': int, 'tasks': int,
+                         'spool': int, 'rss_kb': int, 'cpu': float}
+NATIVE_COLLECTORS = ('cpu', 'mem', 'disk')  # 节点内置采集器，通过 -a @采集器_时间单位 下发
 
 # 用户认证信息
 # 格式: {用户名: 密码}
@@ -53,24 +80,243 @@ USERS = {
 # 用于节点验证的密钥
 NODE_SECRET_KEY = 'superagent_secret_key_2024'  # 生产环境中应该使用更强的密钥并通过环境变量或配置文件管理
 
+# 结果存储配置
+RESULT_RETENTION = 7 * 86400  # 结果保留时长（秒），超过后删除
+STALE_NODE_TTL = 3 * 86400  # 节点离线超过该时长（秒）后删除其所有结果
+RESULT_MEMORY_BUDGET = 256 * 1024 * 1024  # 结果占用内存的上限（字节，估算值）
+RESULT_SWEEP_INTERVAL = 300  # 结果清理间隔（秒）
+RESULT_ENTRY_OVERHEAD = 200  # 单条结果除value外的内存开销估算（字节，含记录对象、时间戳和字典槽位）
+TOP_TASKS_DEFAULT = 10  # -r 默认显示的任务数
+TASK_TOMBSTONE_LIMIT = 10000  # 每个任务保留的已删除结果记录数，用于 -t 增量查询
+
+# 可以为任务指定的脚本资源限制（client --limits），具体含义和默认值见节点的 DEFAULT_SCRIPT_LIMITS
+SCRIPT_LIMIT_KEYS = ('cpu_seconds', 'memory_mb', 'open_files', 'output_kb', 'nice', 'io_class', 'io_level', 'timeout')
+SCRIPT_IO_CLASSES = ('best-effort', 'idle')
+# 任务执行优先级（client --priority），未指定时由节点按执行间隔推断
+TASK_PRIORITIES = ('critical', 'normal', 'bulk')
+
+# 分批下发（client --rollout）的默认参数，可以在命令中按 key=value 覆盖
+ROLLOUT_DEFAULTS = {
+    'canary': 5,  # 第一批（金丝雀）占目标节点的百分比，至少1个节点
+    'batch': 25,  # 之后每批占目标节点的百分比
+    'concurrency': 20,  # 同时发送脚本的节点数，避免一次占满服务端出口带宽
+    'wait': 120,  # 每批下发后等待新版本结果的最长时间（秒），期间没有结果的节点按异常计算
+    'tolerance': 10,  # 新版本W/E/O比例比下发前高出的百分点超过该值时停止并回滚
+}
+ROLLOUT_BAD_LEVELS = ('W', 'E', 'O')
+
+# 结果级别: 正常、警告、错误、其他；节点上报的未知级别按O保存
+RESULT_LEVELS = ('I', 'W', 'E', 'O')
+
 # 存储已连接的节点信息
 connected_nodes = {}
 
+# 节点最近活跃时间 {主机名: 时间戳}，用于清理长期离线节点的结果
+node_last_seen = {}
+
+# 节点标签索引: {(标签名, 标签值): {node_id, ...}}，用于按标签选择器快速定位节点
+label_index = defaultdict(set)
+# 主机名索引: {主机名: node_id}，用于按主机列表定位节点
+hostname_index = {}
+
+# 节点服务所在的事件循环，客户端线程通过它向节点下发消息
+node_loop = None
+
+def parse_timestamp(value):
+    """将ISO格式时间或epoch秒转换为epoch秒，解析失败时返回当前时间"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+class ResultRecord:
+    """单条任务结果
+    
+    使用__slots__减少每条结果的内存占用，主机名、节点ID和级别使用驻留字符串，
+    时间戳保存为epoch秒，查询时再格式化。
+    key为脚本输出行中的子键（如挂载点），一次执行输出多行时每行保存为一个子序列
+    """
+    __slots__ = ('timestamp', 'level', 'value', 'hostname', 'node_id', 'key')
+    
+    def __init__(self, timestamp, level, value, hostname, node_id=None, key=None):
+        self.timestamp = timestamp  # epoch秒
+        self.level = sys.intern(level) if level in RESULT_LEVELS else 'O'
+        self.value = value
+        self.hostname = sys.intern(hostname)
+        self.node_id = sys.intern(node_id) if node_id else None
+        self.key = sys.intern(key) if key else None
+    
+    @property
+    def series_key(self):
+        """结果在任务中的存储键: 主机名，或 主机名:子键"""
+        return f"{self.hostname}:{self.key}" if self.key else self.hostname
+    
+    def to_dict(self):
+        """转换为持久化格式（时间戳为ISO格式，兼容旧版本数据文件）"""
+        return {
+            'timestamp': datetime.fromtimestamp(self.timestamp).isoformat(),
+            'level': self.level,
+            'value': self.value,
+            'hostname': self.hostname,
+            'node_id': self.node_id,
+            'key': self.key
+        }
+    
+    @classmethod
+    def from_dict(cls, data, default_hostname=''):
+        """从持久化格式创建结果记录"""
+        return cls(
+            parse_timestamp(data.get('timestamp')),
+            data.get('level', 'O'),
+            data.get('value', ''),
+            data.get('hostname') or default_hostname,
+            data.get('node_id'),
+            data.get('key')
+        )
+
+class TaskUsage:
+    """任务在所有节点上的资源消耗汇总，由节点随结果上报的每次执行数据累加"""
+    __slots__ = ('since', 'runs', 'failures', 'wall', 'utime', 'stime', 'max_wall')
+    
+    def __init__(self):
+        self.since = time.time()  # 开始统计的时间（epoch秒）
+        self.runs = 0  # 执行次数
+        self.failures = 0  # 退出码非0（含超时被杀）的次数
+        self.wall = 0.0  # 累计耗时（秒）
+        self.utime = 0.0  # 累计用户态CPU（秒）
+        self.stime = 0.0  # 累计内核态CPU（秒）
+        self.max_wall = 0.0  # 单次执行最长耗时（秒）
+    
+    def record(self, usage):
+        """累加一次执行的资源消耗，数据格式不正确时忽略"""
+        try:
+            wall = float(usage.get('wall', 0))
+            utime = float(usage.get('utime', 0))
+            stime = float(usage.get('stime', 0))
+            exit_code = int(usage.get('exit', 0))
+        except (AttributeError, TypeError, ValueError):
+            return
+        self.runs += 1
+        if exit_code != 0:
+            self.failures += 1
+        self.wall += wall
+        self.utime += utime
+        self.stime += stime
+        self.max_wall = max(self.max_wall, wall)
+    
+    @property
+    def cpu(self):
+        return self.utime + self.stime
+    
+    def to_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+    
+    @classmethod
+    def from_dict(cls, data):
+        usage = cls()
+        for slot in cls.__slots__:
+            if slot in data:
+                setattr(usage, slot, data[slot])
+        return usage
+
+# 结果版本号，所有任务共用并单调递增，从1开始；返回给客户端时带上本次启动的随机纪元，格式为 纪元:序号，
+# 服务端重启后纪元不同，重启前的版本号不会与新的版本号混淆，也不依赖系统时钟
+RESULT_EPOCH = os.urandom(4).hex()
+result_versions = itertools.count(1)
+
+def format_version(version):
+    """将内部版本号转换为返回给客户端的版本号"""
+    return f"{RESULT_EPOCH}:{version}"
+
 # 存储任务信息
 class Task:
-    def __init__(self, task_name, script_content, interval):
+    __slots__ = ('task_name', 'script_content', 'interval', 'selector', 'hosts', 'collector', 'limits', 'priority',
+                 'created_at', 'results', 'series', 'usage', 'result_bytes', '_modified',
+                 'version', 'versions', 'removed', 'removed_floor')
+    
+    def __init__(self, task_name, script_content, interval, selector=None, hosts=None, collector=None, limits=None,
+                 priority=None):
         self.task_name = task_name
         self.script_content = script_content
         self.interval = interval  # 执行间隔（秒）
+        self.collector = collector  # 节点内置采集器名称（如cpu），为空表示执行脚本
+        self.limits = limits or {}  # 脚本资源限制，如 {'cpu_seconds': 30}，为空时使用节点默认值
+        self.priority = priority  # 执行优先级，为空时由节点按执行间隔推断
+        self.selector = selector or {}  # 标签选择器，如 {'role': 'db'}，为空表示不限制
+        self.hosts = list(hosts or [])  # 目标主机列表，为空表示不限制
         self.created_at = datetime.now().isoformat()
-        self.results = {}
+        self.results = {}  # 各节点的最新结果 {主机名或主机名:子键: ResultRecord}，以主机名作为稳定的节点标识
+        self.series = {}  # 各节点当前的结果存储键 {主机名: {存储键, ...}}，用于替换多行输出的子序列
+        self.usage = TaskUsage()  # 所有节点执行该任务的资源消耗汇总
+        self.result_bytes = 0  # 结果占用内存的估算值（字节）
         self._modified = False  # 标记是否被修改，用于延迟保存
+        # 结果版本，用于 -t 的条件查询和增量查询
+        self.version = next(result_versions)  # 结果最近一次变化的版本号
+        self.versions = {}  # 各结果最近一次变化的版本号 {存储键: 版本号}
+        self.removed = {}  # 已删除的结果 {存储键: 删除时的版本号}，按删除顺序排列
+        self.removed_floor = self.version  # 早于该版本的删除记录已丢弃，更早的版本号只能全量查询
     
-    def update_result(self, node_id, result_data):
+    def matches(self, node):
+        """判断任务是否应下发到指定节点"""
+        return node_matches(node, self.selector, self.hosts)
+    
+    def update_result(self, host_key, result_data):
         """更新任务结果，并标记为已修改"""
-        self.results[node_id] = result_data
+        old_result = self.results.get(host_key)
+        if old_result is not None:
+            self.result_bytes -= estimate_result_size(old_result)
+        self.results[host_key] = result_data
+        self.series.setdefault(result_data.hostname, set()).add(host_key)
+        self.result_bytes += estimate_result_size(result_data)
+        self.version = self.versions[host_key] = next(result_versions)
+        self.removed.pop(host_key, None)
+        self._modified = True
+    
+    def remove_result(self, host_key):
+        """删除指定节点的结果，并标记为已修改"""
+        old_result = self.results.pop(host_key, None)
+        if old_result is not None:
+            keys = self.series.get(old_result.hostname)
+            if keys is not None:
+                keys.discard(host_key)
+                if not keys:
+                    del self.series[old_result.hostname]
+            self.result_bytes -= estimate_result_size(old_result)
+            self.versions.pop(host_key, None)
+            self.version = self.removed[host_key] = next(result_versions)
+            # 删除记录过多时丢弃最早的，比它更早的版本号只能全量查询
+            if len(self.removed) > TASK_TOMBSTONE_LIMIT:
+                oldest = next(iter(self.removed))
+                self.removed_floor = self.removed.pop(oldest)
+            self._modified = True
+    
+    def host_results(self, hostname):
+        """返回指定节点当前的所有结果存储键"""
+        return self.series.get(hostname, ())
+    
+    def clear_results(self):
+        """清除所有结果"""
+        self.results = {}
+        self.series = {}
+        self.result_bytes = 0
+        self.versions = {}
+        self.removed = {}
+        self.version = self.removed_floor = next(result_versions)
         self._modified = True
     
+    def changes_since(self, since_version):
+        """返回 (变化的存储键列表, 删除的存储键列表)，无法计算增量时返回None
+        
+        版本号早于保留的删除记录或晚于当前版本时需要全量查询
+        """
+        if since_version < self.removed_floor or since_version > self.version:
+            return None
+        changed = [key for key, version in list(self.versions.items()) if version > since_version]
+        removed = [key for key, version in list(self.removed.items()) if version > since_version]
+        return changed, removed
+    
     def mark_saved(self):
         """标记任务结果已保存"""
         self._modified = False
@@ -81,24 +327,68 @@ all_tasks = {}
 # 创建数据目录
 os.makedirs(DATA_DIR, exist_ok=True)
 
+class TokenBucket:
+    """令牌桶，用于入口限流"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at')
+    
+    def __init__(self, rate, burst):
+        self.rate = rate  # 每秒补充的令牌数
+        self.burst = burst  # 桶容量
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def consume(self, count=1):
+        """尝试消耗令牌，成功返回True"""
+        self._refill()
+        if self.tokens >= count:
+            self.tokens -= count
+            return True
+        return False
+    
+    def retry_after(self, count=1):
+        """距离可以再次消耗令牌还需等待的秒数"""
+        self._refill()
+        if self.tokens >= count or self.rate <= 0:
+            return 0
+        return (count - self.tokens) / self.rate
+
 class NodeConnection:
     """管理与单个节点的连接"""
+    __slots__ = ('reader', 'writer', 'address', 'node_id', 'hostname', 'labels',
+                 'last_heartbeat', 'status', 'message_bucket', 'task_buckets',
+                 'throttled_count', 'last_throttle_notice', 'telemetry', 'telemetry_at', 'features')
+    
     def __init__(self, reader, writer, client_address):
         self.reader = reader
         self.writer = writer
         self.address = client_address
         self.node_id = None  # 服务端生成的唯一标识ID
         self.hostname = None  # 节点的主机名
+        self.labels = {}  # 节点在认证时声明的标签，如 {'role': 'db', 'dc': 'bj', 'os': 'linux'}
         self.last_heartbeat = time.time()
         self.status = 'online'
+        # 入口限流状态
+        self.message_bucket = TokenBucket(NODE_MESSAGE_RATE, NODE_MESSAGE_BURST)  # 节点级消息令牌桶
+        self.task_buckets = {}  # 任务级结果令牌桶 {任务名: TokenBucket}
+        self.throttled_count = 0  # 被限流丢弃的消息数
+        self.last_throttle_notice = {}  # 上次发送限流通知的时间 {任务名: 时间}，节点级限流的键为None
+        # 节点随心跳上报的代理运行状况
+        self.telemetry = {}
+        self.telemetry_at = None
+        self.features = set()  # 节点在认证时声明支持的消息类型，如task_bundle
         
     async def send_message(self, message):
         """向节点发送消息"""
         try:
-            data = (json.dumps(message) + '\n').encode('utf-8')
-            self.writer.write(data)
+            self.writer.write(encode_frame(message))
             await self.writer.drain()
-            logger.debug(f"向节点 {self.node_id} 发送消息: {message}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"向节点 {self.node_id} 发送消息: {message}")
         except Exception as e:
             logger.error(f"向节点 {self.node_id} 发送消息失败: {e}")
             await self.close()
@@ -109,8 +399,9 @@ class NodeConnection:
             self.writer.close()
             await self.writer.wait_closed()
             self.status = 'offline'
-            if self.node_id and self.node_id in connected_nodes:
+            if self.node_id and connected_nodes.get(self.node_id) is self:
                 del connected_nodes[self.node_id]
+                unindex_node(self)
             logger.info(f"节点 {self.node_id} 连接已关闭")
         except Exception as e:
             logger.error(f"关闭节点 {self.node_id} 连接失败: {e}")
@@ -122,12 +413,47 @@ tasks_lock = asyncio.Lock()
 # 批量保存结果配置
 BATCH_SAVE_INTERVAL = 5  # 批量保存间隔（秒）
 pending_saves = set()  # 待保存的任务集合
+history_buffer = defaultdict(list)  # 待追加的历史记录 {任务名: [ResultRecord]}
 last_batch_save_time = time.time()
 
 # 性能优化配置
 MAX_CACHE_SIZE = 1000  # 最大缓存条目数
 NODE_TIMEOUT = 60  # 节点超时时间（秒）
 
+# 入口限流配置
+NODE_MESSAGE_RATE = 20  # 每个节点每秒允许的消息数
+NODE_MESSAGE_BURST = 100  # 每个节点允许的突发消息数
+TASK_RESULT_RATE_FACTOR = 4  # 每个任务每个执行间隔允许的结果数
+TASK_RESULT_BURST = 5  # 每个任务允许的突发结果数（容纳立即执行等情况）
+THROTTLE_NOTICE_INTERVAL = 5  # 同一节点（任务级限流时为同一节点的同一任务）限流通知的最小间隔（秒）
+
+# 同步脚本目录（-S）时的下发控制
+CATALOG_SEND_CONCURRENCY = 64  # 同时发送任务包的节点数，避免一次占满服务端出口带宽和内存
+CATALOG_BUNDLE_MAX_BYTES = MAX_FRAME_SIZE // 4  # 单个任务包的估算大小上限，超过后拆分为多个任务包
+
+# 节点接入控制，服务端重启后大量节点同时重连时限制同时处理的认证数
+NODE_AUTH_CONCURRENCY = 32  # 同时处理的节点认证数（包括下发初始任务）
+NODE_AUTH_MAX_PENDING = 256  # 等待认证的连接超过该数量时直接拒绝，并提示节点稍后重试
+NODE_AUTH_RETRY_AFTER = 5  # 拒绝认证时建议节点等待的基础时间（秒），按排队长度放大
+NODE_AUTH_RETRY_AFTER_MAX = 120  # 建议等待时间的上限（秒）
+NODE_AUTH_TIMEOUT = 10  # 连接建立后等待认证消息的超时时间（秒）
+
+# 入口统计
+ingest_stats = {
+    'accepted': 0,  # 已接受的消息数
+    'throttled': 0,  # 被限流丢弃的消息数
+    'auth_rejected': 0  # 因排队过长被拒绝的认证数
+}
+
+# 正在等待或处理认证的连接数
+node_auth_pending = 0
+node_auth_semaphore = asyncio.Semaphore(NODE_AUTH_CONCURRENCY)
+
+def auth_retry_after():
+    """根据当前排队的认证数计算建议节点等待的时间（秒）"""
+    backlog = node_auth_pending / NODE_AUTH_CONCURRENCY
+    return min(NODE_AUTH_RETRY_AFTER_MAX, round(NODE_AUTH_RETRY_AFTER * (1 + backlog), 1))
+
 def authenticate_user(username, password):
     """验证用户身份"""
     if username in USERS and USERS[username] == password:
@@ -136,18 +462,318 @@ def authenticate_user(username, password):
 
 def generate_node_id(address, hostname):
     """生成节点ID（基于地址和主机名，更加稳定）"""
-    # 使用IP地址和主机名生成更稳定的ID，减少重复生成可能
-    unique_str = f"{address[0]}:{address[1]}:{hostname}"
+    # 使用IP地址和主机名生成ID，不包含临时端口，节点重连后ID保持不变
+    unique_str = f"{address[0]}:{hostname}"
     # 使用hashlib.sha1替代md5以获得更好的唯一性
     return hashlib.sha1(unique_str.encode()).hexdigest()[:12]
 
+def admit_node_message(node, message):
+    """入口准入控制，返回 (是否接受, 需要等待的秒数, 被限流的任务名)
+    
+    先检查节点级令牌桶，再对任务结果检查节点+任务级令牌桶，
+    防止单个异常节点或高频脚本拖慢整个集群的入口处理；节点级限流时任务名为None
+    """
+    if not node.message_bucket.consume():
+        return False, node.message_bucket.retry_after(), None
+    
+    if message.get('type') == 'task_result':
+        task_name = message.get('task_name')
+        task = all_tasks.get(task_name)
+        if task is not None:
+            bucket = node.task_buckets.get(task_name)
+            if bucket is None:
+                rate = TASK_RESULT_RATE_FACTOR / max(task.interval, 1)
+                bucket = TokenBucket(rate, TASK_RESULT_BURST)
+                node.task_buckets[task_name] = bucket
+            if not bucket.consume():
+                return False, bucket.retry_after(), task_name
+    
+    return True, 0, None
+
+async def notify_throttle(node, task_name, retry_after):
+    """通知节点已被限流，节点收到后应暂停发送一段时间
+    
+    task_name为None时暂停整个节点，否则只暂停该任务；通知间隔按任务分别计算，
+    一个任务的通知不会挡住另一个任务的通知
+    """
+    now = time.monotonic()
+    if now - node.last_throttle_notice.get(task_name, 0) < THROTTLE_NOTICE_INTERVAL:
+        return
+    node.last_throttle_notice[task_name] = now
+    
+    throttle_msg = {
+        'type': 'throttle',
+        'retry_after': round(max(retry_after, 1), 3),
+        'throttled_count': node.throttled_count
+    }
+    if task_name is not None:
+        throttle_msg['task_name'] = task_name
+    
+    logger.warning(f"节点 {node.node_id}({node.hostname}) 消息超过限流，累计丢弃 {node.throttled_count} 条，通知等待 {throttle_msg['retry_after']} 秒")
+    await node.send_message(throttle_msg)
+
+def parse_selector(selector_str):
+    """解析标签选择器字符串，格式: key=value[,key=value...]"""
+    selector = {}
+    if not selector_str:
+        return selector
+    for item in selector_str.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' not in item:
+            raise ValueError(f"标签选择器格式不正确: {item}，应为key=value")
+        key, value = item.split('=', 1)
+        selector[key.strip()] = value.strip()
+    return selector
+
+def parse_limits(limits_str):
+    """解析脚本资源限制字符串，格式: key=value[,key=value...]，如 cpu_seconds=30,memory_mb=256
+    
+    只校验名称和格式，节点会把数值限制在自身配置的上限之内
+    """
+    limits = {}
+    for key, value in parse_selector(limits_str).items():
+        if key not in SCRIPT_LIMIT_KEYS:
+            raise ValueError(f"未知的资源限制: {key}，可选: {', '.join(SCRIPT_LIMIT_KEYS)}")
+        if key == 'io_class':
+            if value not in SCRIPT_IO_CLASSES:
+                raise ValueError(f"io_class 只能是 {' 或 '.join(SCRIPT_IO_CLASSES)}")
+            limits[key] = value
+            continue
+        try:
+            limits[key] = int(value)
+        except ValueError:
+            raise ValueError(f"资源限制 {key} 必须是整数")
+        if limits[key] < 0:
+            raise ValueError(f"资源限制 {key} 不能为负数")
+    return limits
+
+def parse_priority(priority):
+    """校验任务执行优先级，未指定时返回None"""
+    if not priority:
+        return None
+    if priority not in TASK_PRIORITIES:
+        raise ValueError(f"优先级只能是 {', '.join(TASK_PRIORITIES)}")
+    return priority
+
+def parse_rollout(rollout_str):
+    """解析分批下发参数，格式: key=value[,key=value...]，如 canary=5,batch=20
+    
+    未指定分批下发时返回None，空字符串表示全部使用默认值
+    """
+    if rollout_str is None:
+        return None
+    options = dict(ROLLOUT_DEFAULTS)
+    for key, value in parse_selector(rollout_str).items():
+        if key not in ROLLOUT_DEFAULTS:
+            raise ValueError(f"未知的分批下发参数: {key}，可选: {', '.join(ROLLOUT_DEFAULTS)}")
+        try:
+            options[key] = int(value)
+        except ValueError:
+            raise ValueError(f"分批下发参数 {key} 必须是整数")
+    for key in ('canary', 'batch'):
+        if not 0 < options[key] <= 100:
+            raise ValueError(f"分批下发参数 {key} 必须在1到100之间")
+    if options['concurrency'] < 1 or options['wait'] < 1 or options['tolerance'] < 0:
+        raise ValueError("分批下发参数 concurrency、wait 必须大于0，tolerance 不能为负数")
+    return options
+
+def parse_since_version(value):
+    """解析 -t 条件查询的版本号（纪元:序号），返回内部版本号，未指定时返回None
+    
+    0或其他纪元（服务端重启前）的版本号返回0，早于所有版本，查询返回全量结果
+    """
+    if value is None or value == '':
+        return None
+    epoch, separator, sequence = str(value).partition(':')
+    if not separator:
+        if epoch.strip() == '0':
+            return 0
+        raise ValueError("版本号格式不正确，应为上次查询返回的版本号或0")
+    try:
+        sequence = int(sequence)
+    except ValueError:
+        raise ValueError("版本号格式不正确，应为上次查询返回的版本号或0")
+    return sequence if epoch == RESULT_EPOCH else 0
+
+def parse_hosts(hosts_str):
+    """解析主机列表字符串，格式: host1,host2"""
+    if not hosts_str:
+        return []
+    return [host.strip() for host in hosts_str.split(',') if host.strip()]
+
+def index_node(node):
+    """将节点加入标签索引和主机名索引"""
+    hostname_index[node.hostname] = node.node_id
+    for key, value in node.labels.items():
+        label_index[(key, value)].add(node.node_id)
+
+def unindex_node(node):
+    """从标签索引和主机名索引中移除节点"""
+    if hostname_index.get(node.hostname) == node.node_id:
+        del hostname_index[node.hostname]
+    for key, value in node.labels.items():
+        node_ids = label_index.get((key, value))
+        if node_ids is not None:
+            node_ids.discard(node.node_id)
+            if not node_ids:
+                del label_index[(key, value)]
+
+def node_matches(node, selector=None, hosts=None):
+    """判断节点是否满足标签选择器和主机列表"""
+    if hosts and node.hostname not in hosts:
+        return False
+    if selector:
+        for key, value in selector.items():
+            if node.labels.get(key) != value:
+                return False
+    return True
+
+def resolve_target_nodes(selector=None, hosts=None):
+    """通过索引解析目标节点列表，选择器和主机列表都为空时返回所有节点"""
+    if not selector and not hosts:
+        return list(connected_nodes.values())
+    
+    candidate_sets = []
+    if hosts:
+        candidate_sets.append({hostname_index[h] for h in hosts if h in hostname_index})
+    for key, value in (selector or {}).items():
+        candidate_sets.append(label_index.get((key, value), set()))
+    
+    # 从最小的集合开始求交集
+    candidate_sets.sort(key=len)
+    node_ids = set(candidate_sets[0])
+    for other in candidate_sets[1:]:
+        node_ids &= other
+    
+    return [connected_nodes[node_id] for node_id in node_ids if node_id in connected_nodes]
+
+def parse_telemetry(data):
+    """按NODE_TELEMETRY_FIELDS转换节点上报的运行状况，避免异常节点的数据导致节点状态查询出错"""
+    telemetry = {}
+    for field, cast in NODE_TELEMETRY_FIELDS.items():
+        try:
+            telemetry[field] = cast(data.get(field) or 0)
+        except (TypeError, ValueError, OverflowError):
+            telemetry[field] = cast(0)
+    return telemetry
+
+def node_health(node, now):
+    """根据心跳时间和运行状况判断节点级别，返回 (级别, 原因列表)"""
+    reasons = []
+    level = 'I'
+    telemetry = node.telemetry or {}
+    silent = now - node.last_heartbeat
+    lag = telemetry.get('lag_ms', 0)
+    if silent > HEARTBEAT_TIMEOUT or lag >= NODE_LAG_ERROR_MS:
+        level = 'E'
+    elif (silent > NODE_HEARTBEAT_WARN or lag >= NODE_LAG_WARN_MS
+          or telemetry.get('queued', 0) >= NODE_QUEUED_WARN
+          or telemetry.get('spool', 0) >= NODE_SPOOL_WARN_BYTES
+          or telemetry.get('cpu', 0) >= NODE_CPU_WARN):
+        level = 'W'
+    if silent > NODE_HEARTBEAT_WARN:
+        reasons.append(f"{int(silent)}秒无心跳")
+    if lag >= NODE_LAG_WARN_MS:
+        reasons.append("事件循环延迟")
+    if telemetry.get('queued', 0) >= NODE_QUEUED_WARN:
+        reasons.append("脚本排队")
+    if telemetry.get('spool', 0) >= NODE_SPOOL_WARN_BYTES:
+        reasons.append("离线缓存积压")
+    if telemetry.get('cpu', 0) >= NODE_CPU_WARN:
+        reasons.append("代理CPU过高")
+    return level, reasons
+
+def format_node_status(node, now):
+    """格式化节点状态，格式与任务结果一致: 最近心跳时间 级别 主机名 详情"""
+    level, reasons = node_health(node, now)
+    telemetry = node.telemetry or {}
+    time_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(node.last_heartbeat))
+    if not telemetry:
+        detail = "未上报运行状况"
+    else:
+        detail = (f"延迟 {telemetry.get('lag_ms', 0)}ms 排队 {telemetry.get('queued', 0)} "
+                  f"运行 {telemetry.get('running', 0)} 任务 {telemetry.get('tasks', 0)} "
+                  f"缓存 {telemetry.get('spool', 0) // 1024}KB "
+                  f"RSS {telemetry.get('rss_kb', 0) // 1024}MB CPU {telemetry.get('cpu', 0)}%")
+    if reasons:
+        detail += f"（{'，'.join(reasons)}）"
+    return f"{time_str} {level} {node.hostname} {detail}"
+
+def describe_target(selector=None, hosts=None):
+    """生成目标描述，用于日志和响应消息"""
+    parts = []
+    if selector:
+        parts.append('标签 ' + ','.join(f"{k}={v}" for k, v in selector.items()))
+    if hosts:
+        parts.append('主机 ' + ','.join(hosts))
+    return ' '.join(parts) if parts else '所有节点'
+
+def compute_task_phase(hostname, task_name, interval):
+    """计算节点执行任务的相位偏移（秒）
+    
+    基于主机名和任务名的哈希，在执行间隔内确定性地错开各节点的执行时刻，
+    避免整个集群在同一时刻上报结果。同一节点重连后相位保持不变。
+    """
+    if not interval or interval <= 0:
+        return 0
+    digest = hashlib.sha1(f"{hostname}:{task_name}".encode()).digest()
+    # 取哈希前8字节映射到 [0, interval)，精度为毫秒
+    slot = int.from_bytes(digest[:8], 'big') % (int(interval) * 1000)
+    return slot / 1000.0
+
+def build_task_update_message(task, node):
+    """构建只包含任务参数的更新消息，不含脚本内容"""
+    return {
+        'type': 'task_update',
+        'task_name': task.task_name,
+        'interval': task.interval,
+        'phase': compute_task_phase(node.hostname, task.task_name, task.interval),
+        'limits': task.limits,
+        'priority': task.priority
+    }
+
+def build_task_message(task, node):
+    """构建下发给指定节点的任务消息"""
+    return {
+        'type': 'task',
+        'task_name': task.task_name,
+        'script_content': task.script_content,
+        'interval': task.interval,
+        'phase': compute_task_phase(node.hostname, task.task_name, task.interval),
+        'collector': task.collector,
+        'limits': task.limits,
+        'priority': task.priority
+    }
+
+def parse_collector_spec(spec):
+    """解析内置采集器任务名称，格式: @采集器_时间单位，如 @cpu_1m
+    
+    返回 (任务名, 采集器名, 执行间隔)，格式错误时抛出ValueError
+    """
+    match = re.match(r'^@([a-z]+)_(\d+[smhd])$', spec)
+    if not match:
+        raise ValueError("内置采集器格式不正确，应为@采集器_时间单位，如@cpu_1m")
+    collector = match.group(1)
+    if collector not in NATIVE_COLLECTORS:
+        raise ValueError(f"未知的内置采集器: {collector}，可选: {', '.join(NATIVE_COLLECTORS)}")
+    interval = parse_interval(f"{collector}_{match.group(2)}.sh")
+    if not interval:
+        raise ValueError("无法解析执行间隔")
+    return f"@{collector}", collector, interval
+
 def parse_interval(script_name):
     """从脚本名称解析执行间隔（秒）"""
     match = re.search(r'_(\d+[smhd])\.sh$', script_name)
     if not match:
         return None
-    
-    time_str = match.group(1)
+    return parse_duration(match.group(1))
+
+def parse_duration(time_str):
+    """解析时间长度（秒），格式: 数字加单位，如 30s、5m、1h、1d"""
+    if not re.match(r'^\d+[smhd]$', time_str or ''):
+        return None
     value = int(time_str[:-1])
     unit = time_str[-1]
     
@@ -185,137 +811,176 @@ def validate_script_name(script_name):
     
     return True, ""
 
+async def authenticate_node(node, frame_reader, writer, client_address):
+    """读取并验证节点的认证消息，注册节点并下发初始任务，失败时返回False"""
+    # 等待节点发送认证信息，认证消息可能跨多次读取；迟迟不发送认证的连接不能一直占用认证名额
+    try:
+        frame = await asyncio.wait_for(frame_reader.read_frame(), NODE_AUTH_TIMEOUT)
+    except asyncio.TimeoutError:
+        await send_auth_response(writer, False, "认证超时")
+        return False
+    if frame is None:
+        await send_auth_response(writer, False, "连接已关闭")
+        return False
+    
+    auth_message = decode_frame(frame)
+    
+    # 验证节点密钥
+    if auth_message.get('type') != 'auth' or auth_message.get('secret_key') != NODE_SECRET_KEY:
+        await send_auth_response(writer, False, "无效的节点密钥")
+        logger.warning(f"节点 {client_address} 认证失败: 无效密钥")
+        return False
+    
+    # 获取节点主机名和标签，主机名驻留以便在结果中共享同一个字符串对象
+    node.hostname = sys.intern(str(auth_message.get('hostname', 'unknown')))
+    labels = auth_message.get('labels') or {}
+    if isinstance(labels, dict):
+        node.labels = {str(k): str(v) for k, v in labels.items()}
+    features = auth_message.get('features') or []
+    if isinstance(features, list):
+        node.features = {str(feature) for feature in features}
+    
+    # 认证成功，生成节点ID（基于地址和主机名）
+    node.node_id = generate_node_id(client_address, node.hostname)
+    
+    # 使用锁保护connected_nodes字典
+    async with connected_nodes_lock:
+        # 检查是否已存在相同主机名的节点，如果存在则替换
+        for existing_node_id, existing_node in list(connected_nodes.items()):
+            if existing_node.hostname == node.hostname or existing_node_id == node.node_id:
+                logger.info(f"检测到主机名 {node.hostname} 的节点已存在，替换旧节点连接")
+                try:
+                    await existing_node.close()
+                except Exception as e:
+                    logger.error(f"关闭旧节点连接失败: {e}")
+        
+        # 添加新节点
+        connected_nodes[node.node_id] = node
+        index_node(node)
+    
+    logger.info(f"节点 {node.node_id} ({node.hostname} @ {client_address[0]}:{client_address[1]}) 认证成功，标签: {node.labels}")
+    
+    # 发送认证成功响应和握手消息
+    await send_auth_response(writer, True, "认证成功")
+    
+    # 发送握手消息，包含节点ID和主机名信息
+    handshake_msg = {
+        'type': 'handshake',
+        'node_id': node.node_id,
+        'hostname': node.hostname
+    }
+    await node.send_message(handshake_msg)
+    logger.debug(f"已向节点 {node.node_id}({node.hostname}) 发送握手消息")
+    
+    # 发送该节点匹配的所有任务，分批下发中尚未轮到的节点使用旧版本
+    async with tasks_lock:
+        node_tasks = [task_for_node(task, node) for task in all_tasks.values()]
+    node_tasks = [task for task in node_tasks if task is not None]
+    tasks_list = [task.task_name for task in node_tasks]
+    
+    for task in node_tasks:
+        await node.send_message(build_task_message(task, node))
+    
+    # 发送任务同步消息
+    sync_msg = {
+        'type': 'tasks_sync',
+        'tasks': tasks_list
+    }
+    await node.send_message(sync_msg)
+    return True
+
 async def handle_node(reader, writer):
     """处理节点连接（异步版本）"""
+    global node_auth_pending
     client_address = writer.get_extra_info('peername')
     node = NodeConnection(reader, writer, client_address)
     node.node_id = None  # 将在验证成功后设置
     
     logger.info(f"新的节点连接尝试: {client_address[0]}:{client_address[1]}")
     
+    frame_reader = FrameReader(reader)
     try:
-        # 等待节点发送认证信息
-        data = await reader.read(4096)
-        if not data:
-            await send_auth_response(writer, False, "连接已关闭")
-            return
-        
-        auth_message = json.loads(data.decode('utf-8'))
-        
-        # 验证节点密钥
-        if auth_message.get('type') != 'auth' or auth_message.get('secret_key') != NODE_SECRET_KEY:
-            await send_auth_response(writer, False, "无效的节点密钥")
-            logger.warning(f"节点 {client_address} 认证失败: 无效密钥")
+        # 排队认证的连接过多时直接拒绝，节点按建议时间加随机抖动后重连
+        if node_auth_pending >= NODE_AUTH_MAX_PENDING:
+            ingest_stats['auth_rejected'] += 1
+            await send_auth_response(writer, False, "服务端繁忙，请稍后重试", retry_after=auth_retry_after())
             return
         
-        # 获取节点主机名
-        node.hostname = auth_message.get('hostname', 'unknown')
-        
-        # 认证成功，生成节点ID（基于地址和主机名）
-        node.node_id = generate_node_id(client_address, node.hostname)
-        
-        # 使用锁保护connected_nodes字典
-        async with connected_nodes_lock:
-            # 检查是否已存在相同主机名的节点，如果存在则替换
-            for existing_node_id, existing_node in list(connected_nodes.items()):
-                if existing_node.hostname == node.hostname and existing_node_id != node.node_id:
-                    logger.info(f"检测到主机名 {node.hostname} 的节点已存在，替换旧节点连接")
-                    try:
-                        await existing_node.close()
-                    except Exception as e:
-                        logger.error(f"关闭旧节点连接失败: {e}")
-            
-            # 添加新节点
-            connected_nodes[node.node_id] = node
-        
-        logger.info(f"节点 {node.node_id} ({node.hostname} @ {client_address[0]}:{client_address[1]}) 认证成功")
-        
-        # 发送认证成功响应和握手消息
-        await send_auth_response(writer, True, "认证成功")
-        
-        # 发送握手消息，包含节点ID和主机名信息
-        handshake_msg = {
-            'type': 'handshake',
-            'node_id': node.node_id,
-            'hostname': node.hostname
-        }
-        await node.send_message(handshake_msg)
-        logger.debug(f"已向节点 {node.node_id}({node.hostname}) 发送握手消息")
-        
-        # 发送所有已存在的任务
-        async with tasks_lock:
-            tasks_list = list(all_tasks.keys())
-            task_dict = all_tasks.copy()
-        
-        for task_name in tasks_list:
-            task = task_dict[task_name]
-            task_msg = {
-                'type': 'task',
-                'task_name': task_name,
-                'script_content': task.script_content,
-                'interval': task.interval
-            }
-            await node.send_message(task_msg)
-        
-        # 发送任务同步消息
-        sync_msg = {
-            'type': 'tasks_sync',
-            'tasks': tasks_list
-        }
-        await node.send_message(sync_msg)
+        node_auth_pending += 1
+        try:
+            async with node_auth_semaphore:
+                if not await authenticate_node(node, frame_reader, writer, client_address):
+                    return
+        finally:
+            node_auth_pending -= 1
         
-        # 处理消息循环
-        buffer = ''
+        # 处理消息循环，每次读取可能包含多条完整消息
         while True:
-            # 异步读取数据
-            data = await reader.read(4096)
-            if not data:
+            frames = await frame_reader.read_batch()
+            if not frames:
                 break
             
-            # 处理可能的多条消息
-            buffer += data.decode('utf-8')
-            while '\n' in buffer:
-                line, buffer = buffer.split('\n', 1)
-                if not line.strip():
-                    continue
-                
+            for frame in frames:
                 try:
-                    message = json.loads(line)
+                    message = decode_frame(frame)
                     node.last_heartbeat = time.time()
+                    node_last_seen[node.hostname] = node.last_heartbeat
+                    
+                    # 准入控制，超过限流的消息直接计数丢弃，心跳也不再响应
+                    admitted, retry_after, throttled_task = admit_node_message(node, message)
+                    if not admitted:
+                        node.throttled_count += 1
+                        ingest_stats['throttled'] += 1
+                        await notify_throttle(node, throttled_task, retry_after)
+                        continue
+                    ingest_stats['accepted'] += 1
+                    
+                    # 记录代理运行状况，可能随心跳或任务结果上报
+                    if isinstance(message.get('telemetry'), dict):
+                        node.telemetry = parse_telemetry(message['telemetry'])
+                        node.telemetry_at = node.last_heartbeat
                     
                     if message['type'] == 'heartbeat':
-                        # 响应心跳，包含节点标识信息
-                        await node.send_message({
-                            'type': 'heartbeat_response',
-                            'node_id': node.node_id,
-                            'hostname': node.hostname
-                        })
+                        # 任何消息都会刷新节点在线时间，心跳只在节点要求时响应（旧版本节点默认要求）
+                        if message.get('ack', True):
+                            await node.send_message({
+                                'type': 'heartbeat_response',
+                                'node_id': node.node_id,
+                                'hostname': node.hostname
+                            })
                     elif message['type'] == 'task_result':
                         # 处理任务执行结果
                         # 确保结果中包含正确的节点信息
                         if 'hostname' not in message:
                             message['hostname'] = node.hostname
                         await process_task_result(node, message)
-                except json.JSONDecodeError as e:
-                    logger.error(f"解析节点 {node.node_id} 消息失败: {e}")
+                    elif message['type'] == 'task_result_batch':
+                        # 处理节点离线期间缓存的结果
+                        await process_task_result_batch(node, message)
+                except MESSAGE_ERRORS as e:
+                    logger.error(f"解析节点 {node.node_id} 消息失败: {e!r}")
     
     except json.JSONDecodeError:
         logger.warning(f"节点 {client_address} 发送的验证信息格式错误")
         await send_auth_response(writer, False, "无效的请求格式")
+    except FrameTooLarge as e:
+        logger.error(f"节点 {node.node_id or client_address} 消息过大，关闭连接: {e}")
     except Exception as e:
         logger.error(f"处理节点 {node.node_id or client_address} 连接时出错: {e}")
     finally:
         await node.close()
 
-async def send_auth_response(writer, success, message):
-    """发送认证响应"""
+async def send_auth_response(writer, success, message, retry_after=None):
+    """发送认证响应，retry_after为建议节点重连前等待的时间（秒）"""
     response = {
         'type': 'auth_response',
         'success': success,
         'message': message
     }
+    if retry_after is not None:
+        response['retry_after'] = retry_after
     try:
-        writer.write((json.dumps(response) + '\n').encode('utf-8'))
+        writer.write(encode_frame(response))
         await writer.drain()
     except Exception as e:
         logger.error(f"发送认证响应失败: {e}")
@@ -324,39 +989,99 @@ async def send_auth_response(writer, success, message):
             writer.close()
             await writer.wait_closed()
 
-async def process_task_result(node, message):
-    """处理任务执行结果（异步版本）"""
+def store_task_result(node, message):
+    """保存一条任务结果，返回保存的结果记录列表，调用方需持有tasks_lock
+    
+    结果写入历史记录；只有比当前结果更新时才替换最新结果，
+    因此节点离线期间缓存、重连后补发的历史结果不会覆盖更新的结果。
+    消息带有metrics（多行输出，每项为 [级别, 子键, 值]）时，每行保存为一个子序列，
+    并删除该节点上次执行输出而本次没有输出的子序列
+    """
     task_name = message.get('task_name')
-    timestamp = message.get('timestamp', datetime.now().isoformat())
+    task = all_tasks.get(task_name)
+    if task is None:
+        return None
+    
+    timestamp = parse_timestamp(message.get('timestamp', time.time()))
     level = message.get('level', 'O')
     value = message.get('value', '')
+    metrics = message.get('metrics') or [(level, None, value)]
     
-    # 优先使用message中的hostname，如果没有则使用node的hostname，最后才使用node_id
-    hostname = message.get('hostname', node.hostname)
+    # 以认证时的主机名作为键，节点重连不会产生新条目
+    hostname = node.hostname
     
-    result_data = {
-        'timestamp': timestamp,
-        'level': level,
-        'value': value,
-        'hostname': hostname,
-        'node_id': node.node_id  # 同时保存node_id以便后续查询
-    }
+    # 汇总脚本执行的资源消耗
+    if message.get('usage'):
+        task.usage.record(message['usage'])
     
-    # 保存结果
-    async with tasks_lock:
-        if task_name in all_tasks:
-            all_tasks[task_name].update_result(node.node_id, result_data)
-            # 添加到待保存集合
-            pending_saves.add(task_name)
+    # 同时保存node_id以便后续查询
+    records = []
+    for metric in metrics:
+        try:
+            metric_level, key, metric_value = metric
+        except (TypeError, ValueError):
+            continue
+        record = ResultRecord(timestamp, metric_level or 'O', metric_value, hostname, node.node_id,
+                              str(key) if key else None)
+        history_buffer[task_name].append(record)
+        records.append(record)
+    if not records:
+        return None
     
-    # 检查是否需要批量保存
+    # 保存结果，一次执行的所有子序列整体替换
+    current_keys = task.host_results(hostname)
+    latest = max((task.results[key].timestamp for key in current_keys), default=None)
+    if latest is None or latest <= timestamp:
+        new_keys = set()
+        for record in records:
+            task.update_result(record.series_key, record)
+            new_keys.add(record.series_key)
+        for stale_key in set(current_keys) - new_keys:
+            task.remove_result(stale_key)
+    # 分批下发期间，新版本的结果用于判断是否继续下发
+    rollout = rollouts.get(task_name)
+    if rollout is not None:
+        rollout.record(hostname, records, message.get('sha256'))
+    
+    # 添加到待保存集合
+    pending_saves.add(task_name)
+    return records
+
+def schedule_batch_save():
+    """距离上次批量保存超过间隔时触发保存"""
     global last_batch_save_time
     current_time = time.time()
     if current_time - last_batch_save_time >= BATCH_SAVE_INTERVAL:
         asyncio.create_task(batch_save_results())
         last_batch_save_time = current_time
+
+async def process_task_result(node, message):
+    """处理任务执行结果（异步版本）"""
+    async with tasks_lock:
+        records = store_task_result(node, message)
+    
+    # 检查是否需要批量保存
+    schedule_batch_save()
     
-    logger.info(f"收到节点 {node.node_id}({node.hostname}) 任务 {task_name} 执行结果: {level} {value}")
+    if records:
+        task_name = message.get('task_name')
+        level = message.get('level', records[0].level)
+        # 结果日志按类别采样，使用%s参数，被采样丢弃的日志不会格式化
+        logger.info("收到节点 %s(%s) 任务 %s 执行结果: %s %s，共 %d 项",
+                    node.node_id, node.hostname, task_name, level, message.get('value', records[0].value), len(records),
+                    extra={'category': 'result', 'task': task_name, 'host': node.hostname, 'result_level': level})
+
+async def process_task_result_batch(node, message):
+    """处理节点重连后补发的离线缓存结果"""
+    results = message.get('results') or []
+    stored = 0
+    async with tasks_lock:
+        for result in results:
+            if isinstance(result, dict) and store_task_result(node, result):
+                stored += 1
+    
+    schedule_batch_save()
+    logger.info(f"收到节点 {node.node_id}({node.hostname}) 补发的 {len(results)} 条离线结果，保存 {stored} 条")
 
 async def batch_save_results():
     """批量保存任务结果"""
@@ -367,6 +1092,13 @@ async def batch_save_results():
     tasks_to_save = set(pending_saves)
     pending_saves.clear()
     
+    # 追加历史记录
+    if history_buffer:
+        history_to_save = dict(history_buffer)
+        history_buffer.clear()
+        loop = asyncio.get_event_loop()
+        asyncio.ensure_future(loop.run_in_executor(None, append_task_history, history_to_save))
+    
     # 批量保存
     for task_name in tasks_to_save:
         # 只保存被修改的任务
@@ -377,6 +1109,33 @@ async def batch_save_results():
                 # 标记为已保存
                 all_tasks[task_name].mark_saved()
 
+def history_file_path(task_name):
+    """任务历史记录文件路径"""
+    return os.path.join(HISTORY_DIR, f"task_{task_name}.jsonl")
+
+def append_task_history(history):
+    """追加任务历史记录，每行一条结果，超过大小上限时轮转为.1文件"""
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    for task_name, records in history.items():
+        file_path = history_file_path(task_name)
+        try:
+            if os.path.exists(file_path) and os.path.getsize(file_path) >= HISTORY_MAX_BYTES:
+                os.replace(file_path, file_path + '.1')
+            with open(file_path, 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(record.to_dict(), ensure_ascii=False) + '\n' for record in records)
+        except Exception as e:
+            logger.error(f"保存任务 {task_name} 历史记录失败: {e}")
+
+def remove_task_history(task_name):
+    """删除任务历史记录文件"""
+    history_buffer.pop(task_name, None)
+    for file_path in (history_file_path(task_name), history_file_path(task_name) + '.1'):
+        try:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        except Exception as e:
+            logger.error(f"删除任务历史记录文件失败: {e}")
+
 def save_task_results(task_name):
     """保存任务结果到文件（同步版本，保留向后兼容）"""
     if task_name not in all_tasks:
@@ -389,7 +1148,14 @@ def save_task_results(task_name):
                 'task_name': task_name,
                 'created_at': all_tasks[task_name].created_at,
                 'interval': all_tasks[task_name].interval,
-                'results': all_tasks[task_name].results
+                'selector': all_tasks[task_name].selector,
+                'hosts': all_tasks[task_name].hosts,
+                'collector': all_tasks[task_name].collector,
+                'limits': all_tasks[task_name].limits,
+                'priority': all_tasks[task_name].priority,
+                'usage': all_tasks[task_name].usage.to_dict(),
+                'results': {host_key: result.to_dict()
+                            for host_key, result in list(all_tasks[task_name].results.items())}
             }, f, ensure_ascii=False, indent=2)
     except Exception as e:
         logger.error(f"保存任务 {task_name} 结果失败: {e}")
@@ -414,24 +1180,104 @@ def load_task_results():
                     # 只恢复结果，不恢复脚本内容
                     if task_name not in all_tasks:
                         # 如果任务不存在，创建一个空任务
-                        all_tasks[task_name] = Task(task_name, '', data['interval'])
-                    all_tasks[task_name].results = data['results']
-                    all_tasks[task_name].created_at = data['created_at']
+                        all_tasks[task_name] = Task(task_name, '', data['interval'],
+                                                    data.get('selector'), data.get('hosts'),
+                                                    collector=data.get('collector'), limits=data.get('limits'),
+                                                    priority=data.get('priority'))
+                    task = all_tasks[task_name]
+                    if data.get('usage'):
+                        task.usage = TaskUsage.from_dict(data['usage'])
+                    # 旧版本以node_id为键，按主机名重新归并，保留最新的结果
+                    for key, result_dict in data['results'].items():
+                        result = ResultRecord.from_dict(result_dict, key)
+                        host_key = result.series_key
+                        current = task.results.get(host_key)
+                        if current is None or current.timestamp < result.timestamp:
+                            task.update_result(host_key, result)
+                        # 以结果时间初始化节点最近活跃时间
+                        node_last_seen[result.hostname] = max(node_last_seen.get(result.hostname, 0), result.timestamp)
+                    task.created_at = data['created_at']
+                    task.mark_saved()
             except Exception as e:
                 logger.error(f"加载任务结果文件 {filename} 失败: {e}")
 
-async def async_send_to_nodes(message):
-    """异步向所有节点发送消息"""
+def estimate_result_size(result):
+    """估算单条结果占用的内存（字节）"""
+    return RESULT_ENTRY_OVERHEAD + len(str(result.value))
+
+def sweep_results(now=None):
+    """按保留时长、离线节点和内存预算清理结果，返回删除的条目数"""
+    if now is None:
+        now = time.time()
+    retention_cutoff = now - RESULT_RETENTION
+    stale_cutoff = now - STALE_NODE_TTL
+    
+    # 长期离线且当前未连接的节点
+    stale_hosts = {host for host, seen in node_last_seen.items()
+                   if seen < stale_cutoff and host not in hostname_index}
+    for host in stale_hosts:
+        del node_last_seen[host]
+    
+    removed = 0
+    for task in list(all_tasks.values()):
+        for host_key, result in list(task.results.items()):
+            if result.hostname in stale_hosts or result.timestamp < retention_cutoff:
+                task.remove_result(host_key)
+                removed += 1
+    
+    # 超出内存预算时，从最旧的结果开始删除，直到降到预算的90%
+    total_bytes = sum(task.result_bytes for task in all_tasks.values())
+    if total_bytes > RESULT_MEMORY_BUDGET:
+        entries = sorted(
+            (result.timestamp, task.task_name, host)
+            for task in all_tasks.values()
+            for host, result in task.results.items()
+        )
+        target_bytes = RESULT_MEMORY_BUDGET * 0.9
+        for _, task_name, host in entries:
+            if total_bytes <= target_bytes:
+                break
+            task = all_tasks[task_name]
+            size = estimate_result_size(task.results[host])
+            task.remove_result(host)
+            total_bytes -= size
+            removed += 1
+        logger.warning(f"结果占用内存超出预算 {RESULT_MEMORY_BUDGET} 字节，已删除最旧的结果")
+    
+    for task in all_tasks.values():
+        if task._modified:
+            pending_saves.add(task.task_name)
+    
+    return removed
+
+async def result_retention_async():
+    """定期清理过期结果和长期离线节点的结果"""
+    while True:
+        await asyncio.sleep(RESULT_SWEEP_INTERVAL)
+        try:
+            async with tasks_lock:
+                removed = sweep_results()
+            if removed:
+                logger.info(f"结果清理完成，删除 {removed} 条过期或离线节点的结果")
+                await batch_save_results()
+        except Exception as e:
+            logger.error(f"清理结果时出错: {e}")
+
+async def async_send_to_nodes(message, selector=None, hosts=None):
+    """异步向目标节点发送消息，未指定选择器和主机列表时发送到所有节点
+    
+    message可以是消息字典，也可以是以节点为参数、返回消息字典的函数（用于每个节点内容不同的消息）
+    """
     executed_count = 0
     failed_count = 0
     
     # 创建所有发送任务
     send_tasks = []
     async with connected_nodes_lock:
-        # 创建一个副本以避免在迭代过程中修改
-        nodes_copy = list(connected_nodes.items())
-        for node_id, node in nodes_copy:
-            send_tasks.append((node_id, node.hostname, node.send_message(message)))
+        # 通过索引解析目标节点，得到副本以避免在迭代过程中修改
+        for node in resolve_target_nodes(selector, hosts):
+            node_message = message(node) if callable(message) else message
+            send_tasks.append((node.node_id, node.hostname, node.send_message(node_message)))
     
     # 并行等待所有发送任务完成
     for node_id, hostname, send_task in send_tasks:
@@ -444,8 +1290,414 @@ async def async_send_to_nodes(message):
     
     return executed_count, failed_count
 
-def handle_client_command(command, username, script_name=None, script_content=None):
-    """处理客户端命令"""
+async def replace_task(task):
+    """创建或替换任务，并同步到节点
+    
+    目标缩小时，通知不再匹配的节点删除旧任务，然后向新目标下发任务；
+    该任务正在分批下发时，新版本直接替换，分批下发停止
+    """
+    stop_rollout(task.task_name, "任务已被重新下发")
+    async with tasks_lock:
+        old_task = all_tasks.get(task.task_name)
+        all_tasks[task.task_name] = task
+    
+    # 执行间隔可能变化，丢弃旧的任务级令牌桶
+    for node in list(connected_nodes.values()):
+        node.task_buckets.pop(task.task_name, None)
+    
+    if old_task is not None and (old_task.selector or old_task.hosts or task.selector or task.hosts):
+        delete_msg = {'type': 'delete_task', 'task_name': task.task_name}
+        for node in resolve_target_nodes(old_task.selector, old_task.hosts):
+            if not task.matches(node):
+                await node.send_message(delete_msg)
+    
+    return await async_send_to_nodes(lambda node: build_task_message(task, node), task.selector, task.hosts)
+
+def delete_task_files(task_name):
+    """删除任务的数据文件和历史记录"""
+    remove_task_history(task_name)
+    file_path = os.path.join(DATA_DIR, f"task_{task_name}.json")
+    if os.path.exists(file_path):
+        try:
+            os.remove(file_path)
+        except Exception as e:
+            logger.error(f"删除任务文件失败: {e}")
+
+class Rollout:
+    """分批下发新版本任务
+    
+    先下发到金丝雀节点，之后按批次下发，每批下发后立即触发执行，并等待这批节点上报结果；
+    新版本的W/E/O比例比下发前的基线高出 tolerance 个百分点以上时停止，已下发的节点回滚到旧版本。
+    分批下发期间尚未轮到的节点重连时仍然下发旧版本。
+    节点在结果中带回执行的脚本sha256，与新版本不一致的结果（下发前已开始执行的旧版本）不计入；
+    不带sha256的旧版本节点按结果时间判断，早于下发时间的结果不计入。
+    分批下发结束后从rollouts中移除，释放新旧版本，只在rollout_summaries中保留进度摘要供 -R 查询
+    """
+    
+    def __init__(self, task, previous, options):
+        self.task = task  # 新版本
+        self.previous = previous  # 旧版本，新任务为None，分批下发结束后释放
+        self.options = options
+        self.baseline = self._bad_ratio(previous)  # 下发前的W/E/O比例
+        self.script_sha = None if task.collector else script_sha256(task.script_content)  # 新版本脚本的sha256
+        self.upgraded = set()  # 已下发新版本的主机名
+        self.deployed_at = {}  # 当前批次 {主机名: 下发时间}
+        self.state = 'running'  # running、completed、halted、stopped
+        self.message = ''
+        self.started_at = time.time()
+        self.waves = []  # 每批的摘要
+        self.observing = {}  # 当前批次 {主机名: 最近一次结果的级别}，尚未上报为None
+        self._observed = None  # 当前批次全部上报后设置的事件
+        self._runner = None
+    
+    @staticmethod
+    def _bad_ratio(task):
+        if task is None or not task.results:
+            return 0.0
+        bad = sum(1 for result in task.results.values() if result.level in ROLLOUT_BAD_LEVELS)
+        return bad / len(task.results)
+    
+    def record(self, hostname, records, script_sha=None):
+        """记录当前批次节点上报的新版本结果，多行输出取最严重的级别，旧版本的结果忽略"""
+        if self.state != 'running' or hostname not in self.observing:
+            return
+        if script_sha is not None:
+            if self.script_sha is not None and script_sha != self.script_sha:
+                return
+        elif records[0].timestamp < self.deployed_at.get(hostname, 0):
+            return
+        levels = [record.level for record in records]
+        self.observing[hostname] = next((level for level in ROLLOUT_BAD_LEVELS if level in levels), levels[0])
+        if self._observed is not None and all(level is not None for level in self.observing.values()):
+            self._observed.set()
+    
+    def node_task(self, node):
+        """节点重连时应下发的版本，不应下发时返回None"""
+        if self.state != 'running' or node.hostname in self.upgraded:
+            return self.task if self.task.matches(node) else None
+        if self.previous is not None and self.previous.matches(node):
+            return self.previous
+        return None
+    
+    def start(self):
+        self._runner = asyncio.create_task(self.run())
+    
+    def stop(self, message, state='stopped'):
+        """停止分批下发，不回滚，已下发和未下发的节点在重连时都使用新版本"""
+        if self.state != 'running':
+            return
+        self.state = state
+        self.message = message
+        if self._runner is not None and self._runner is not asyncio.current_task():
+            self._runner.cancel()
+        if state == 'stopped':
+            self._release()
+        logger.info(f"任务 {self.task.task_name} 分批下发已停止: {message}")
+    
+    def _release(self):
+        """分批下发结束后释放旧版本及其结果和当前批次的记录，从rollouts中移除并保留进度摘要"""
+        self.previous = None
+        self.observing = {}
+        self.deployed_at = {}
+        task_name = self.task.task_name
+        if rollouts.get(task_name) is self:
+            del rollouts[task_name]
+            rollout_summaries[task_name] = self.describe()
+    
+    async def run(self):
+        task_name = self.task.task_name
+        try:
+            while self.state == 'running':
+                pending = [node for node in resolve_target_nodes(self.task.selector, self.task.hosts)
+                           if node.hostname not in self.upgraded]
+                if not pending:
+                    self.state = 'completed'
+                    self.message = f"已下发到 {len(self.upgraded)} 个节点"
+                    self._release()
+                    logger.info(f"任务 {task_name} 分批下发完成，{self.message}")
+                    return
+                
+                # 按主机名哈希确定顺序，每批的节点在目标内均匀分布且结果可复现
+                pending.sort(key=lambda node: hashlib.sha1(f"{node.hostname}:{task_name}".encode()).digest())
+                percent = self.options['batch'] if self.waves else self.options['canary']
+                total = len(pending) + len(self.upgraded)
+                wave = pending[:max(1, total * percent // 100)]
+                
+                await self._deploy(wave)
+                ratio, missing = await self._observe()
+                summary = {
+                    'nodes': len(wave),
+                    'bad_ratio': ratio,
+                    'missing': missing
+                }
+                self.waves.append(summary)
+                logger.info(f"任务 {task_name} 第 {len(self.waves)} 批下发到 {len(wave)} 个节点，"
+                            f"W/E/O比例 {ratio:.0%}（基线 {self.baseline:.0%}），未上报 {missing} 个")
+                
+                if ratio > self.baseline + self.options['tolerance'] / 100:
+                    await self.halt(f"第 {len(self.waves)} 批W/E/O比例 {ratio:.0%} 超过基线 {self.baseline:.0%} "
+                                    f"{self.options['tolerance']} 个百分点，已回滚")
+                    return
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"任务 {task_name} 分批下发出错: {e}")
+            await self.halt(f"分批下发出错: {e}，已回滚")
+        finally:
+            self.observing = {}
+    
+    async def _deploy(self, wave):
+        """向一批节点下发新版本并立即触发执行，同时发送的节点数不超过concurrency"""
+        execute_msg = {'type': 'execute_task', 'task_name': self.task.task_name}
+        self.observing = {node.hostname: None for node in wave}
+        self.deployed_at = {}
+        self._observed = asyncio.Event()
+        concurrency = self.options['concurrency']
+        for offset in range(0, len(wave), concurrency):
+            chunk = wave[offset:offset + concurrency]
+            self.upgraded.update(node.hostname for node in chunk)
+            now = time.time()
+            self.deployed_at.update((node.hostname, now) for node in chunk)
+            await asyncio.gather(*(node.send_message(build_task_message(self.task, node)) for node in chunk))
+            await asyncio.gather(*(node.send_message(execute_msg) for node in chunk))
+    
+    async def _observe(self):
+        """等待这批节点上报结果，返回 (W/E/O和未上报节点的比例, 未上报节点数)"""
+        try:
+            await asyncio.wait_for(self._observed.wait(), self.options['wait'])
+        except asyncio.TimeoutError:
+            pass
+        levels = list(self.observing.values())
+        missing = sum(1 for level in levels if level is None)
+        bad = missing + sum(1 for level in levels if level in ROLLOUT_BAD_LEVELS)
+        return bad / max(len(levels), 1), missing
+    
+    async def halt(self, message):
+        """停止分批下发并回滚，已经结束时返回False"""
+        if self.state != 'running':
+            return False
+        self.stop(message, state='halted')
+        try:
+            await self._rollback()
+        finally:
+            self._release()
+        return True
+    
+    async def _rollback(self):
+        """已下发新版本的节点恢复旧版本，新任务则删除"""
+        task_name = self.task.task_name
+        async with tasks_lock:
+            if all_tasks.get(task_name) is self.task:
+                if self.previous is not None:
+                    all_tasks[task_name] = self.previous
+                else:
+                    del all_tasks[task_name]
+        if self.previous is not None:
+            pending_saves.add(task_name)
+        else:
+            await asyncio.get_event_loop().run_in_executor(None, delete_task_files, task_name)
+        
+        delete_msg = {'type': 'delete_task', 'task_name': task_name}
+        for node in list(connected_nodes.values()):
+            if node.hostname not in self.upgraded:
+                continue
+            if self.previous is not None and self.previous.matches(node):
+                await node.send_message(build_task_message(self.previous, node))
+            else:
+                await node.send_message(delete_msg)
+        logger.warning(f"任务 {task_name} 已在 {len(self.upgraded)} 个节点上回滚")
+    
+    def describe(self):
+        """分批下发进度，用于 -R"""
+        lines = [
+            f"任务 {self.task.task_name} 分批下发 {ROLLOUT_STATES[self.state]}，已下发 {len(self.upgraded)} 个节点，"
+            f"基线W/E/O比例 {self.baseline:.0%}，参数 " + ','.join(f"{key}={value}" for key, value in self.options.items())
+        ]
+        for number, wave in enumerate(self.waves, 1):
+            lines.append(f"第 {number} 批 {wave['nodes']} 个节点 W/E/O比例 {wave['bad_ratio']:.0%} 未上报 {wave['missing']} 个")
+        if self.state == 'running' and self.observing:
+            reported = sum(1 for level in self.observing.values() if level is not None)
+            lines.append(f"第 {len(self.waves) + 1} 批 {len(self.observing)} 个节点 已上报 {reported} 个")
+        if self.message:
+            lines.append(self.message)
+        return lines
+
+ROLLOUT_STATES = {'running': '进行中', 'completed': '已完成', 'halted': '已停止并回滚', 'stopped': '已中止'}
+
+# 各任务进行中的分批下发 {任务名: Rollout}
+rollouts = {}
+# 已结束的分批下发 {任务名: -R 显示的进度摘要}，任务删除时清除
+rollout_summaries = {}
+
+def task_for_node(task, node):
+    """节点应运行的任务版本，分批下发中尚未轮到的节点使用旧版本，不应下发时返回None"""
+    rollout = rollouts.get(task.task_name)
+    if rollout is not None and rollout.task is task:
+        return rollout.node_task(node)
+    return task if task.matches(node) else None
+
+def stop_rollout(task_name, message):
+    """任务被重新下发或删除时停止正在进行的分批下发，不回滚"""
+    rollout = rollouts.get(task_name)
+    if rollout is not None:
+        rollout.stop(message)
+
+def discard_rollout(task_name, message):
+    """任务被删除时停止正在进行的分批下发，并清除已结束的分批下发摘要"""
+    stop_rollout(task_name, message)
+    rollout_summaries.pop(task_name, None)
+
+async def halt_rollout(task_name, message):
+    """停止任务正在进行的分批下发并回滚，没有进行中的分批下发时返回False"""
+    rollout = rollouts.get(task_name)
+    if rollout is None:
+        return False
+    return await rollout.halt(message)
+
+async def start_rollout(task, options):
+    """创建或替换任务并开始分批下发，返回 (Rollout, 目标节点数)"""
+    stop_rollout(task.task_name, "任务已被重新下发")
+    async with tasks_lock:
+        previous = all_tasks.get(task.task_name)
+        all_tasks[task.task_name] = task
+    
+    # 执行间隔可能变化，丢弃旧的任务级令牌桶
+    for node in list(connected_nodes.values()):
+        node.task_buckets.pop(task.task_name, None)
+    
+    # 不再匹配新目标的节点直接删除旧任务，不参与分批
+    if previous is not None and (previous.selector or previous.hosts or task.selector or task.hosts):
+        delete_msg = {'type': 'delete_task', 'task_name': task.task_name}
+        for node in resolve_target_nodes(previous.selector, previous.hosts):
+            if not task.matches(node):
+                await node.send_message(delete_msg)
+    
+    rollout = Rollout(task, previous, options)
+    rollouts[task.task_name] = rollout
+    pending_saves.add(task.task_name)
+    rollout.start()
+    return rollout, len(resolve_target_nodes(task.selector, task.hosts))
+
+def script_sha256(script_content):
+    """计算脚本内容的sha256，用于与客户端的脚本目录比对"""
+    return hashlib.sha256((script_content or '').encode('utf-8')).hexdigest()
+
+async def apply_catalog(tasks, deleted_names):
+    """一次性替换多个任务并删除多个任务，每个节点通常只收到一条task_bundle消息
+    
+    任务包的估算大小超过CATALOG_BUNDLE_MAX_BYTES时拆分为多条，同时发送的节点数不超过CATALOG_SEND_CONCURRENCY。
+    返回收到变更的节点数；不支持task_bundle的旧版本节点逐条发送任务和删除消息
+    """
+    for task in tasks:
+        stop_rollout(task.task_name, "任务目录已同步")
+    for name in deleted_names:
+        discard_rollout(name, "任务目录已同步")
+    
+    async with tasks_lock:
+        previous = {task.task_name: all_tasks.get(task.task_name) for task in tasks}
+        removed = {name: all_tasks.pop(name) for name in deleted_names if name in all_tasks}
+        for task in tasks:
+            all_tasks[task.task_name] = task
+    
+    # 执行间隔可能变化，丢弃旧的任务级令牌桶
+    for node in list(connected_nodes.values()):
+        for task in tasks:
+            node.task_buckets.pop(task.task_name, None)
+    
+    loop = asyncio.get_event_loop()
+    for name in removed:
+        await loop.run_in_executor(None, delete_task_files, name)
+    
+    # 每个任务消息编码后的估算大小，所有节点共用（脚本按JSON转义后计算，另加其余字段的余量）
+    item_sizes = {task.task_name: len(json.dumps(task.script_content or '')) + 1024 for task in tasks}
+    semaphore = asyncio.Semaphore(CATALOG_SEND_CONCURRENCY)
+    
+    def split_bundles(items, deletes):
+        """按估算大小把任务消息分成多个任务包，删除放在第一个任务包中"""
+        bundles = [{'type': 'task_bundle', 'tasks': [], 'delete': deletes}]
+        size = 0
+        for item in items:
+            item_size = item_sizes[item['task_name']]
+            if bundles[-1]['tasks'] and size + item_size > CATALOG_BUNDLE_MAX_BYTES:
+                bundles.append({'type': 'task_bundle', 'tasks': [], 'delete': []})
+                size = 0
+            bundles[-1]['tasks'].append(item)
+            size += item_size
+        return bundles
+    
+    async def send_bundle(node):
+        items = [build_task_message(task, node) for task in tasks if task.matches(node)]
+        # 删除的任务，以及目标缩小后不再匹配该节点的任务
+        deletes = [name for name, task in removed.items() if task.matches(node)]
+        deletes += [task.task_name for task in tasks if not task.matches(node)
+                    and previous[task.task_name] is not None and previous[task.task_name].matches(node)]
+        if not items and not deletes:
+            return False
+        async with semaphore:
+            if 'task_bundle' in node.features:
+                for bundle in split_bundles(items, deletes):
+                    await node.send_message(bundle)
+            else:
+                for name in deletes:
+                    await node.send_message({'type': 'delete_task', 'task_name': name})
+                for item in items:
+                    await node.send_message(item)
+        return True
+    
+    async with connected_nodes_lock:
+        nodes = list(connected_nodes.values())
+    sent = await asyncio.gather(*(send_bundle(node) for node in nodes))
+    return sum(sent)
+
+async def update_task(task_name, interval=None, limits=None, priority=None):
+    """原地修改任务的执行间隔、资源限制或优先级，只向节点发送参数增量，不重新下发脚本
+    
+    limits与任务原有的资源限制合并，返回 (任务, 成功节点数, 失败节点数)，任务不存在时任务为None。
+    分批下发进行中时同时修改旧版本，尚未轮到的节点和回滚后的节点也使用新的参数
+    """
+    async with tasks_lock:
+        task = all_tasks.get(task_name)
+        if task is None:
+            return None, 0, 0
+        rollout = rollouts.get(task_name)
+        previous = rollout.previous if rollout is not None and rollout.task is task else None
+        for version in (task, previous):
+            if version is None:
+                continue
+            if interval:
+                version.interval = interval
+            if limits:
+                version.limits = dict(version.limits, **limits)
+            if priority:
+                version.priority = priority
+    
+    # 执行间隔可能变化，丢弃旧的任务级令牌桶
+    if interval:
+        for node in list(connected_nodes.values()):
+            node.task_buckets.pop(task_name, None)
+    
+    await save_task_results_async(task_name)
+    executed_count, failed_count = await async_send_to_nodes(
+        lambda node: build_task_update_message(task, node), task.selector, task.hosts)
+    return task, executed_count, failed_count
+
+def run_on_node_loop(coro, timeout=30):
+    """在节点服务的事件循环中执行协程并等待结果（供客户端线程调用）"""
+    if node_loop is None or not node_loop.is_running():
+        coro.close()
+        raise RuntimeError("节点服务未启动")
+    future = asyncio.run_coroutine_threadsafe(coro, node_loop)
+    return future.result(timeout)
+
+def handle_client_command(command, username, script_name=None, script_content=None, target=None, limits=None,
+                          priority=None, rollout=None, since_version=None, manifest=None, fetch_scripts=None):
+    """处理客户端命令
+    
+    target为客户端指定的目标，格式: {'selector': {标签名: 标签值}, 'hosts': [主机名]}；
+    rollout为 -a、-u 的分批下发参数，为None时一次下发到所有目标节点；
+    since_version为 -t 的条件查询版本号，结果没有变化时返回not_modified，否则尽量只返回变化的结果；
+    manifest为 -S 的脚本目录清单 {脚本名: sha256}，fetch_scripts(脚本名列表) 从客户端获取需要上传的脚本内容
+    """
     parts = command.split()
     if len(parts) < 1:
         return {"success": False, "message": "命令格式错误"}
@@ -454,10 +1706,13 @@ def handle_client_command(command, username, script_name=None, script_content=No
     # 这里可以根据需要扩展不同用户的权限控制
     if username == 'viewer':
         # 查看员只能执行查询类命令
-        if parts[0] not in ['-t', '-l']:
+        if parts[0] not in ['-t', '-l', '-r', '-N']:
             return {"success": False, "message": "权限不足，查看员只能执行查询类命令"}
     
     cmd = parts[0]
+    target = target or {}
+    target_selector = target.get('selector') or {}
+    target_hosts = target.get('hosts') or []
     
     if cmd == '-t':  # 查询任务结果
         if len(parts) < 2:
@@ -475,26 +1730,90 @@ def handle_client_command(command, username, script_name=None, script_content=No
         if task_name not in all_tasks:
             return {"success": False, "message": f"任务 {task_name} 不存在"}
         
+        # 条件查询：结果没有变化时不返回数据，只有部分变化时只返回变化的结果
+        task = all_tasks[task_name]
+        version = task.version
+        if since_version is not None and since_version == version:
+            return {"success": True, "not_modified": True, "version": format_version(version)}
+        changes = task.changes_since(since_version) if since_version is not None else None
+        if changes is None:
+            host_keys = list(task.results)
+            removed = []
+        else:
+            host_keys, removed = changes
+        
         # 构建结果响应
         results = []
-        for node_id, result in all_tasks[task_name].results.items():
-            # 根据级别过滤
-            if level and result.get('level', 'O') != level:
+        for host_key in host_keys:
+            result = task.results.get(host_key)
+            if result is None:
+                continue
+            # 根据级别过滤，增量查询时级别不再匹配的结果视为已删除
+            if level and result.level != level:
+                if changes is not None:
+                    removed.append(host_key)
                 continue
             
             # 格式化时间
-            try:
-                timestamp = datetime.fromisoformat(result['timestamp'])
-                time_str = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            except:
-                time_str = result['timestamp']
+            time_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(result.timestamp))
             
-            # 优先使用hostname，如果没有则使用node_id
-            display_name = result.get('hostname', node_id)
-            results.append(f"{time_str} {result['level']} {display_name} {result['value']}")
+            # 优先使用结果中的hostname和子键，如果没有则使用存储键
+            display_name = result.series_key if result.hostname else host_key
+            results.append(f"{time_str} {result.level} {display_name} {result.value}")
+        
+        response = {"success": True, "data": results}
+        if since_version is not None:
+            response['version'] = format_version(version)
+            if changes is not None:
+                response['delta'] = True
+                response['removed'] = removed
+        return response
+    
+    elif cmd == '-r':  # 显示资源消耗最高的任务
+        limit = TOP_TASKS_DEFAULT
+        if len(parts) > 1:
+            try:
+                limit = max(1, int(parts[1]))
+            except ValueError:
+                return {"success": False, "message": "任务数量必须是整数"}
         
+        tasks = [task for task in all_tasks.values() if task.usage.runs]
+        if not tasks:
+            return {"success": True, "message": "暂无任务资源消耗数据"}
+        
+        # 按所有节点累计CPU时间排序
+        tasks.sort(key=lambda task: task.usage.cpu, reverse=True)
+        now = time.time()
+        results = []
+        for task in tasks[:limit]:
+            usage = task.usage
+            hours = max(now - usage.since, 1) / 3600
+            results.append(
+                f"{task.task_name} 执行 {usage.runs} 次 失败 {usage.failures} 次 "
+                f"CPU {usage.cpu:.1f}s（用户 {usage.utime:.1f}s 内核 {usage.stime:.1f}s，{usage.cpu / hours:.1f}s/小时） "
+                f"平均CPU {usage.cpu / usage.runs:.3f}s 平均耗时 {usage.wall / usage.runs:.3f}s 最长 {usage.max_wall:.1f}s"
+            )
         return {"success": True, "data": results}
     
+    elif cmd == '-N':  # 列出节点及其运行状况
+        nodes = resolve_target_nodes(target_selector, target_hosts)
+        if not nodes:
+            return {"success": True, "message": "没有符合条件的在线节点"}
+        
+        # 支持按级别过滤，格式与 -t 相同
+        level = parts[1].lstrip('-') if len(parts) > 1 else None
+        now = time.time()
+        statuses = []
+        for node in nodes:
+            node_level, _ = node_health(node, now)
+            if level and node_level != level:
+                continue
+            statuses.append((node_level, node.hostname or '', format_node_status(node, now)))
+        
+        # 级别严重的节点排在前面
+        statuses.sort(key=lambda item: ('EWI'.index(item[0]), item[1]))
+        return {"success": True, "data": [line for _, _, line in statuses]}
+    
     elif cmd == '-l':  # 列出所有任务
         if not all_tasks:
             return {"success": True, "message": "当前没有任务"}
@@ -509,20 +1828,26 @@ def handle_client_command(command, username, script_name=None, script_content=No
         if task_name not in all_tasks:
             return {"success": False, "message": f"任务 {task_name} 不存在"}
         
-        # 同步环境中创建异步任务并等待其完成
         execute_msg = {
             'type': 'execute_task',
             'task_name': task_name
         }
         
-        # 创建一个事件循环来运行异步函数
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            executed_count, failed_count = loop.run_until_complete(async_send_to_nodes(execute_msg))
-            return {"success": True, "message": f"已向 {executed_count} 个节点发送立即执行任务 {task_name} 的请求，失败 {failed_count} 个"}
-        finally:
-            loop.close()
+        # 命令指定的目标与任务本身的目标取交集，只发送给实际运行该任务的节点
+        task = all_tasks[task_name]
+        selector = dict(task.selector)
+        for key, value in target_selector.items():
+            if selector.get(key, value) != value:
+                return {"success": True, "message": f"目标 {describe_target(target_selector, target_hosts)} 与任务 {task_name} 的目标没有交集"}
+            selector[key] = value
+        hosts = task.hosts
+        if target_hosts:
+            hosts = [h for h in target_hosts if not task.hosts or h in task.hosts]
+            if not hosts:
+                return {"success": True, "message": f"目标 {describe_target(target_selector, target_hosts)} 与任务 {task_name} 的目标没有交集"}
+        
+        executed_count, failed_count = run_on_node_loop(async_send_to_nodes(execute_msg, selector, hosts))
+        return {"success": True, "message": f"已向 {executed_count} 个节点发送立即执行任务 {task_name} 的请求，失败 {failed_count} 个"}
     
     elif cmd == '-d':  # 删除任务
         if len(parts) < 2:
@@ -532,31 +1857,21 @@ def handle_client_command(command, username, script_name=None, script_content=No
         if task_name not in all_tasks:
             return {"success": False, "message": f"任务 {task_name} 不存在"}
         
-        # 删除任务
-        del all_tasks[task_name]
+        # 删除任务，停止正在进行的分批下发
+        task = all_tasks.pop(task_name)
+        node_loop.call_soon_threadsafe(discard_rollout, task_name, "任务已删除")
         
-        # 删除数据文件
-        file_path = os.path.join(DATA_DIR, f"task_{task_name}.json")
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                logger.error(f"删除任务文件失败: {e}")
+        # 删除数据文件和历史记录
+        delete_task_files(task_name)
         
-        # 通知所有节点删除任务
+        # 通知运行该任务的节点删除任务
         delete_msg = {
             'type': 'delete_task',
             'task_name': task_name
         }
         
-        # 创建一个事件循环来运行异步函数
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            executed_count, failed_count = loop.run_until_complete(async_send_to_nodes(delete_msg))
-            logger.info(f"已向 {executed_count} 个节点发送删除任务消息，失败 {failed_count} 个")
-        finally:
-            loop.close()
+        executed_count, failed_count = run_on_node_loop(async_send_to_nodes(delete_msg, task.selector, task.hosts))
+        logger.info(f"已向 {executed_count} 个节点发送删除任务消息，失败 {failed_count} 个")
         
         return {"success": True, "message": f"任务 {task_name} 已删除"}
     
@@ -569,6 +1884,19 @@ def handle_client_command(command, username, script_name=None, script_content=No
         # 提取文件名（去掉路径部分）
         script_name = os.path.basename(full_script_path)
         
+        # 内置采集器，节点直接读取/proc等数据，不需要脚本
+        if script_name.startswith('@'):
+            try:
+                task_name, collector, interval = parse_collector_spec(script_name)
+            except ValueError as e:
+                return {"success": False, "message": str(e)}
+            
+            task = Task(task_name, '', interval, target_selector, target_hosts, collector=collector)
+            executed_count, failed_count = run_on_node_loop(replace_task(task))
+            logger.info(f"已向 {executed_count} 个节点发送内置采集器任务 {task_name}，失败 {failed_count} 个")
+            
+            return {"success": True, "message": f"内置采集器 {task_name} 已下发到 {describe_target(target_selector, target_hosts)} 的 {executed_count} 个节点"}
+        
         # 验证脚本名称
         is_valid, error_msg = validate_script_name(script_name)
         if not is_valid:
@@ -595,26 +1923,113 @@ def handle_client_command(command, username, script_name=None, script_content=No
             return {"success": False, "message": "无法从脚本名称解析执行间隔"}
         
         # 创建或更新任务
-        all_tasks[task_name] = Task(task_name, script_content, interval)
-        
-        # 通知所有节点执行任务
-        task_msg = {
-            'type': 'task',
-            'task_name': task_name,
-            'script_content': script_content,
-            'interval': interval
-        }
+        task = Task(task_name, script_content, interval, target_selector, target_hosts, limits=limits, priority=priority)
+        if rollout is not None:
+            return start_rollout_command(task, rollout)
+        executed_count, failed_count = run_on_node_loop(replace_task(task))
+        logger.info(f"已向 {executed_count} 个节点发送任务消息，失败 {failed_count} 个")
         
-        # 创建一个事件循环来运行异步函数
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            executed_count, failed_count = loop.run_until_complete(async_send_to_nodes(task_msg))
-            logger.info(f"已向 {executed_count} 个节点发送任务消息，失败 {failed_count} 个")
-        finally:
-            loop.close()
+        return {"success": True, "message": f"脚本 {script_name} 已上传并下发到 {describe_target(target_selector, target_hosts)} 的 {executed_count} 个节点"}
+    
+    elif cmd == '-e':  # 修改任务参数
+        if len(parts) < 2:
+            return {"success": False, "message": "缺少任务名称"}
+        
+        task_name = parts[1]
+        interval = None
+        if len(parts) > 2:
+            interval = parse_duration(parts[2])
+            if not interval:
+                return {"success": False, "message": "执行间隔格式不正确，应为数字加单位，如30s、5m、1h"}
+        if not (interval or limits or priority):
+            return {"success": False, "message": "没有需要修改的参数，请指定执行间隔、--limits 或 --priority"}
+        
+        task, executed_count, failed_count = run_on_node_loop(update_task(task_name, interval, limits, priority))
+        if task is None:
+            return {"success": False, "message": f"任务 {task_name} 不存在"}
+        logger.info(f"用户 {username} 修改了任务 {task_name}，已通知 {executed_count} 个节点，失败 {failed_count} 个")
+        
+        return {"success": True, "message": f"任务 {task_name} 已更新，执行间隔 {task.interval} 秒，已通知 {executed_count} 个节点，失败 {failed_count} 个"}
+    
+    elif cmd == '-S':  # 同步脚本目录
+        if not isinstance(manifest, dict) or fetch_scripts is None:
+            return {"success": False, "message": "缺少脚本目录清单"}
+        prune = 'prune' in parts[1:]
+        
+        # 校验清单中的脚本名称，得到期望的任务 {任务名: (脚本名, sha256, 执行间隔)}
+        desired = {}
+        for script_name, digest in manifest.items():
+            is_valid, error_msg = validate_script_name(script_name)
+            if not is_valid:
+                return {"success": False, "message": f"{script_name}: {error_msg}"}
+            task_name = '_'.join(script_name.split('_')[:-1])
+            interval = parse_interval(script_name)
+            if not interval:
+                return {"success": False, "message": f"{script_name}: 无法从脚本名称解析执行间隔"}
+            if task_name in desired:
+                return {"success": False, "message": f"{script_name} 与 {desired[task_name][0]} 对应同一个任务 {task_name}"}
+            desired[task_name] = (script_name, digest, interval)
+        
+        # 只请求内容有变化的脚本，由客户端在同一连接上压缩后上传
+        need = []
+        for task_name, (script_name, digest, _) in desired.items():
+            existing = all_tasks.get(task_name)
+            if existing is None or existing.collector or script_sha256(existing.script_content) != digest:
+                need.append(script_name)
+        uploaded = fetch_scripts(need) if need else {}
+        for script_name in need:
+            if script_sha256(uploaded.get(script_name)) != manifest[script_name]:
+                return {"success": False, "message": f"脚本 {script_name} 的内容与清单中的sha256不一致"}
+        
+        # 生成变化的任务，脚本、执行间隔、目标、资源限制和优先级都没有变化的任务保持不变
+        changed = []
+        created = 0
+        for task_name, (script_name, digest, interval) in desired.items():
+            existing = all_tasks.get(task_name)
+            script_content = uploaded[script_name] if script_name in uploaded else existing.script_content
+            task = Task(task_name, script_content, interval, target_selector, target_hosts, limits=limits, priority=priority)
+            if (existing is not None and script_name not in uploaded and existing.interval == interval
+                    and existing.selector == task.selector and existing.hosts == task.hosts
+                    and existing.limits == task.limits and existing.priority == task.priority):
+                continue
+            if existing is None:
+                created += 1
+            changed.append(task)
+        
+        # prune时删除目录中没有的脚本任务，只删除目标与本次同步目标相同的任务，
+        # 下发到其他标签或主机的任务以及内置采集器不受影响
+        deleted = [name for name, task in list(all_tasks.items())
+                   if prune and not task.collector and name not in desired
+                   and task.selector == target_selector and sorted(task.hosts) == sorted(target_hosts)]
+        
+        if not changed and not deleted:
+            return {"success": True, "message": f"脚本目录与服务端一致，{len(desired)} 个任务没有变化"}
+        
+        node_count = run_on_node_loop(apply_catalog(changed, deleted))
+        logger.info(f"用户 {username} 同步了脚本目录，新增 {created} 个，更新 {len(changed) - created} 个，删除 {len(deleted)} 个")
         
-        return {"success": True, "message": f"脚本 {script_name} 已上传并下发到 {len(connected_nodes)} 个节点"}
+        return {"success": True, "message": f"同步完成: 新增 {created} 个，更新 {len(changed) - created} 个，删除 {len(deleted)} 个，"
+                                            f"未变化 {len(desired) - len(changed)} 个，上传脚本 {len(need)} 个，已通知 {node_count} 个节点"}
+    
+    elif cmd == '-R':  # 查看或停止分批下发
+        if len(parts) < 2:
+            return {"success": False, "message": "缺少任务名称"}
+        
+        task_name = parts[1]
+        rollout = rollouts.get(task_name)
+        summary = rollout_summaries.get(task_name)
+        if rollout is None and summary is None:
+            return {"success": False, "message": f"任务 {task_name} 没有分批下发记录"}
+        
+        if len(parts) > 2:
+            if parts[2] != 'stop':
+                return {"success": False, "message": f"未知操作: {parts[2]}，只支持stop"}
+            # 手动停止，与自动停止一样回滚已下发的节点
+            if rollout is None or not run_on_node_loop(halt_rollout(task_name, f"用户 {username} 手动停止，已回滚")):
+                return {"success": False, "message": f"任务 {task_name} 的分批下发已经结束"}
+            return {"success": True, "message": f"任务 {task_name} 的分批下发已停止，已下发的 {len(rollout.upgraded)} 个节点已回滚"}
+        
+        return {"success": True, "data": rollout.describe() if rollout is not None else summary}
     
     elif cmd == '-c':  # 清除任务记录
         if len(parts) < 2:
@@ -624,9 +2039,11 @@ def handle_client_command(command, username, script_name=None, script_content=No
         if task_name not in all_tasks:
             return {"success": False, "message": f"任务 {task_name} 不存在"}
         
-        # 清除结果
-        all_tasks[task_name].results = {}
+        # 清除结果、资源消耗统计和历史记录
+        all_tasks[task_name].clear_results()
+        all_tasks[task_name].usage = TaskUsage()
         save_task_results(task_name)
+        remove_task_history(task_name)
         
         return {"success": True, "message": f"任务 {task_name} 的记录已清除"}
     
@@ -638,12 +2055,19 @@ def handle_client_command(command, username, script_name=None, script_content=No
         if task_name not in all_tasks:
             return {"success": False, "message": f"任务 {task_name} 不存在"}
         
-        # 获取原始脚本内容
+        # 获取原始脚本内容，内置采集器没有脚本
         original_content = all_tasks[task_name].script_content
+        if all_tasks[task_name].collector:
+            original_content = f"# 内置采集器: {all_tasks[task_name].collector}"
+        if all_tasks[task_name].limits:
+            limits_str = ','.join(f"{key}={value}" for key, value in all_tasks[task_name].limits.items())
+            original_content = f"# 资源限制: {limits_str}\n{original_content}"
+        if all_tasks[task_name].priority:
+            original_content = f"# 优先级: {all_tasks[task_name].priority}\n{original_content}"
         # 获取执行间隔（秒）
         interval_seconds = all_tasks[task_name].interval
-        # 将秒转换为更友好的格式（m表示分钟）
-        interval_str = f"{interval_seconds // 60}m"
+        # 将秒转换为更友好的格式（m表示分钟），不足整分钟的用秒表示
+        interval_str = f"{interval_seconds // 60}m" if interval_seconds % 60 == 0 else f"{interval_seconds}s"
         # 在脚本开头添加注释掉的执行周期信息
         modified_content = f"task  {interval_str} \n{original_content}"
         
@@ -667,8 +2091,7 @@ def handle_client_command(command, username, script_name=None, script_content=No
         if not interval:
             return {"success": False, "message": "无法从脚本名称解析执行间隔"}
         
-        # 创建或更新任务
-        all_tasks[task_name] = Task(task_name, script_content, interval)
+        task = Task(task_name, script_content, interval, target_selector, target_hosts, limits=limits, priority=priority)
         logger.info(f"用户 {username} 上传了脚本: {script_name}，任务名: {task_name}")
         
         # 保存脚本到文件系统（可选）
@@ -682,82 +2105,31 @@ def handle_client_command(command, username, script_name=None, script_content=No
         except Exception as e:
             logger.error(f"保存脚本文件失败: {e}")
         
-        # 通知所有节点执行任务
-        for node_id, node in connected_nodes.items():
-            # 直接使用原始脚本内容下发，不包含注释信息
-            node.send_message({
-                'type': 'task',
-                'task_name': task_name,
-                'script_content': script_content,
-                'interval': interval
-            })
+        # 创建或更新任务并通知目标节点，直接使用原始脚本内容下发，不包含注释信息
+        if rollout is not None:
+            return start_rollout_command(task, rollout)
+        executed_count, failed_count = run_on_node_loop(replace_task(task))
         
-        return {"success": True, "message": f"脚本 {script_name} 已上传并下发到 {len(connected_nodes)} 个节点"}
+        return {"success": True, "message": f"脚本 {script_name} 已上传并下发到 {describe_target(target_selector, target_hosts)} 的 {executed_count} 个节点"}
     
     else:
         return {"success": False, "message": f"未知命令: {cmd}"}
 
-async def handle_client_command_async(command, username=None, script_name=None, script_content=None):
-    """异步处理客户端命令"""
-    parts = command.split()
-    if len(parts) < 1:
-        return {"success": False, "message": "命令格式错误"}
-    
-    cmd = parts[0]
-    
-    # 对于需要异步操作的命令，使用异步处理
-    if cmd == '-n':  # 立即执行任务
-        if len(parts) < 2:
-            return {"success": False, "message": "缺少任务名称"}
-        
-        task_name = parts[1]
-        if task_name not in all_tasks:
-            return {"success": False, "message": f"任务 {task_name} 不存在"}
-        
-        # 异步发送到所有节点
-        execute_msg = {
-            'type': 'execute_task',
-            'task_name': task_name
-        }
-        
-        executed_count, failed_count = await async_send_to_nodes(execute_msg)
-        return {"success": True, "message": f"已向 {executed_count} 个节点发送立即执行任务 {task_name} 的请求，失败 {failed_count} 个"}
-    
-    # 其他命令使用原有的同步处理
-    return handle_client_command_original(command, username, script_name, script_content)
-
-def handle_client_command_sync(command, username=None, script_name=None, script_content=None):
-    """同步包装器，用于在同步环境中调用异步函数"""
-    # 创建一个事件循环来运行异步函数
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        # 对于需要异步处理的命令，使用异步版本
-        if command.startswith('-n'):
-            # 先尝试获取现有事件循环，如果没有则创建新的
-            try:
-                current_loop = asyncio.get_event_loop()
-                if current_loop.is_running():
-                    # 如果有运行中的事件循环，使用run_coroutine_threadsafe
-                    future = asyncio.run_coroutine_threadsafe(
-                        handle_client_command_async(command, username, script_name, script_content), current_loop
-                    )
-                    return future.result()
-            except RuntimeError:
-                pass
-                
-            # 否则使用新的事件循环
-            return loop.run_until_complete(handle_client_command_async(command, username, script_name, script_content))
-        
-        # 其他命令继续使用原有逻辑
-        return handle_client_command_original(command, username, script_name, script_content)
-    finally:
-        loop.close()
+def start_rollout_command(task, options):
+    """开始分批下发并生成客户端响应"""
+    rollout, target_count = run_on_node_loop(start_rollout(task, options))
+    canary = max(1, target_count * options['canary'] // 100) if target_count else 0
+    return {"success": True, "message": f"任务 {task.task_name} 开始分批下发到 {describe_target(task.selector, task.hosts)} 的 "
+                                        f"{target_count} 个节点，第一批 {canary} 个节点，使用 -R {task.task_name} 查看进度"}
 
-# 重命名原始函数
-handle_client_command_original = handle_client_command
-# 替换handle_client_command为同步包装器
-handle_client_command = handle_client_command_sync
+def send_client_response(sock, response, compress=False):
+    """发送响应，客户端支持压缩且响应较大时先发送说明编码的一行，再分块发送压缩后的JSON"""
+    payload = json.dumps(response).encode('utf-8')
+    if compress and len(payload) >= CLIENT_COMPRESS_MIN:
+        sock.sendall(json.dumps({'encoding': 'zlib'}).encode('utf-8') + b'\n')
+        send_chunked(sock, payload)
+    else:
+        sock.sendall(payload + b'\n')
 
 def client_handler(client_socket, client_address):
     """处理客户端连接"""
@@ -773,13 +2145,17 @@ def client_handler(client_socket, client_address):
         'client_port': client_port
     }
     
+    compress = False
     try:
-        # 接收认证信息
-        data = client_socket.recv(4096)
+        # 接收认证信息，请求头为一行JSON，不限于一次recv读到的数据
+        client_socket.settimeout(CLIENT_TIMEOUT)
+        stream = ChunkedStream(client_socket)
+        data = stream.readline(CLIENT_MAX_HEADER)
         if not data:
             return
         
-        auth_data = json.loads(data.decode('utf-8'))
+        auth_data = json.loads(data)
+        compress = auth_data.get('accept_encoding') == 'zlib'
         username = auth_data.get('username', 'unknown')
         password = auth_data.get('password', '')
         command = auth_data.get('command', '')
@@ -791,7 +2167,7 @@ def client_handler(client_socket, client_address):
         # 验证用户
         if not authenticate_user(username, password):
             response = {"success": False, "message": "认证失败"}
-            client_socket.sendall((json.dumps(response) + '\n').encode('utf-8'))
+            send_client_response(client_socket, response)
             logger.warning(f"客户端 {client_address} 认证失败: {username}")
             # 记录认证失败日志
             client_logger.info(f"认证失败: 密码错误", extra=log_extra)
@@ -799,12 +2175,46 @@ def client_handler(client_socket, client_address):
         
         logger.info(f"客户端 {client_address} 认证成功: {username}")
         
+        # 较大的脚本和 -S 的脚本清单压缩后跟在请求头之后分块传输
+        if auth_data.get('script_encoding') == 'zlib':
+            auth_data['script_content'] = stream.read_chunked(CLIENT_MAX_REQUEST).decode('utf-8')
+        if auth_data.get('manifest_encoding') == 'zlib':
+            auth_data['manifest'] = json.loads(stream.read_chunked(CLIENT_MAX_REQUEST))
+        
+        # 解析命令目标（标签选择器和主机列表）
+        try:
+            target = {
+                'selector': parse_selector(auth_data.get('selector')),
+                'hosts': parse_hosts(auth_data.get('hosts'))
+            }
+            limits = parse_limits(auth_data.get('limits'))
+            priority = parse_priority(auth_data.get('priority'))
+            rollout = parse_rollout(auth_data.get('rollout'))
+            since_version = parse_since_version(auth_data.get('since_version'))
+        except ValueError as e:
+            response = {"success": False, "message": str(e)}
+            send_client_response(client_socket, response)
+            client_logger.info(f"操作结果: {e}", extra=log_extra)
+            return
+        
+        def fetch_scripts(script_names):
+            """-S 同步时告知客户端需要上传的脚本，并读取压缩后分块上传的 {脚本名: 内容}"""
+            send_client_response(client_socket, {'need': script_names})
+            return json.loads(stream.read_chunked(CLIENT_MAX_REQUEST))
+        
         # 处理命令，传递可能的脚本信息
         response = handle_client_command(
             command, 
             username,
             auth_data.get('script_name'),
-            auth_data.get('script_content')
+            auth_data.get('script_content'),
+            target,
+            limits,
+            priority,
+            rollout,
+            since_version,
+            auth_data.get('manifest'),
+            fetch_scripts
         )
         
         # 更新日志成功状态
@@ -815,18 +2225,21 @@ def client_handler(client_socket, client_address):
         client_logger.info(f"操作结果: {operation_result}", extra=log_extra)
         
         # 发送响应
-        client_socket.sendall((json.dumps(response) + '\n').encode('utf-8'))
+        send_client_response(client_socket, response, compress)
     
     except json.JSONDecodeError as e:
         logger.error(f"解析客户端消息失败: {e}")
         response = {"success": False, "message": "无效的请求格式"}
-        client_socket.sendall((json.dumps(response) + '\n').encode('utf-8'))
+        send_client_response(client_socket, response)
         # 记录格式错误日志
         client_logger.info(f"请求格式错误", extra=log_extra)
     except Exception as e:
         logger.error(f"处理客户端连接时出错: {e}")
         response = {"success": False, "message": f"服务器错误: {e}"}
-        client_socket.sendall((json.dumps(response) + '\n').encode('utf-8'))
+        try:
+            send_client_response(client_socket, response)
+        except OSError:
+            pass
         # 记录服务器错误日志
         client_logger.info(f"服务器错误: {str(e)}", extra=log_extra)
     finally:
@@ -877,7 +2290,9 @@ def cleanup_dead_nodes():
 
 async def main_async():
     """异步主函数"""
+    global node_loop
     logger.info("SuperAgent Server 启动")
+    node_loop = asyncio.get_running_loop()
     
     # 加载任务结果
     load_task_results()
@@ -887,6 +2302,7 @@ async def main_async():
     
     # 启动清理协程
     asyncio.create_task(cleanup_dead_nodes_async())
+    asyncio.create_task(result_retention_async())
     
     # 启动客户端服务器（保持同步以兼容现有代码）
     client_server_thread = threading.Thread(target=start_client_server, daemon=True)
@@ -920,6 +2336,10 @@ async def cleanup_dead_nodes_async():
             # 更详细的死亡节点信息日志
             dead_nodes_info = ", ".join([f"{node_id}({hostname})" for node_id, hostname in dead_nodes])
             logger.info(f"清理了 {len(dead_nodes)} 个死亡节点: {dead_nodes_info}")
+        
+        if ingest_stats['throttled'] or ingest_stats['auth_rejected']:
+            logger.info(f"入口统计: 已接受 {ingest_stats['accepted']} 条消息，限流丢弃 {ingest_stats['throttled']} 条，"
+                        f"拒绝认证 {ingest_stats['auth_rejected']} 次")
 
 def main():
     """主函数入口"""
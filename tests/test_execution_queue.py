@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""ExecutionQueue 在分配槽位与取消交错时的行为"""
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'agent'))
+
+from agent import ExecutionQueue
+
+
+async def hold(queue, task_name, entered, leave):
+    """占用槽位直到leave被设置"""
+    async with queue.slot(task_name, 'normal'):
+        entered.set()
+        await leave.wait()
+
+
+class ExecutionQueueCancelTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_cancel_before_release(self):
+        """等待者被取消后、恢复运行前槽位被释放，不能再把槽位分配给它"""
+        queue = ExecutionQueue(1)
+        holder = queue.slot('a', 'normal')
+        await holder.__aenter__()
+        waiting = asyncio.ensure_future(hold(queue, 'b', asyncio.Event(), asyncio.Event()))
+        await asyncio.sleep(0)
+        self.assertEqual(queue.queued, 1)
+
+        waiting.cancel()
+        await holder.__aexit__(None, None, None)
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(queue.running, 0)
+        self.assertEqual(queue.queued, 0)
+
+        later = queue.slot('c', 'normal')
+        await asyncio.wait_for(later.__aenter__(), 1)
+        self.assertEqual(queue.running, 1)
+        await later.__aexit__(None, None, None)
+        self.assertEqual(queue.running, 0)
+
+    async def test_cancel_after_wake(self):
+        """已分配槽位、恢复运行前被取消的等待者归还槽位，由下一个等待者获得"""
+        queue = ExecutionQueue(1)
+        holder = queue.slot('a', 'normal')
+        await holder.__aenter__()
+        granted = asyncio.ensure_future(hold(queue, 'b', asyncio.Event(), asyncio.Event()))
+        await asyncio.sleep(0)
+        entered, leave = asyncio.Event(), asyncio.Event()
+        following = asyncio.ensure_future(hold(queue, 'c', entered, leave))
+        await asyncio.sleep(0)
+        self.assertEqual(queue.queued, 2)
+
+        await holder.__aexit__(None, None, None)
+        granted.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await granted
+        await asyncio.wait_for(entered.wait(), 1)
+        self.assertEqual(queue.running, 1)
+        self.assertEqual(queue.queued, 0)
+
+        leave.set()
+        await following
+        self.assertEqual(queue.running, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()